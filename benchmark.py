@@ -0,0 +1,385 @@
+#*******************************************************************************#
+# Benchmarks for the HL7 library.  Builds a reproducible synthetic corpus of    #
+# ADT, ORM and ORU messages and times parse, serialize, ACK building, file      #
+# streaming and MLLP loopback send/receive.  Results are written as JSON so     #
+# runs against different versions can be compared                              #
+#                                                                               #
+#   python benchmark.py --count 2000 --obx 50 --output new.json                 #
+#   python benchmark.py --compare old.json new.json                             #
+#                                                                               #
+# Parse throughput targets are checked against an earlier hl7.py, e.g.          #
+#                                                                               #
+#   git show <commit>:hl7.py > old_hl7.py                                       #
+#   python benchmark.py --only parse --against old_hl7.py                       #
+#*******************************************************************************#
+
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import hl7
+
+kinds = ('ADT', 'ORM', 'ORU')
+
+#-------------------------------------------------------------------------------#
+# Synthetic message generator.  The same seed always gives the same corpus      #
+#-------------------------------------------------------------------------------#
+lastNames = ('SMITH', 'JOHNSON', 'WILLIAMS', 'BROWN', 'JONES', 'GARCIA', 'MILLER', 'DAVIS')
+firstNames = ('JAMES', 'MARY', 'ROBERT', 'PATRICIA', 'JOHN', 'JENNIFER', 'MICHAEL', 'LINDA')
+tests = (('WBC', 'White blood cells', '10*3/uL', '4.0-11.0'), ('HGB', 'Hemoglobin', 'g/dL', '12.0-17.5'),
+         ('PLT', 'Platelets', '10*3/uL', '150-400'), ('NA', 'Sodium', 'mmol/L', '135-145'),
+         ('K', 'Potassium', 'mmol/L', '3.5-5.1'), ('GLU', 'Glucose', 'mg/dL', '70-99'))
+
+def generate(kind,rng,n=1,obx=10,repetitions=2,subcomponents=True,size=0,wide=0):
+    """Builds one synthetic message of the given type as a string"""
+    stamp = '2015%02d%02d%02d%02d00' % (rng.randint(1,12), rng.randint(1,28), rng.randint(0,23), rng.randint(0,59))
+    mrn = str(rng.randint(100000,999999))
+    last, first = rng.choice(lastNames), rng.choice(firstNames)
+    name = last + '^' + first + '^' + ('Q&R' if subcomponents else 'Q') + '^JR'
+    ids = '~'.join([mrn + '^^^MRN^MR'] + [str(rng.randint(100000000,999999999)) + '^^^SSA^SS' for i in range(repetitions - 1)])
+    event = {'ADT': 'A08^ADT_A01', 'ORM': 'O01^ORM_O01', 'ORU': 'R01^ORU_R01'}[kind]
+
+    segments = [
+        'MSH|^~\\&|SENDAPP|SENDFAC|RECVAPP|RECVFAC|%s||%s^%s|MSG%08d|P|2.5|||AL|NE|||UNICODE UTF-8' % (stamp, kind, event, n),
+        'PID|1||%s||%s||19%02d%02d%02d|%s|||%d MAIN ST^^TOWN^ST^%05d||555-%04d|||||ACCT%d' % (
+            ids, name, rng.randint(20,99), rng.randint(1,12), rng.randint(1,28), rng.choice('MF'),
+            rng.randint(1,999), rng.randint(10000,99999), rng.randint(0,9999), n),
+        'PV1|1|I|WARD^%d^A||||%d^DOC^JANE|||||||||||V%d' % (rng.randint(100,999), rng.randint(1000,9999), n),
+    ]
+    if kind == 'ADT':
+        segments.insert(1, 'EVN|A08|' + stamp)
+        for i in range(repetitions):
+            segments.append('NK1|%d|%s^%s|%s' % (i + 1, last, rng.choice(firstNames), rng.choice(('SPO', 'SON', 'DAU'))))
+            segments.append('AL1|%d|DA|%d^ALLERGEN %d^LOCAL|MO|RASH' % (i + 1, rng.randint(100,999), i))
+        segments.append('DG1|1||I10^Essential hypertension^I10|||A')
+    else:
+        test = rng.choice(tests)
+        segments.append('ORC|%s|ORD%d|FIL%d||CM' % ('NW' if kind == 'ORM' else 'RE', n, n))
+        segments.append('OBR|1|ORD%d|FIL%d|%s^%s^LN|||%s' % (n, n, test[0], test[1], stamp))
+        if kind == 'ORU':
+            for i in range(obx):
+                test = rng.choice(tests)
+                segments.append('OBX|%d|NM|%s^%s^LN||%.1f|%s|%s|N|||F' % (i + 1, test[0], test[1], rng.uniform(1,200), test[2], test[3]))
+        else:
+            segments.append('NTE|1||Routine order')
+    if wide:
+        # One very wide segment, plain, component and repeating fields mixed
+        values = []
+        for i in range(1, wide + 1):
+            if i % 7 == 0:
+                values.append('')
+            elif i % 5 == 0:
+                values.append('C%d^%s^L' % (i, rng.choice(lastNames)))
+            elif i % 11 == 0:
+                values.append('R%d~R%d' % (i, rng.randint(0,99)))
+            else:
+                values.append('V%d.%d' % (i, rng.randint(0,999)))
+        segments.append('ZWD|' + '|'.join(values))
+
+    raw = '\r'.join(segments) + '\r'
+    # Padding with notes until the message reaches the requested size
+    i = 1
+    while len(raw) < size:
+        raw += 'NTE|%d||%s\r' % (i, 'X' * min(200, size - len(raw)))
+        i += 1
+    return raw
+
+def corpus(kind='ORU',count=1000,seed=1,**options):
+    """Returns a list of count synthetic messages, the same for the same seed"""
+    rng = random.Random('%s-%s' % (kind, seed))
+    return [generate(kind, rng, n, **options) for n in range(count)]
+
+#-------------------------------------------------------------------------------#
+# Harness.  Every operation is timed call by call for the latency percentiles,  #
+# then run once more under tracemalloc, keeping what it returns, for the peak   #
+# memory                                                                        #
+#-------------------------------------------------------------------------------#
+def measure(fn,items,repeat=3):
+    """Times fn over every item, returning throughput, latency and peak memory"""
+    clock = time.perf_counter
+    latencies = []
+    total = 0.0
+    for r in range(repeat):
+        for item in items:
+            start = clock()
+            fn(item)
+            latencies.append(clock() - start)
+        total += sum(latencies[-len(items):])
+
+    tracemalloc.start()
+    kept = [fn(item) for item in items]
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del kept
+
+    return _summary(latencies, total, len(items) * repeat, peak)
+
+def _summary(latencies,total,ops,peak):
+    """Summary numbers for one benchmark, times in microseconds"""
+    latencies.sort()
+    def percentile(p):
+        return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1e6, 2)
+    return {
+        'ops': ops,
+        'ops_per_sec': round(ops / total, 1) if total else None,
+        'p50_us': percentile(.50),
+        'p90_us': percentile(.90),
+        'p99_us': percentile(.99),
+        'max_us': round(latencies[-1] * 1e6, 2),
+        'peak_kb': round(peak / 1024, 1) if peak is not None else None,
+    }
+
+def benchMessages(messages,repeat):
+    """Parse, serialize and ACK benchmarks over a list of raw messages"""
+    results = {}
+    results['parse'] = measure(hl7.parse, messages, repeat)
+    results['parse_lazy'] = measure(lambda raw: hl7.parse(raw, lazy=True), messages, repeat)
+    results['parse_compact'] = measure(lambda raw: hl7.parse(raw, compact=True), messages, repeat)
+    results['parse_bytes'] = measure(hl7.parse, [raw.encode('utf-8') for raw in messages], repeat)
+    results['peek'] = measure(hl7.peek, messages, repeat)
+
+    parsed = [hl7.parse(raw) for raw in messages]
+    results['toString'] = measure(hl7.toString, parsed, repeat)
+    edited = [hl7.parse(raw) for raw in messages]
+    for msg in edited:
+        msg['PID']['PID.5'] = 'DOE^JOHN'
+    results['toString_edited'] = measure(hl7.toString, edited, repeat)
+
+    results['ack'] = measure(hl7.makeAck, messages, repeat)
+    results['ack_error'] = measure(lambda raw: hl7.makeAck(raw, 'AE', 'Bad field', '102'), messages, repeat)
+    return results
+
+def benchFile(messages,repeat):
+    """Streams the messages back from a file on disk"""
+    results = {}
+    folder = tempfile.mkdtemp()
+    path = os.path.join(folder, 'corpus.hl7')
+    try:
+        with open(path, 'w', newline='') as f:
+            f.write('\n'.join(raw.rstrip('\r') for raw in messages) + '\n')
+        size = os.path.getsize(path)
+
+        # iterMessages is a generator, so each message is timed as it comes off
+        clock = time.perf_counter
+        for name, binary in (('file_iterMessages', False), ('file_iterMessages_bytes', True)):
+            latencies = []
+            for r in range(repeat):
+                stream = hl7.file(path).iterMessages(binary)
+                while True:
+                    start = clock()
+                    raw = next(stream, None)
+                    if raw is None:
+                        break
+                    latencies.append(clock() - start)
+            tracemalloc.start()
+            for raw in hl7.file(path).iterMessages(binary):
+                pass
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            total = sum(latencies)
+            results[name] = _summary(latencies, total, len(latencies), peak)
+            results[name]['mb_per_sec'] = round(size * repeat / total / 1e6, 1) if total else None
+
+        # read returns the whole file in one call, throughput only
+        start = clock()
+        for r in range(repeat):
+            count = len(hl7.file(path).read())
+        total = clock() - start
+        tracemalloc.start()
+        hl7.file(path).read()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['file_read'] = {'ops': count * repeat,
+                                'ops_per_sec': round(count * repeat / total, 1) if total else None,
+                                'peak_kb': round(peak / 1024, 1),
+                                'mb_per_sec': round(size * repeat / total / 1e6, 1) if total else None}
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+        os.rmdir(folder)
+    return results
+
+def benchLoopback(messages,repeat,window=32):
+    """Sends the messages over MLLP to a listener on this machine"""
+    results = {}
+    ib = hl7.tcp.server(0)
+    ib.start()
+    port = ib.ib.getsockname()[1]
+
+    def listen():
+        # Receiving and ACKing until the listener is stopped
+        try:
+            while True:
+                ib.getMsg()
+        except Exception:
+            pass
+    listener = threading.Thread(target=listen, daemon=True)
+    listener.start()
+
+    try:
+        ob = hl7.tcp.client('127.0.0.1', port)
+        if not ob.start():
+            return {'error': 'could not connect to loopback listener'}
+        results['mllp_send'] = measure(ob.send, messages, repeat)
+        results['mllp_send'].pop('peak_kb')
+
+        # Windowed sending, throughput only since messages overlap
+        ob.pipeline(window=window)
+        start = time.perf_counter()
+        for r in range(repeat):
+            futures = [ob.sendAsync(raw) for raw in messages]
+            for future in futures:
+                future.result()
+        total = time.perf_counter() - start
+        results['mllp_pipeline'] = {'ops': len(messages) * repeat, 'window': window,
+                                    'ops_per_sec': round(len(messages) * repeat / total, 1)}
+        ob.stop()
+    finally:
+        ib.stop()
+    return results
+
+#-------------------------------------------------------------------------------#
+# Parse throughput targets.  Each corpus is parsed by this hl7.py and by an     #
+# earlier one.  The new parse must reach the msg/s floor and be at least the    #
+# given times faster than the old one.  Wide segments cost the old parse a      #
+# scan per field, so the gain is largest there.  Floors are a little under      #
+# half what CPython 3.11 does on one core of a current x86 server               #
+#-------------------------------------------------------------------------------#
+parseTargets = (
+    # Name, message type, corpus options, msg/s floor, minimum speedup
+    ('wide', 'ADT', {'wide': 400}, 1000, 3.0),
+    ('deep', 'ORU', {'obx': 300}, 150, 1.15),
+    ('typical', 'ADT', {}, 6000, 1.15),
+)
+
+def benchParse(against,count=200,repeat=3,seed=1):
+    """Parse msg/s of this hl7.py and the one at against, checked against parseTargets"""
+    spec = importlib.util.spec_from_file_location('hl7_old', against)
+    old = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(old)
+
+    clock = time.perf_counter
+    results = {}
+    for name, kind, options, floor, target in parseTargets:
+        messages = corpus(kind, count, seed, **options)
+        # Passes alternate between the two and the fastest of each is kept,
+        # so a busy machine doesn't favour either one
+        best = {old.parse: None, hl7.parse: None}
+        for r in range(max(repeat, 5)):
+            for parse in best:
+                start = clock()
+                for raw in messages:
+                    parse(raw)
+                elapsed = clock() - start
+                if best[parse] is None or elapsed < best[parse]:
+                    best[parse] = elapsed
+        before = round(count / best[old.parse], 1)
+        after = round(count / best[hl7.parse], 1)
+        speedup = round(after / before, 2)
+        results[name] = {'old_msg_per_sec': before, 'new_msg_per_sec': after,
+                         'avg_bytes': sum(len(raw) for raw in messages) // count,
+                         'speedup': speedup, 'target_msg_per_sec': floor, 'target_speedup': target,
+                         'met': after >= floor and speedup >= target}
+    return results
+
+#-------------------------------------------------------------------------------#
+# Running, reporting and comparing                                              #
+#-------------------------------------------------------------------------------#
+def run(count=1000,repeat=3,seed=1,only=None,**options):
+    """Runs every benchmark, returning the results as a dictionary"""
+    report = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0],
+            'implementation': platform.python_implementation(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'count': count, 'repeat': repeat, 'seed': seed,
+            'options': options,
+        },
+        'results': {},
+    }
+    for kind in kinds:
+        messages = corpus(kind, count, seed, **options)
+        results = {}
+        if only in (None, 'messages'):
+            results.update(benchMessages(messages, repeat))
+        if only in (None, 'file'):
+            results.update(benchFile(messages, repeat))
+        if only in (None, 'mllp'):
+            results.update(benchLoopback(messages, repeat))
+        report['meta'][kind + '_avg_bytes'] = sum(len(raw) for raw in messages) // count
+        report['results'][kind] = results
+    return report
+
+def compare(old,new):
+    """Prints throughput of new against old, per message type and benchmark"""
+    print('%-4s %-26s %14s %14s %8s' % ('type', 'benchmark', 'old ops/s', 'new ops/s', 'change'))
+    for kind, results in new['results'].items():
+        for name, result in results.items():
+            before = old['results'].get(kind, {}).get(name, {}).get('ops_per_sec')
+            after = result.get('ops_per_sec')
+            if not before or not after:
+                continue
+            print('%-4s %-26s %14.1f %14.1f %+7.1f%%' % (kind, name, before, after, (after / before - 1) * 100))
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the HL7 library')
+    parser.add_argument('--count', type=int, default=1000, help='messages per type')
+    parser.add_argument('--repeat', type=int, default=3, help='passes over the corpus')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--obx', type=int, default=10, help='OBX segments per ORU')
+    parser.add_argument('--repetitions', type=int, default=2, help='field and segment repetitions')
+    parser.add_argument('--no-subcomponents', dest='subcomponents', action='store_false')
+    parser.add_argument('--size', type=int, default=0, help='minimum message size in bytes')
+    parser.add_argument('--wide', type=int, default=0, help='fields in an extra wide Z segment, e.g. 400')
+    parser.add_argument('--only', choices=('messages', 'file', 'mllp', 'parse'))
+    parser.add_argument('--against', help='earlier hl7.py to check the parse targets against')
+    parser.add_argument('--output', help='JSON file to write, default is stdout')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='compare two result files')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        compare(old, new)
+        return
+
+    if args.only == 'parse':
+        if not args.against:
+            parser.error('--only parse needs --against')
+        report = {'meta': {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': sys.version.split()[0],
+                           'count': args.count, 'repeat': args.repeat, 'seed': args.seed, 'against': args.against},
+                  'results': {}}
+    else:
+        report = run(args.count, args.repeat, args.seed, args.only, obx=args.obx, repetitions=args.repetitions,
+                     subcomponents=args.subcomponents, size=args.size, wide=args.wide)
+    if args.against:
+        report['parse_targets'] = benchParse(args.against, args.count, args.repeat, args.seed)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+    if args.against:
+        # A missed target fails the run, so it can gate a build
+        missed = [name for name, result in report['parse_targets'].items() if not result['met']]
+        for name in missed:
+            print('parse target missed: %s' % name, file=sys.stderr)
+        if missed:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -5,28 +5,62 @@
 #*******************************************************************************#
 
 import socket
+import asyncio
+import threading
+import select
+import time
+import random
 import datetime
 import pickle
+import struct
+import sqlite3
+import os
+import mmap
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from copy import deepcopy
+from functools import lru_cache
+from inspect import iscoroutinefunction
+from itertools import islice
+from queue import Empty, LifoQueue
 from ftplib import FTP
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from io import BytesIO, StringIO
-from re import compile, match, sub
+from re import compile, escape
 from os import remove, rename
+from urllib.parse import quote
+from zlib import crc32
 
 #-------------------------------------------------------------------------------#
 # This function takes the message as a string and creates "msg" variable        #
 # in the form of a Python dictionary with HL7 fields as keys and field values   #
 # as the values.  Repeating fields and segments are nested python lists         #
 #-------------------------------------------------------------------------------#
-def parse(raw):
+def parse(raw,lazy=False,compact=False):
     """Turns message into Python Dictionary"""
-    if raw == '':
+    if len(raw) == 0:
         return False
 
+    if compact:
+        # Offset-backed message object instead of a dictionary tree, bytes
+        # are kept as they are and only decoded a segment at a time
+        return message(raw)
+
+    if not isinstance(raw,str):
+        # Bytes or memoryview, MLLP framing removed and decoded per MSH-18
+        raw = _decode(raw)
+
+    if lazy:
+        # Segments are split now but fields are only parsed when accessed
+        return parseLazy(raw)
+
     # This will be the returned parsed message dictionary
     msg = {}
 
     # Metadata
-    structure = ""      # Since dictionary loses our order, we maintain in structure string
+    structure = []      # Since dictionary loses our order, we maintain in structure string
     segList = []        # List of message segments
     
     # Getting encoding characters from MSH-1 & MSH-2
@@ -35,6 +69,10 @@ def parse(raw):
     rep = raw[5:6]
     esc = raw[6:7]
     sub = raw[7:8]
+    enc = (fld, com, rep, sub)
+
+    # Storing fields without marking the segment as edited
+    setField = dict.__setitem__
     
     # Finding the newline or return character
     raw = raw.replace('\n','\r')
@@ -43,7 +81,7 @@ def parse(raw):
     # Splitting Segments at the return character
     segments = raw.split(ret)
     
-    # Looping over the segments
+    # Looping over the segments, each one is split and visited once
     for segment in segments:
         # Getting segment name
         seg = segment[0:3]
@@ -51,196 +89,1022 @@ def parse(raw):
         if seg == '':
             continue
 
-        # Adding segment name to segment list
-        repSegList = []
-        if seg in segList:
-            # # Checking for repeating segments
-            index = segList.index(seg)
-            if isinstance(msg[segList[index]],list):
-                repSegList = msg[segList[index]]
-                msg[seg] = {}
-            else:
-                repSegList.append(msg[segList[index]])
-                msg[seg] = {}
-        else:
-            # Creating segment dictionary
-            msg[seg] = {}
-            # Adding unique segment to list
-            segList.append(seg)
-            # Setting this back to false
-            repSegList = []
-        
-        # Trimming segment name off
-        segment = segment[4:]
-
-        # Adding segment to structure string
-        structure += seg + '|'
-        
-        # Splitting into fields and assigning to msg dictionary
-        fields = segment.split(fld)
+        # Splitting into fields and assigning to segment dictionary, which
+        # keeps the original segment string so toString can reuse it
+        fields = segment[4:].split(fld)
+        segDict = _segment(seg, segment, enc, False)
 
-        # Looping over fields
         if seg == 'MSH':
-            msg[seg]['MSH.1'] = fld
+            setField(segDict, 'MSH.1', fld)
             fldCount = 2            # We've already set MSH_1 so we start at 2
         else:
             fldCount = 1
 
-        # Process segments
-        for field in fields:
-            # This is the current key name field
-            currFld = seg+"."+str(fldCount)
-
-            # If field is repeating we loop over repetitions
-            if rep in field and currFld != 'MSH.2':
-                field_list = []     # Starting a field list for the repetitions
+        # Adding segment to structure string
+        structure.append(_structureLine(seg, fldCount, len(fields)))
 
-                repetitions = field.split(rep)
+        # Process fields, the key prefix is built once per segment
+        prefix = seg + '.'
+        for field in fields:
+            currFld = prefix + str(fldCount)
+            if rep in field or com in field or sub in field:
+                setField(segDict, currFld, _parseField(currFld, field, com, rep, sub))
+            else:
+                # Plain field, the most common case
+                setField(segDict, currFld, field)
+            fldCount += 1   # Incrementing Field Count Variable 
 
-                for repetition in repetitions:
-                    msg[seg][currFld] = {}
+        # Repeating segments are kept as a list in message order
+        if seg in msg:
+            if isinstance(msg[seg],list):
+                msg[seg].append(segDict)
+            else:
+                msg[seg] = [msg[seg], segDict]
+        else:
+            msg[seg] = segDict
+            segList.append(seg)
 
-                    # Looping over components
-                    if com in repetition and currFld != 'MSH.2':
-                        comCount = 1
-                        components = repetition.split(com)
+    structure = ''.join(structure)
 
-                        for component in components:
-                            currCom = seg+"."+str(fldCount)+"."+str(comCount)
+    # Adding structure string to dictionary
+    msg['structure'] = structure
 
-                            msg[seg][currFld][currCom] = {}
+    # Adding a copy of the original message
+    msg['raw'] = raw
 
-                            # Looping over sub-components
-                            if sub in component:
-                                subCount = 1
-                                subcomponents = component.split(sub)
-                                for subcomponent in subcomponents:
-                                    currSub = seg+"."+str(fldCount)+"."+str(comCount)+"."+str(subCount)
-                                    msg[seg][currFld][currCom][currSub] = {}
-                                    msg[seg][currFld][currCom][currSub] = subcomponent
+    # Returning a list of segments
+    msg['segments'] = segList
+    
+    # Useful for scripting to kill or error message
+    msg['status'] = ''
 
-                                    subCount += 1   # Incrementing Sub-Componenet Count
-                            else:
-                                msg[seg][currFld][currCom] = component
+    # Returning short-cuts to useful fields
+    msg['msg_date'] = msg['MSH']['MSH.7']
+    msg['msg_type'] = msg['MSH'].peek('MSH.9')['MSH.9.1']
+    msg['msg_event'] = msg['MSH'].peek('MSH.9')['MSH.9.2']
+    msg['msg_id'] = msg['MSH']['MSH.10']
+    msg['msg_version'] = msg['MSH']['MSH.12']
 
-                            comCount += 1   # Incrementing Component Count
-                    else:
-                        msg[seg][currFld] = repetition
-                        
-                    # Appending field to list
-                    field_list.append(msg[seg][currFld])
+    # Returning dictionary
+    return msg
 
-                # Setting the field to a list format    
-                msg[seg][currFld] = field_list  
+#-------------------------------------------------------------------------------#
+# Lazy version of "parse".  The message is split into segments up front, but    #
+# each segment is a dictionary that only builds the fields that are accessed.   #
+# Routing on a few MSH and PID fields never pays for the rest of the message    #
+#-------------------------------------------------------------------------------#
+def parseLazy(raw):
+    """Turns message into Python Dictionary of lazily parsed segments"""
+    if len(raw) == 0:
+        return False
 
-            else:
-                msg[seg][currFld] = {}
-
-                # Looping over components
-                if com in field and currFld != 'MSH.2':
-                    comCount = 1
-                    components = field.split(com)
-
-                    for component in components:
-                        currCom = seg+"."+str(fldCount)+"."+str(comCount)
-
-                        msg[seg][currFld][currCom] = {}
-
-                        # Looping over sub-components
-                        if sub in component:
-                            subCount = 1
-                            subcomponents = component.split(sub)
-                            for subcomponent in subcomponents:
-                                currSub = seg+"."+str(fldCount)+"."+str(comCount)+"."+str(subCount)
-                                msg[seg][currFld][currCom][currSub] = {}
-                                msg[seg][currFld][currCom][currSub] = subcomponent
-
-                                subCount += 1   # Incrementing Sub-Componenet Count
-                        else:
-                            msg[seg][currFld][currCom] = component
-
-                        comCount += 1   # Incrementing Component Count
-                elif sub in field and currFld != 'MSH.2':
-                    # Processing subfields w/o components
-                    comCount = 1
-                    subCount = 1
-                    currCom = seg+"."+str(fldCount)+"."+str(comCount)
-                    msg[seg][currFld][currCom] = {}
-                    subcomponents = field.split(sub)
-                    for subcomponent in subcomponents:
-                        currSub = seg+"."+str(fldCount)+"."+str(comCount)+"."+str(subCount)
-                        msg[seg][currFld][currCom][currSub] = {}
-                        msg[seg][currFld][currCom][currSub] = subcomponent
-
-                        subCount += 1   # Incrementing Sub-Componenet Count
-                else:
-                    msg[seg][currFld] = field
+    if not isinstance(raw,str):
+        raw = _decode(raw)
 
-            index = fields.index(field)
-            fields[index] = currFld
+    msg = {}
+    structure = []      # Structure lines, joined once at the end
+    segList = []        # List of message segments
 
-            fldCount += 1   # Incrementing Field Count Variable 
+    # Getting encoding characters from MSH-1 & MSH-2
+    enc = (raw[3:4], raw[4:5], raw[5:6], raw[7:8])
+    fld = enc[0]
 
-        fieldStr = fld.join(fields)
-        structureStr = '|'.join(fields)
+    raw = raw.replace('\n','\r')
 
-        # Adding return character to structure string
-        structure += structureStr + ret
+    for segment in raw.split('\r'):
+        seg = segment[0:3]
+        if seg == '':
+            continue
 
-        if repSegList:
-            repSegList.append(msg[seg])
-            msg[seg] = repSegList
+        # Counting fields without splitting them
+        if seg == 'MSH':
+            structure.append(_structureLine(seg, 2, segment.count(fld, 4) + 1))
+        else:
+            structure.append(_structureLine(seg, 1, segment.count(fld, 4) + 1))
 
-    # Adding structure string to dictionary
-    msg['structure'] = structure
+        segDict = _segment(seg, segment, enc)
+        if seg in msg:
+            # Repeating segment
+            if isinstance(msg[seg],list):
+                msg[seg].append(segDict)
+            else:
+                msg[seg] = [msg[seg], segDict]
+        else:
+            msg[seg] = segDict
+            segList.append(seg)
 
-    # Adding a copy of the original message
+    msg['structure'] = ''.join(structure)
     msg['raw'] = raw
-
-    # Returning a list of segments
     msg['segments'] = segList
-    
-    # Useful for scripting to kill or error message
     msg['status'] = ''
 
-    # Returning short-cuts to useful fields
+    # Short-cuts only touch the MSH fields they need
     msg['msg_date'] = msg['MSH']['MSH.7']
-    msg['msg_type'] = msg['MSH']['MSH.9']['MSH.9.1']
-    msg['msg_event'] = msg['MSH']['MSH.9']['MSH.9.2']
+    msg['msg_type'] = msg['MSH'].peek('MSH.9')['MSH.9.1']
+    msg['msg_event'] = msg['MSH'].peek('MSH.9')['MSH.9.2']
     msg['msg_id'] = msg['MSH']['MSH.10']
     msg['msg_version'] = msg['MSH']['MSH.12']
 
-    # Returning dictionary
     return msg
 
+@lru_cache(maxsize=1024)
+def _structureLine(seg,first,count):
+    """Builds the structure string line for a segment of count fields"""
+    keys = []
+    for n in range(first, first + count):
+        keys.append(seg + '.' + str(n))
+    return seg + '|' + '|'.join(keys) + '\r'
+
+def _parseField(currFld,field,com,rep,sub):
+    """Turns a single field string into a string, component dictionary or repetition list"""
+    if currFld == 'MSH.2':
+        # Encoding characters are never split
+        return field
+
+    if rep in field:
+        # Repeating field, each repetition may have components
+        field_list = []
+        for repetition in field.split(rep):
+            if com in repetition:
+                field_list.append(_parseComponents(currFld,repetition,com,sub))
+            else:
+                field_list.append(repetition)
+        return field_list
+
+    if com in field:
+        return _parseComponents(currFld,field,com,sub)
+
+    if sub in field:
+        # Sub-components without components are kept under component 1
+        currCom = currFld + '.1'
+        return {currCom: _parseSubComponents(currCom,field,sub)}
+
+    return field
+
+def _parseComponents(currFld,field,com,sub):
+    """Splits a field or repetition into its component dictionary"""
+    components = {}
+    comCount = 1
+    for component in field.split(com):
+        currCom = currFld + '.' + str(comCount)
+        if sub in component:
+            components[currCom] = _parseSubComponents(currCom,component,sub)
+        else:
+            components[currCom] = component
+        comCount += 1
+    return components
+
+def _parseSubComponents(currCom,component,sub):
+    """Splits a component into its sub-component dictionary"""
+    subcomponents = {}
+    subCount = 1
+    for subcomponent in component.split(sub):
+        subcomponents[currCom + '.' + str(subCount)] = subcomponent
+        subCount += 1
+    return subcomponents
+
+def _peekField(segDict,key):
+    """Reads a field without marking a parsed segment as changed"""
+    if segDict.__class__ is _segment:
+        return segDict.peek(key)
+    return segDict[key]
+
+class _segment(dict):
+    """Segment dictionary that parses a field the first time it is accessed"""
+    # Python code sees every field, but C code that reads the dictionary
+    # storage directly, such as json.dumps, only sees the fields loaded so
+    # far.  "toDict" returns a fully parsed plain copy
+    __slots__ = ('name', 'text', 'enc', 'fields', 'dirty')
+
+    def __init__(self,name,text,enc,fields=None):
+        self.name = name        # Segment name, e.g. PID
+        self.text = text        # Original segment string
+        self.enc = enc          # (field, component, repetition, sub-component)
+        self.fields = fields    # Split field strings, False once fully loaded
+        self.dirty = False      # Set once the segment may have been changed
+
+    def _split(self):
+        # Splitting fields only once, the first time any field is needed
+        if self.fields is None:
+            self.fields = self.text[4:].split(self.enc[0])
+        return self.fields
+
+    def _index(self,key):
+        # Turns a key like PID.3 into an index into the split field list
+        if not isinstance(key,str) or key[0:4] != self.name + '.' or not key[4:].isdigit() or key[4:5] == '0':
+            return None
+        n = int(key[4:])
+        if self.name == 'MSH':
+            n -= 1          # MSH.1 is the field separator itself
+        if n < 1 or n > len(self._split()):
+            return None
+        return n - 1
+
+    def _load(self,key):
+        # Parsing a single field into the dictionary
+        if self.fields is False:
+            return False
+        if key == 'MSH.1' and self.name == 'MSH':
+            dict.__setitem__(self, key, self.enc[0])
+            return True
+        i = self._index(key)
+        if i is None:
+            return False
+        fld, com, rep, sub = self.enc
+        dict.__setitem__(self, key, _parseField(key, self.fields[i], com, rep, sub))
+        return True
+
+    def _loadAll(self):
+        # Parsing every field, keeping anything already loaded or edited
+        if self.fields is False:
+            return
+        loaded = dict(dict.items(self))
+        dict.clear(self)
+        fld, com, rep, sub = self.enc
+        if self.name == 'MSH':
+            first = 2
+            dict.__setitem__(self, 'MSH.1', loaded.pop('MSH.1', fld))
+        else:
+            first = 1
+        for field in self._split():
+            key = self.name + '.' + str(first)
+            if key in loaded:
+                dict.__setitem__(self, key, loaded.pop(key))
+            else:
+                dict.__setitem__(self, key, _parseField(key, field, com, rep, sub))
+            first += 1
+        # Keys added by the user that are not in the original segment
+        dict.update(self, loaded)
+        self.fields = False
+
+    def _edit(self):
+        # Anything that can change the segment means it must be rebuilt
+        self._loadAll()
+        self.dirty = True
+
+    def peek(self,key):
+        """Returns a field without marking the segment as changed"""
+        if not dict.__contains__(self, key):
+            self._load(key)
+        return dict.__getitem__(self, key)
+
+    def __getitem__(self,key):
+        if not dict.__contains__(self, key):
+            self._load(key)
+        value = dict.__getitem__(self, key)
+        if value.__class__ is not str:
+            # Components and repetitions can be edited in place
+            self.dirty = True
+        return value
+
+    def get(self,key,default=None):
+        if not dict.__contains__(self, key) and not self._load(key):
+            return default
+        value = dict.__getitem__(self, key)
+        if value.__class__ is not str:
+            self.dirty = True
+        return value
+
+    def __contains__(self,key):
+        if dict.__contains__(self, key):
+            return True
+        return self._load(key)
+
+    def __setitem__(self,key,value):
+        self.dirty = True
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self,key):
+        self._edit()
+        dict.__delitem__(self, key)
+
+    def __iter__(self):
+        self._loadAll()
+        return dict.__iter__(self)
+
+    def __len__(self):
+        self._loadAll()
+        return dict.__len__(self)
+
+    def __eq__(self,other):
+        self._loadAll()
+        return dict.__eq__(self, other)
+
+    def __ne__(self,other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        self._loadAll()
+        return dict.__repr__(self)
+
+    def __reduce__(self):
+        # Pickled fully loaded, keeping the original text for toString
+        self._loadAll()
+        return (_segment, (self.name, self.text, self.enc, False), (dict(dict.items(self)), self.dirty))
+
+    def __setstate__(self,state):
+        dict.update(self, state[0])
+        self.dirty = state[1]
+
+    def __copy__(self):
+        # A shallow copy shares fields with this segment, like "copy"
+        return self.copy()
+
+    def __deepcopy__(self,memo):
+        self._loadAll()
+        segDict = _segment(self.name, self.text, self.enc, False)
+        memo[id(self)] = segDict
+        dict.update(segDict, deepcopy(dict(dict.items(self)), memo))
+        segDict.dirty = self.dirty
+        return segDict
+
+    def keys(self):
+        self._loadAll()
+        return dict.keys(self)
+
+    def values(self):
+        self._edit()
+        return dict.values(self)
+
+    def items(self):
+        self._edit()
+        return dict.items(self)
+
+    def copy(self):
+        self._edit()
+        return dict.copy(self)
+
+    def pop(self,*args):
+        self._edit()
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self._edit()
+        return dict.popitem(self)
+
+    def setdefault(self,key,default=None):
+        self._edit()
+        return dict.setdefault(self, key, default)
+
+    def update(self,*args,**kwargs):
+        self._edit()
+        dict.update(self, *args, **kwargs)
+
+    def clear(self):
+        self._edit()
+        dict.clear(self)
+
+    __hash__ = None
+
+#-------------------------------------------------------------------------------#
+# Compact message object.  Instead of a tree of dictionaries it keeps the raw   #
+# string once plus the start and end offset of every segment.  Segments are    #
+# only turned into (lazy) dictionaries when accessed, so listeners holding      #
+# thousands of in-flight messages pay for little more than the raw text         #
+#-------------------------------------------------------------------------------#
+class message:
+    """Offset-backed message with the same keys as the "parse" dictionary"""
+    __slots__ = ('raw', 'enc', 'encoding', 'names', 'starts', 'ends', 'cache', 'extra')
+
+    # Keys that are not segments but are computed from the message
+    shortcuts = ('structure', 'raw', 'segments', 'status', 'msg_date',
+                 'msg_type', 'msg_event', 'msg_id', 'msg_version')
+
+    def __init__(self,raw):
+        self.encoding = None        # Set when raw is kept as undecoded bytes
+        if isinstance(raw,(bytes,bytearray,memoryview)):
+            raw = _unframe(raw)
+            encoding = _charset(raw)
+            if encoding in byteSafe:
+                # Segments are found in the bytes and decoded when accessed
+                if b'\n' in raw:
+                    raw = raw.replace(b'\n',b'\r')
+                self.encoding = encoding
+            else:
+                # Multi-byte character sets can contain delimiter bytes
+                raw = raw.decode(encoding, 'replace')
+
+        if self.encoding:
+            ret = b'\r'
+            self.enc = tuple(c.decode('latin-1') for c in (raw[3:4], raw[4:5], raw[5:6], raw[7:8]))
+        else:
+            raw = raw.replace('\n','\r')
+            ret = '\r'
+            self.enc = (raw[3:4], raw[4:5], raw[5:6], raw[7:8])
+        self.raw = raw
+        self.names = []             # Segment name per segment, in order
+        self.starts = array('I')    # Offset of each segment into raw
+        self.ends = array('I')      # Offset of each segment's return character
+        self.cache = None           # Segments that have been accessed
+        self.extra = None           # Keys set by the user
+
+        shared = {}     # One string object per distinct segment name
+        pos = 0
+        size = len(raw)
+        while pos < size:
+            end = raw.find(ret, pos)
+            if end == -1:
+                end = size
+            if end > pos:
+                seg = raw[pos:pos+3]
+                name = shared.get(seg)
+                if name is None:
+                    name = shared[seg] = seg if ret == '\r' else seg.decode('latin-1')
+                self.names.append(name)
+                self.starts.append(pos)
+                self.ends.append(end)
+            pos = end + 1
+
+    def _build(self,key):
+        # Creating the segment dictionary, or list for repeating segments
+        segs = []
+        for i, name in enumerate(self.names):
+            if name == key:
+                segs.append(_segment(name, self.text(i), self.enc))
+        if not segs:
+            return None
+        if len(segs) == 1:
+            segs = segs[0]
+        if self.cache is None:
+            self.cache = {}
+        self.cache[key] = segs
+        return segs
+
+    def text(self,i):
+        """Returns the original string of the i-th segment"""
+        if self.encoding:
+            return self.raw[self.starts[i]:self.ends[i]].decode(self.encoding, 'replace')
+        return self.raw[self.starts[i]:self.ends[i]]
+
+    def count(self,i):
+        """Number of fields in the i-th segment, counted without splitting"""
+        fld = self.enc[0]
+        if self.encoding:
+            fld = fld.encode('latin-1')
+        return self.raw.count(fld, self.starts[i] + 4, self.ends[i]) + 1
+
+    def segment(self,key):
+        """Returns the segment dictionary or list of segments, or None"""
+        if self.cache is not None and key in self.cache:
+            return self.cache[key]
+        if key in self.names:
+            return self._build(key)
+        return None
+
+    def structure(self):
+        """Builds the structure string from the segment offsets"""
+        structure = []
+        for i, seg in enumerate(self.names):
+            count = self.count(i)
+            if seg == 'MSH':
+                structure.append(_structureLine(seg, 2, count))
+            else:
+                structure.append(_structureLine(seg, 1, count))
+        return ''.join(structure)
+
+    def segments(self):
+        """Returns list of unique segment names in message order"""
+        segList = []
+        for name in self.names:
+            if name not in segList:
+                segList.append(name)
+        return segList
+
+    def __getitem__(self,key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        value = self.segment(key)
+        if value is not None:
+            return value
+        if key == 'raw':
+            if self.encoding:
+                return self.raw.decode(self.encoding, 'replace')
+            return self.raw
+        if key == 'structure':
+            return self.structure()
+        if key == 'segments':
+            return self.segments()
+        if key == 'status':
+            return ''
+        if key == 'msg_date':
+            return self['MSH']['MSH.7']
+        if key == 'msg_type':
+            return _peekField(self['MSH'], 'MSH.9')['MSH.9.1']
+        if key == 'msg_event':
+            return _peekField(self['MSH'], 'MSH.9')['MSH.9.2']
+        if key == 'msg_id':
+            return self['MSH']['MSH.10']
+        if key == 'msg_version':
+            return self['MSH']['MSH.12']
+        raise KeyError(key)
+
+    def __setitem__(self,key,value):
+        if key in message.shortcuts:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+        else:
+            # Replacing or adding a segment
+            if self.cache is None:
+                self.cache = {}
+            self.cache[key] = value
+
+    def __delitem__(self,key):
+        if key not in self:
+            raise KeyError(key)
+        if self.cache is None:
+            self.cache = {}
+        self.cache[key] = None      # Marks the segment as removed
+
+    def __contains__(self,key):
+        if self.extra is not None and key in self.extra:
+            return True
+        if self.cache is not None and key in self.cache:
+            return self.cache[key] is not None
+        return key in message.shortcuts or key in self.names
+
+    def get(self,key,default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        keys = [k for k in self.segments() if k in self]
+        if self.cache is not None:
+            keys += [k for k in self.cache if k not in keys and self.cache[k] is not None]
+        keys += [k for k in message.shortcuts if k not in keys]
+        if self.extra is not None:
+            keys += [k for k in self.extra if k not in keys]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [self[k] for k in self.keys()]
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def __eq__(self,other):
+        return dict(self.items()) == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'message(%r)' % (self.raw,)
+
+    def toString(self):
+        """Serializes the message, copying segments never accessed from raw"""
+        if self.extra is not None and 'structure' in self.extra:
+            # Structure was replaced, the dictionary path follows it
+            return toString(dict(self.items()))
+        return self._serialize(False)
+
+    def toBytes(self):
+        """Serializes to bytes, copying untouched segments without decoding"""
+        if not self.encoding or (self.extra is not None and 'structure' in self.extra):
+            return self.toString().encode(self.encoding or 'utf-8')
+        return self._serialize(True)
+
+    def _serialize(self,binary):
+        # Untouched segments are copied, edited ones rebuilt from their fields
+        MSH = self['MSH']
+        fld = MSH['MSH.1']
+        com = MSH['MSH.2'][0:1]
+        rep = MSH['MSH.2'][1:2]
+        sub = MSH['MSH.2'][3:4]
+        ret = b'\r' if binary else '\r'
+        cache = self.cache
+
+        outMsg = []
+        seg_dict = {}   # Keeps count of repeating segments
+        for i, name in enumerate(self.names):
+            if len(name) < 3:
+                continue
+
+            segDict = cache.get(name, self)     # self marks a segment never accessed
+            if segDict is None:
+                # Removed segment
+                continue
+            if isinstance(segDict,list):
+                t = seg_dict.get(name, -1) + 1
+                seg_dict[name] = t
+                if t < len(segDict):
+                    segDict = segDict[t]
+                else:
+                    segDict = None
+
+            if segDict is self or (segDict.__class__ is _segment and not segDict.dirty):
+                # Never accessed or not edited, copied from the raw message
+                if binary:
+                    outMsg.append(self.raw[self.starts[i]:self.ends[i]])
+                else:
+                    outMsg.append(self.text(i))
+            else:
+                # Structure line for this segment, without its return character
+                if name == 'MSH':
+                    line = _structureLine(name, 2, self.count(i))[:-1]
+                else:
+                    line = _structureLine(name, 1, self.count(i))[:-1]
+                segStr = _segmentString(name, line, segDict, fld, com, rep, sub)
+                if binary:
+                    segStr = segStr.encode(self.encoding)
+                outMsg.append(segStr)
+            outMsg.append(ret)
+
+        return (b'' if binary else '').join(outMsg)
+
+#-------------------------------------------------------------------------------#
+# Function reads the encoding characters and the header fields used for        #
+# routing straight from the MSH segment.  Nothing past the first segment is     #
+# looked at, so it costs the same for a 1 KB ADT and a 1 MB ORU                 #
+#-------------------------------------------------------------------------------#
+def peek(raw):
+    """Returns MSH-1 through MSH-12 and the parse short-cuts without parsing"""
+    if isinstance(raw,memoryview):
+        # Only copying as much of the buffer as it takes to hold MSH
+        size = 1024
+        head = raw[:size].tobytes()
+        while b'\r' not in head and b'\n' not in head and size < len(raw):
+            size *= 4
+            head = raw[:size].tobytes()
+        raw = head
+
+    if isinstance(raw,(bytes,bytearray)):
+        start = raw.find(b'MSH')
+        if start == -1:
+            # UTF-16 and UTF-32 have no MSH in their bytes, decoded whole
+            raw = _decode(raw)
+        else:
+            end = _segmentEnd(raw, start, b'\r', b'\n')
+            # Header fields are decoded on their own, in the MSH-18 character set
+            msh = bytes(raw[start:end])
+            msh = msh.decode(_charset(msh), 'replace')
+
+    if isinstance(raw,str):
+        start = raw.find('MSH')
+        if start == -1:
+            return False
+        msh = raw[start:_segmentEnd(raw, start, '\r', '\n')]
+
+    fld = msh[3:4]
+    com = msh[4:5]
+
+    # Only the first 12 fields are split off, the rest is left alone
+    fields = msh.split(fld, 12)[:12]
+    fields += [''] * (12 - len(fields))
+
+    header = {'MSH.1': fld}
+    n = 2
+    for field in fields[1:]:
+        header['MSH.' + str(n)] = field
+        n += 1
+
+    # Same short-cuts that "parse" returns
+    msgType = header['MSH.9'].split(com)
+    header['msg_date'] = header['MSH.7']
+    header['msg_type'] = msgType[0]
+    header['msg_event'] = msgType[1] if len(msgType) > 1 else ''
+    header['msg_id'] = header['MSH.10']
+    header['msg_version'] = header['MSH.12']
+
+    return header
+
+def _segmentEnd(raw,start,cr,lf):
+    """Offset of the first return or newline after start, or the end of raw"""
+    end = raw.find(cr, start)
+    if end == -1:
+        end = len(raw)
+    newline = raw.find(lf, start, end)
+    if newline != -1:
+        end = newline
+    return end
+
+#-------------------------------------------------------------------------------#
+# Bytes support.  Messages straight off a socket or file can be handed to       #
+# "parse" as bytes.  MLLP framing is sliced off and the character set is taken  #
+# from MSH-18, defaulting to UTF-8                                              #
+#-------------------------------------------------------------------------------#
+
+# HL7 table 0211 character sets and their Python codecs
+charsets = {
+    'ASCII': 'ascii',
+    '8859/1': 'latin-1',
+    '8859/2': 'iso8859-2',
+    '8859/3': 'iso8859-3',
+    '8859/4': 'iso8859-4',
+    '8859/5': 'iso8859-5',
+    '8859/6': 'iso8859-6',
+    '8859/7': 'iso8859-7',
+    '8859/8': 'iso8859-8',
+    '8859/9': 'iso8859-9',
+    '8859/15': 'iso8859-15',
+    'ISO IR14': 'iso2022_jp',
+    'ISO IR87': 'iso2022_jp',
+    'ISO IR159': 'iso2022_jp_2',
+    'GB 18030-2000': 'gb18030',
+    'KS X 1001': 'euc_kr',
+    'BIG-5': 'big5',
+    'UNICODE': 'utf-8',
+    'UNICODE UTF-8': 'utf-8',
+    'UNICODE UTF-16': 'utf-16',
+    'UNICODE UTF-32': 'utf-32',
+}
+
+# Codecs where a delimiter byte can never be part of another character
+byteSafe = ('ascii', 'utf-8', 'latin-1', 'iso8859-2', 'iso8859-3', 'iso8859-4', 'iso8859-5',
+            'iso8859-6', 'iso8859-7', 'iso8859-8', 'iso8859-9', 'iso8859-15')
+
+def _unframe(raw):
+    """Slices the MLLP start and end block characters off a message"""
+    if not isinstance(raw,bytes):
+        raw = bytes(raw)
+    begin = 1 if raw[0:1] == b'\x0b' else 0
+    end = raw.find(b'\x1c', begin)
+    if end == -1:
+        end = len(raw)
+    if begin == 0 and end == len(raw):
+        return raw
+    return raw[begin:end]
+
+def _charset(raw):
+    """Python codec for the character set named in MSH-18, UTF-8 by default"""
+    # Wide encodings can only be told apart by their byte order mark
+    if raw[0:4] in (b'\xff\xfe\x00\x00', b'\x00\x00\xfe\xff'):
+        return 'utf-32'
+    if raw[0:2] in (b'\xff\xfe', b'\xfe\xff'):
+        return 'utf-16'
+    if raw[0:3] == b'\xef\xbb\xbf':
+        return 'utf-8-sig'
+    if raw[0:3] != b'MSH' or len(raw) < 4:
+        return 'utf-8'
+    msh = raw[0:_segmentEnd(raw, 0, b'\r', b'\n')]
+    fields = msh.split(msh[3:4], 18)
+    if len(fields) < 18:
+        return 'utf-8'
+    # MSH-18 can repeat, the first repetition is the default character set
+    charset = fields[17].split(msh[5:6])[0].decode('latin-1').strip().upper()
+    return charsets.get(charset, 'utf-8')
+
+def _decode(raw):
+    """Turns framed or unframed message bytes into a string"""
+    raw = _unframe(raw)
+    return raw.decode(_charset(raw), 'replace')
+
+def toBytes(msg,encoding=None):
+    """Combining Dictionary into HL7 message bytes"""
+    if isinstance(msg,message) and encoding is None:
+        return msg.toBytes()
+    out = toString(msg)
+    if out is False:
+        return False
+    if encoding is None:
+        # Following MSH-18 like "parse" does
+        encoding = 'utf-8'
+        if 'MSH.18' in msg['MSH']:
+            charset = _peekField(msg['MSH'], 'MSH.18')
+            if isinstance(charset,list):
+                charset = charset[0]
+            if isinstance(charset,str):
+                encoding = charsets.get(charset.strip().upper(), 'utf-8')
+    return out.encode(encoding)
+
+def toDict(msg):
+    """Returns a plain dictionary copy of a parsed message or segment, every field parsed"""
+    # Lazy and compact segments only hold the fields read so far.  Code that
+    # reads dictionary storage directly, such as json.dumps, needs this copy
+    if msg.__class__ is _segment:
+        msg._loadAll()
+        items = dict.items(msg)
+    elif isinstance(msg,(dict,message)):
+        items = [(key, msg[key]) for key in msg.keys()]
+    elif msg.__class__ is list:
+        return [toDict(value) for value in msg]
+    else:
+        return msg
+    return dict((key, toDict(value)) for key, value in items)
+
+#-------------------------------------------------------------------------------#
+# Bulk parsing over a pool of processes.  Messages are handed to the workers   #
+# in chunks and only a few chunks are in flight at once, so an iterable of      #
+# millions of messages is streamed through in bounded memory                    #
+#-------------------------------------------------------------------------------#
+def parseMany(messages,workers=None,chunksize=100,ordered=True,**options):
+    """Parses an iterable of raw messages in worker processes, yielding each result"""
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    messages = iter(messages)
+
+    if workers <= 1:
+        # No pool, parsing in this process
+        for raw in messages:
+            yield parse(raw, **options)
+        return
+
+    for chunk in _poolChunks(_parseChunk, messages, chunksize, workers, ordered, (options,)):
+        for msg in chunk:
+            yield msg
+
+def _poolChunks(fn,messages,chunksize,workers,ordered=True,args=(),initializer=None,initargs=()):
+    """Yields fn(chunk, *args) for each chunk of messages, run in worker processes"""
+    pending = deque()           # Chunks in flight, in submission order
+    window = workers * 2        # Keeps every worker busy without reading ahead
+    pool = ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs)
+    try:
+        while True:
+            while len(pending) < window:
+                chunk = list(islice(messages, chunksize))
+                if not chunk:
+                    break
+                pending.append(pool.submit(fn, chunk, *args))
+
+            if not pending:
+                break
+
+            if ordered:
+                # Waiting on the oldest chunk keeps input order
+                yield pending.popleft().result()
+            else:
+                # Whichever chunk finishes first is returned first
+                done, running = wait(pending, return_when=FIRST_COMPLETED)
+                pending = deque(f for f in pending if f in running)
+                for future in done:
+                    yield future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown()
+
+def _parseChunk(chunk,options):
+    """Worker side of "parseMany", parses one chunk of messages"""
+    return [parse(raw, **options) for raw in chunk]
+
+#-------------------------------------------------------------------------------#
+# Columnar extraction.  Only the segments named by the requested fields are     #
+# found in each raw message and only those fields are split, the rest of the   #
+# message is never parsed.  Values are the HL7 text at the level the path      #
+# names, and columns come back a chunk of messages at a time                   #
+#-------------------------------------------------------------------------------#
+def extract(source,fields,chunksize=10000,workers=1,default='',arrays=False):
+    """Returns a dictionary of columns, one list per field path"""
+    columns = dict((field, []) for field in fields)
+    for chunk in extractChunks(source, fields, chunksize, workers, default):
+        for field in columns:
+            columns[field].extend(chunk[field])
+    if arrays:
+        return _arrays(columns, default)
+    return columns
+
+def extractChunks(source,fields,chunksize=10000,workers=1,default='',arrays=False):
+    """Yields a dictionary of columns for every chunksize messages, in order"""
+    if isinstance(source,file):
+        source = source.iterMessages(binary=True)
+    fields = tuple(fields)
+    _extractPlan(fields)        # Bad paths are raised before any work starts
+
+    messages = iter(source)
+    if workers is None:
+        workers = os.cpu_count() or 1
+
+    if workers <= 1:
+        while True:
+            chunk = list(islice(messages, chunksize))
+            if not chunk:
+                break
+            columns = _extractChunk(chunk, fields, default)
+            yield _arrays(columns, default) if arrays else columns
+        return
+
+    for columns in _poolChunks(_extractChunk, messages, chunksize, workers, True, (fields, default)):
+        yield _arrays(columns, default) if arrays else columns
+
+@lru_cache(maxsize=64)
+def _extractPlan(fields):
+    """Compiles the fields into split positions and the segments they need"""
+    plans = []
+    segNames = []
+    for field in fields:
+        p = path(field)
+        if p.field is None:
+            raise ValueError('Path does not name a field: %s' % p.text)
+        n = _keyOrder(p.field)
+        # Position in the segment split on the field separator, MSH.1 is the
+        # separator itself so MSH fields sit one place to the left
+        pos = n - 1 if p.seg == 'MSH' else n
+        com = _keyOrder(p.component) if p.component else 0
+        sub = _keyOrder(p.subcomponent) if p.subcomponent else 0
+        encField = p.seg == 'MSH' and n <= 2
+        plans.append((p.seg, p.segIndex, pos, p.repIndex, com, sub, p.many, encField))
+        if p.seg not in segNames:
+            segNames.append(p.seg)
+    return plans, segNames
+
+def _extractChunk(chunk,fields,default):
+    """Extracts the fields from one chunk of raw messages into columns"""
+    plans, segNames = _extractPlan(fields)
+    columns = [[] for plan in plans]
+    for raw in chunk:
+        if not isinstance(raw,str):
+            raw = _decode(raw)
+        if '\n' in raw:
+            raw = raw.replace('\n','\r')
+        segs = _extractSegments(raw, segNames)
+        for plan, column in zip(plans, columns):
+            column.append(_extractValue(raw, segs, plan, default))
+    return dict(zip(fields, columns))
+
+def _extractSegments(raw,segNames):
+    """Finds only the named segments in a raw message, left unsplit"""
+    fld = raw[3:4]
+    size = len(raw)
+    segs = {}
+    for seg in segNames:
+        if seg == 'MSH':
+            end = raw.find('\r')
+            segs[seg] = [raw[0:end if end != -1 else size]]
+            continue
+        found = []
+        tag = '\r' + seg + fld
+        start = raw.find(tag)
+        while start != -1:
+            end = raw.find('\r', start + 1)
+            if end == -1:
+                end = size
+            found.append(raw[start+1:end])
+            start = raw.find(tag, end)
+        if found:
+            segs[seg] = found
+    return segs
+
+def _extractValue(raw,segs,plan,default):
+    """Reads one field path from the segment strings, as HL7 text"""
+    seg, segIndex, pos, repIndex, com, sub, many, encField = plan
+    texts = segs.get(seg)
+    values = []
+    if texts:
+        fld, comChar, repChar, subChar = raw[3:4], raw[4:5], raw[5:6], raw[7:8]
+        for text in _pick(texts, segIndex):
+            if encField:
+                # MSH.1 and MSH.2 are the delimiters and are never split
+                values.append(fld if pos == 0 else raw[4:8])
+                continue
+            fields = text.split(fld, pos + 1)
+            if pos >= len(fields):
+                continue
+            value = fields[pos]
+            if repChar in value:
+                reps = _pick(value.split(repChar), repIndex)
+            else:
+                reps = _pick(value, repIndex)
+            for item in reps:
+                if com:
+                    parts = item.split(comChar)
+                    if com > len(parts):
+                        continue
+                    item = parts[com-1]
+                    if sub:
+                        parts = item.split(subChar)
+                        if sub > len(parts):
+                            continue
+                        item = parts[sub-1]
+                values.append(item)
+    if many:
+        return values
+    return values[0] if values else default
+
+def _arrays(columns,default):
+    """Turns column lists into NumPy arrays, numpy is only needed here"""
+    import numpy
+    arrays = {}
+    for field, column in columns.items():
+        if isinstance(default,str) and all(value.__class__ is str for value in column):
+            arrays[field] = numpy.array(column, dtype=str)
+        else:
+            # Filled in place so list values stay lists instead of a 2D array
+            arrays[field] = numpy.empty(len(column), dtype=object)
+            arrays[field][:] = column
+    return arrays
+
 #-------------------------------------------------------------------------------#
 # Function takes the python dictionary from the "parse" function and turns it   #
-# back into a string in the formatted HL7                                       #
+# back into a string in the formatted HL7.  Segments that have not been touched #
+# since "parse" are copied straight from the original message, only edited     #
+# segments are rebuilt                                                          #
 #-------------------------------------------------------------------------------#
 def toString(msg):
     """Combining Dictionary into HL7 message"""
-    if msg == '':
+    if isinstance(msg,str):
         return False
 
-    # Setting some regex patterns
-    fieldRegEx = compile('[A-Z0-9]{3}.([0-9]+)')
-    comRegEx = compile('[A-Z0-9]{3}.[0-9]+.([0-9]+)')
-    subRegEx = compile('[A-Z0-9]{3}.[0-9]+.[0-9]+.([0-9]+)')
-
-    def order(d,regex):
-        """Function takes dictionary of hl7 field names and orders them"""
-        ordered = {}
-        for k in d:
-            n = match(regex,k).group(1)
-            ordered[int(n)] = k
-        l = []
-        for k in sorted(ordered):
-            l.append(ordered[k])
-        return l
-    
-    # This is the message we will build
-    outMsg = ''
-    
+    if isinstance(msg,message):
+        return msg.toString()
+
     # Getting encoding characters
     fld = msg['MSH']['MSH.1']
     com = msg['MSH']['MSH.2'][0:1]
@@ -249,166 +1113,252 @@ def toString(msg):
     sub = msg['MSH']['MSH.2'][3:4]
     ret = "\r"
 
-    segList = []    # list of repeating segments so we don't go over them twice
-
-    seg_dict = {}   # Keeps count of segments in a dictionary
+    outMsg = []     # Segment strings, joined once at the end
 
-    segments = msg['structure'].split(ret)
+    seg_dict = {}   # Keeps count of repeating segments
 
-    for seg in segments:
-        segName = seg[0:3]
+    for line in msg['structure'].split(ret):
+        segName = line[0:3]
         
         # Skipping blanks
         if segName == '' or segName not in msg:
             continue
-            
-        # Splitting segment into fields
-        fields = seg.split('|')
 
-        if isinstance(msg[fields[0]],list):
-            # This is a repeating segment
+        segDict = msg[segName]
+        if isinstance(segDict,list):
+            # This is a repeating segment, taking the next one in order
+            t = seg_dict.get(segName, -1) + 1
+            seg_dict[segName] = t
+            if t < len(segDict):
+                segDict = segDict[t]
+            else:
+                segDict = None
+
+        outMsg.append(_segmentString(segName, line, segDict, fld, com, rep, sub))
+        outMsg.append(ret)
+
+    # Finished message
+    return ''.join(outMsg)
 
-            # Repeating segment iteration
-            t = 0
+def _segmentString(segName,line,segDict,fld,com,rep,sub):
+    """Turns one segment dictionary back into its HL7 string"""
+    if segDict.__class__ is _segment and not segDict.dirty:
+        # Untouched since parse
+        return segDict.text
+
+    fields = [segName]
+    for key in line.split('|')[1:]:
+        try:
+            fields.append(_fieldString(segDict[key], com, rep, sub))
+        except Exception:
+            # Missing fields are left out
+            continue
+    return fld.join(fields)
 
-            if segName in segList:
-                t = int(seg_dict[segName])
-                t += 1
-                seg_dict[segName] = t
+def _fieldString(value,com,rep,sub):
+    """Turns a field, component dictionary or repetition list back into a string"""
+    if isinstance(value,list):
+        repetitions = []
+        for repetition in value:
+            if isinstance(repetition,dict):
+                repetitions.append(_componentString(repetition, com, sub))
             else:
-                seg_dict[segName] = t
-                segList.append(segName)
+                repetitions.append(str(repetition))
+        return rep.join(repetitions)
+    if isinstance(value,dict):
+        return _componentString(value, com, sub)
+    return str(value)
 
-            # Adding segment name to beginning of string
-            outMsg += segName
-            
-            # Field iterator
-            i = 1
-            while i < len(fields):
+def _componentString(components,com,sub):
+    """Joins a component dictionary, and any sub-components, in key order"""
+    comList = []
+    for c in sorted(components, key=_keyOrder):
+        component = components[c]
+        if isinstance(component,dict):
+            comList.append(sub.join([str(component[s]) for s in sorted(component, key=_keyOrder)]))
+        else:
+            comList.append(str(component))
+    return com.join(comList)
+
+def _keyOrder(key):
+    """Sort key for names like PID.3.1, ordering on the last number"""
+    return int(key[key.rindex('.') + 1:])
+
+#-------------------------------------------------------------------------------#
+# Compiled field paths.  A path like "PID.3[*].1" is split once into the keys   #
+# the parse dictionaries use, so getting or setting it on each message is only #
+# dictionary lookups.  Lazy and compact messages only load the segment and     #
+# field the path names                                                          #
+#-------------------------------------------------------------------------------#
+class path:
+    """Compiled getter/setter for a field path such as PID.3[*].1 or OBX[2].5"""
+    __slots__ = ('text', 'seg', 'segIndex', 'field', 'repIndex', 'component', 'subcomponent', 'many')
+
+    ALL = -1    # Index written as [*], every repetition
+
+    def __init__(self,text):
+        self.text = text
+        levels = []     # (name or number, repetition index) per level
+        for part in text.replace('-','.').split('.'):
+            index = None
+            if part.endswith(']') and '[' in part:
+                part, index = part[:-1].split('[', 1)
+                index = path.ALL if index == '*' else int(index)
+            levels.append((part, index))
+        if not 1 <= len(levels) <= 4 or len(levels[0][0]) != 3:
+            raise ValueError('Invalid HL7 path: %s' % text)
+        for number, index in levels[1:]:
+            if not number.isdigit() or number[0:1] == '0':
+                raise ValueError('Invalid HL7 path: %s' % text)
+        if levels[2:] and (levels[2][1] is not None or levels[3:] and levels[3][1] is not None):
+            raise ValueError('Only segments and fields repeat: %s' % text)
+
+        self.seg, self.segIndex = levels[0]
+        self.field = self.component = self.subcomponent = None
+        self.repIndex = None
+        if len(levels) > 1:
+            # Keys built the same way as the parse dictionaries
+            self.field = self.seg + '.' + levels[1][0]
+            self.repIndex = levels[1][1]
+        if len(levels) > 2:
+            self.component = self.field + '.' + levels[2][0]
+        if len(levels) > 3:
+            self.subcomponent = self.component + '.' + levels[3][0]
+        self.many = path.ALL in (self.segIndex, self.repIndex)
+
+    def __repr__(self):
+        return 'path(%r)' % (self.text,)
+
+    def __call__(self,msg,default=None):
+        return self.get(msg,default)
+
+    def get(self,msg,default=None):
+        """Returns the value, or a list of values if the path has [*]"""
+        if isinstance(msg,(str,bytes,bytearray,memoryview)):
+            msg = parse(msg,compact=True)
+        found = []
+        segs = msg.get(self.seg)
+        if segs is not None:
+            field = self.field
+            for segDict in _pick(segs, self.segIndex):
+                if field is None:
+                    found.append(segDict)
+                    continue
                 try:
-                    if isinstance(msg[fields[0]][seg_dict[segName]][fields[i]],list):
-                        # If field is a list/repeating field, we keep parsing
-                        repetitions = []
-                        x = 0
-                        for repetition in msg[fields[0]][seg_dict[segName]][fields[i]]:
-                            repList = []
-                            if isinstance(repetition,dict):
-                                # If it is a dictionary then we keep parsing the sub-components
-                                for c in order(repetition,comRegEx):
-                                    if isinstance(msg[fields[0]][seg_dict[segName]][fields[i]][x][c],dict):
-                                        # Component contains sub-component
-                                        subList = []
-                                        for s in order(msg[fields[0]][seg_dict[segName]][fields[i]][x][c],subRegEx):
-                                            subList.append(msg[fields[0]][seg_dict[segName]][fields[i]][x][c][s])
-                                        repList.append(sub.join(subList))
-                                    else:
-                                        # Appending to field repetition list
-                                        repList.append(msg[fields[0]][seg_dict[segName]][fields[i]][x][c])
-                            else:
-                                # No sub-fields in repetition
-                                repList.append(msg[fields[0]][seg_dict[segName]][fields[i]][x])
-                            x += 1
-                            repList = com.join(repList)
-                            repetitions.append(repList)
-
-                        # Adding the repeating field string to the out message with the repetition character
-                        outMsg += fld + rep.join(repetitions)
+                    # Not peek, components and repetitions handed out can be
+                    # edited in place so they mark the segment as changed
+                    value = segDict[field]
+                except KeyError:
+                    continue
+                if self.component is None and value.__class__ is not list:
+                    # Plain field, the most common case
+                    if not self.repIndex or self.repIndex == path.ALL:
+                        found.append(value)
+                    continue
+                for item in _pick(value, self.repIndex):
+                    if self.component is not None:
+                        item = _subValue(item, self.component)
+                        if item is not None and self.subcomponent is not None:
+                            item = _subValue(item, self.subcomponent)
+                        if item is None:
+                            continue
+                    found.append(item)
+        if self.many:
+            return found
+        return found[0] if found else default
 
-                    else:
-                        # Non repeating field
-                        if isinstance(msg[fields[0]][seg_dict[segName]][fields[i]],dict):
-                            # Contains components
-                            comList = []
-                            for c in order(msg[fields[0]][seg_dict[segName]][fields[i]],comRegEx):
-                                if isinstance(msg[fields[0]][seg_dict[segName]][fields[i]][c],dict):
-                                    # Contains sub-components
-                                    subList = []
-                                    for s in order(msg[fields[0]][seg_dict[segName]][fields[i]][c],subRegEx):
-                                        subList.append(msg[fields[0]][seg_dict[segName]][fields[i]][c][s])
-                                    comList.append(sub.join(subList))
-                                else:
-                                    comList.append(msg[fields[0]][seg_dict[segName]][fields[i]][c])
-                            outMsg += fld + com.join(comList)
-                        else:
-                            # Field without components or sub-components
-                            outMsg += fld + str(msg[fields[0]][seg_dict[segName]][fields[i]])
-
-                    # Incrementing count
-                    i += 1
-                except Exception as e:
-                    i += 1
+    def set(self,msg,value):
+        """Sets the value, in every repetition if the path has [*]"""
+        if self.field is None:
+            raise ValueError('Path does not name a field: %s' % self.text)
+        segs = msg.get(self.seg)
+        if segs is None:
+            raise KeyError(self.seg)
+        segList = _pick(segs, self.segIndex)
+        if not segList:
+            raise IndexError('%s has no repetition %s' % (self.seg, self.segIndex))
+        grown = None
+        for n, segDict in enumerate(segList):
+            try:
+                current = segDict[self.field]
+            except KeyError:
+                # Past the end of the segment, its structure line grows too
+                current = ''
+                last = _fillFields(segDict, self.seg, self.field)
+                if grown is None:
+                    grown = {}
+                grown[(self.seg, n if self.segIndex == path.ALL else self.segIndex or 0)] = last
+            segDict[self.field] = self._setField(current, value)
+        if grown:
+            _growStructure(msg, grown)
+
+    def getMany(self,messages,default=None):
+        """Returns the value from each message, in order"""
+        get = self.get
+        return [get(msg,default) for msg in messages]
 
-            # Adding return character back on
-            outMsg += ret
+    def setMany(self,messages,value):
+        """Sets the same value in each message"""
+        for msg in messages:
+            self.set(msg,value)
 
+    def _setField(self,current,value):
+        # Returns the new field value with the repetition(s) changed
+        index = self.repIndex
+        if index is None or (index == 0 and not isinstance(current,list)):
+            return self._setItem(current, value)
+        reps = list(current) if isinstance(current,list) else [current]
+        if index == path.ALL:
+            indexes = range(len(reps))
         else:
-            # Non repeating segment
-            
-            # Adding segment name to beginning of string
-            outMsg += segName
+            while len(reps) <= index:
+                reps.append('')
+            indexes = (index,)
+        for i in indexes:
+            reps[i] = self._setItem(reps[i], value)
+        return reps
 
-            # field iterator
-            i = 1
-            while i < len(fields):
-                try:
-                    if isinstance(msg[fields[0]][fields[i]],list):
-                        # If field is a list/repeating field, we keep parsing
-                        repetitions = []
-                        x = 0
-                        for repetition in msg[fields[0]][fields[i]]:
-                            repList = []
-                            if isinstance(repetition,dict):
-                                # If it is a dictionary then we keep parsing the sub-components
-                                for c in order(repetition,comRegEx):
-                                    if isinstance(msg[fields[0]][fields[i]][x][c],dict):
-                                        # Component contains sub-component
-                                        subList = []
-                                        for s in order(msg[fields[0]][fields[i]][x][c],subRegEx):
-                                            subList.append(msg[fields[0]][fields[i]][x][c][s])
-                                        repList.append(sub.join(subList))
-                                    else:
-                                        # Appending to field repetition list
-                                        repList.append(msg[fields[0]][fields[i]][x][c])
-                            else:
-                                # No sub-fields in repetition
-                                repList.append(msg[fields[0]][fields[i]][x])
-                            x += 1
-                            repList = com.join(repList)
-                            repetitions.append(repList)
-
-                        # Adding the repeating field string to the out message with the repetition character
-                        outMsg += fld + rep.join(repetitions)
+    def _setItem(self,item,value):
+        # Returns a repetition with the component or sub-component changed
+        if self.component is None:
+            return value
+        components = item if isinstance(item,dict) else {self.field + '.1': item}
+        _fill(components, self.field, self.component)
+        if self.subcomponent is None:
+            components[self.component] = value
+        else:
+            subcomponents = components[self.component]
+            if not isinstance(subcomponents,dict):
+                subcomponents = {self.component + '.1': subcomponents}
+            _fill(subcomponents, self.component, self.subcomponent)
+            subcomponents[self.subcomponent] = value
+            components[self.component] = subcomponents
+        return components
 
-                    else:
-                        # Non repeating field
-                        if isinstance(msg[fields[0]][fields[i]],dict):
-                            # Contains components
-                            comList = []
-                            for c in order(msg[fields[0]][fields[i]],comRegEx):
-                                if isinstance(msg[fields[0]][fields[i]][c],dict):
-                                    # Contains sub-components
-                                    subList = []
-                                    for s in order(msg[fields[0]][fields[i]][c],subRegEx):
-                                        subList.append(msg[fields[0]][fields[i]][c][s])
-                                    comList.append(sub.join(subList))
-                                else:
-                                    comList.append(msg[fields[0]][fields[i]][c])
-                            outMsg += fld + com.join(comList)
-                        else:
-                            # Field without components or sub-components
-                            outMsg += fld + str(msg[fields[0]][fields[i]])
-
-                    # Incrementing count
-                    i += 1
-                except Exception as e:
-                    print(e)
-                    i += 1
+def _pick(value,index):
+    """Selects repetitions of a segment or field as a sequence"""
+    if value.__class__ is list:
+        if index == path.ALL:
+            return value
+        index = index or 0
+        return value[index:index+1]
+    if not index or index == path.ALL:
+        return (value,)
+    return ()
 
-            # Adding return character back on
-            outMsg += ret
+def _subValue(value,key):
+    """Reads a component or sub-component, a plain string is its first one"""
+    if isinstance(value,dict):
+        return value.get(key)
+    if key.endswith('.1'):
+        return value
+    return None
 
-    # Finished message
-    return outMsg
+def _fill(parts,prefix,key):
+    """Adds empty components or sub-components up to key, so positions hold"""
+    for n in range(1, _keyOrder(key)):
+        parts.setdefault(prefix + '.' + str(n), '')
+    parts.setdefault(key, '')
 
 #----------------------------------------------#
 # Utilities to use while working with HL7 data #
@@ -432,16 +1382,47 @@ def date(string,format):
 
 class table:
     """Class to create and manage table lookups using Python's pickle function"""
+
+    # Loaded tables shared by every instance, keyed by file path.  Each entry
+    # is [mtime, size, dictionary, reverse index, last checked]
+    cache = {}
+    checkInterval = 1.0     # Seconds between checks of the file for changes
+
     def __init__(self,name):
         # Initializing
         self.name = name
+        self.path = os.path.abspath(name)
+
+    def _table(self):
+        # Loaded dictionary entry, reloaded only when the file has changed
+        entry = table.cache.get(self.path)
+        now = time.monotonic()
+        if entry is not None and now - entry[4] < table.checkInterval:
+            return entry
+
+        stat = os.stat(self.path)
+        if entry is None or entry[0] != stat.st_mtime_ns or entry[1] != stat.st_size:
+            with open(self.path,'rb') as f:
+                dictionary = pickle.load(f)
+            entry = [stat.st_mtime_ns, stat.st_size, dictionary, None, now]
+            table.cache[self.path] = entry
+        else:
+            entry[4] = now
+        return entry
+
+    def _forget(self):
+        # Dropping the cached copy after the file is changed here
+        table.cache.pop(self.path, None)
 
     def create(self,dictionary = {}):
         # Creating pick file
-        pickle.dump(dictionary,open(self.name,'wb'))
+        with open(self.name,'wb') as f:
+            pickle.dump(dictionary,f)
+        self._forget()
 
     def delete(self):
         # Deleting pickle file
+        self._forget()
         try:
             remove(self.name)
             return True
@@ -450,25 +1431,962 @@ class table:
 
     def lookup(self,key,default):
         # Doing lookup of dictionary
-        dictionary = pickle.load(open(self.name,'rb'))
-        value = dictionary.get(key,None)
+        value = self._table()[2].get(key,None)
         if value:
             return value
         else:
             return default
 
+    def lookupMany(self,keys,default):
+        """Looks up a list of keys, returning a list of values"""
+        get = self._table()[2].get
+        values = []
+        for key in keys:
+            value = get(key,None)
+            values.append(value if value else default)
+        return values
+
     def reverseLookup(self,value,default):
-        # Doing reverse lookup, will only fine first match
-        dictionary = pickle.load(open(self.name,'rb'))
+        # Doing reverse lookup, will only find first match
+        entry = self._table()
+        if entry[3] is None:
+            # Building the value to key index once per load
+            reverse = {}
+            partial = False     # Some values can't be hashed and aren't indexed
+            for k,v in entry[2].items():
+                try:
+                    reverse.setdefault(v,k)
+                except TypeError:
+                    partial = True
+            entry[3] = (reverse, partial)
+
+        reverse, partial = entry[3]
+        try:
+            if value in reverse:
+                return reverse[value]
+        except TypeError:
+            return self._scan(entry[2],value,default)
+        if partial:
+            return self._scan(entry[2],value,default)
+        return default
+
+    def _scan(self,dictionary,value,default):
+        # Reverse lookup the slow way, for values that can't be indexed
         for k,v in dictionary.items():
             if v == value:
                 return k
         return default
 
     def read(self):
-        # Returning dictionary to user
-        dictionary = pickle.load(open(self.name,'rb'))
-        return dictionary
+        # Returning dictionary to user, a copy so the cache stays intact
+        return dict(self._table()[2])
+
+class indexedTable:
+    """Table lookups kept in an indexed SQLite file, rows are read on demand"""
+
+    checkInterval = 1.0     # Seconds between checks for a rebuilt file
+    chunkSize = 50000       # Rows written per batch
+
+    def __init__(self,name):
+        # Initializing, connections are opened per process and thread
+        self.name = name
+        self.path = os.path.abspath(name)
+        self.local = threading.local()
+        self.generation = 0     # Bumped by create, every thread then reconnects
+
+    def _reader(self):
+        # Read only connection, memory mapped so processes share the page cache
+        local = self.local
+        now = time.monotonic()
+        db = getattr(local,'db',None)
+        if db is not None and local.pid == os.getpid() and local.generation == self.generation:
+            if now - local.checked < indexedTable.checkInterval:
+                return db
+            local.checked = now
+            if os.stat(self.path).st_ino == local.ino:
+                return db
+            db.close()
+
+        ino = os.stat(self.path).st_ino
+        db = sqlite3.connect('file:' + quote(self.path) + '?mode=ro', uri=True)
+        db.execute('PRAGMA mmap_size=1073741824')
+        local.db, local.pid, local.ino, local.checked = db, os.getpid(), ino, now
+        local.generation = self.generation
+        return db
+
+    def _rows(self,dictionary):
+        # Key, value pairs from a dictionary or any iterable of pairs
+        if isinstance(dictionary,dict):
+            return iter(dictionary.items())
+        return iter(dictionary)
+
+    def _write(self,db,rows):
+        # Upsert in batches, a key that is already there keeps its position
+        rows = self._rows(rows)
+        while True:
+            chunk = list(islice(rows,indexedTable.chunkSize))
+            if not chunk:
+                break
+            db.executemany('INSERT INTO entries (key,value) VALUES (?,?) '
+                           'ON CONFLICT(key) DO UPDATE SET value=excluded.value', chunk)
+
+    def create(self,dictionary = {}):
+        # Bulk build into a temporary file, swapped in when complete.  The
+        # name is unique to this process and thread so builds don't collide
+        temp = '%s.%d.%d.tmp' % (self.path, os.getpid(), threading.get_ident())
+        if os.path.exists(temp):
+            remove(temp)
+        try:
+            db = sqlite3.connect(temp)
+            try:
+                db.execute('PRAGMA journal_mode=OFF')
+                db.execute('PRAGMA synchronous=OFF')
+                db.execute('CREATE TABLE entries (key PRIMARY KEY, value)')
+                with db:
+                    self._write(db,dictionary)
+                # Value index built once after loading, cheaper than maintaining it
+                db.execute('CREATE INDEX entries_value ON entries (value)')
+            finally:
+                db.close()
+            os.replace(temp,self.path)
+        except:
+            if os.path.exists(temp):
+                remove(temp)
+            raise
+
+        # Connections to the old file are not used again
+        self.generation += 1
+        db = getattr(self.local,'db',None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+
+    def update(self,dictionary):
+        # Adding or changing entries in place
+        db = sqlite3.connect(self.path)
+        try:
+            with db:
+                self._write(db,dictionary)
+        finally:
+            db.close()
+
+    def discard(self,keys):
+        # Removing entries in place
+        db = sqlite3.connect(self.path)
+        try:
+            with db:
+                db.executemany('DELETE FROM entries WHERE key=?', ((key,) for key in keys))
+        finally:
+            db.close()
+
+    def delete(self):
+        # Deleting table file
+        db = getattr(self.local,'db',None)
+        if db is not None:
+            db.close()
+            self.local.db = None
+        try:
+            remove(self.name)
+            return True
+        except:
+            return False
+
+    def lookup(self,key,default):
+        # Doing indexed lookup of key
+        row = self._reader().execute('SELECT value FROM entries WHERE key=?', (key,)).fetchone()
+        if row and row[0]:
+            return row[0]
+        else:
+            return default
+
+    def lookupMany(self,keys,default):
+        """Looks up a list of keys, returning a list of values"""
+        cursor = self._reader().cursor()
+        values = []
+        for key in keys:
+            row = cursor.execute('SELECT value FROM entries WHERE key=?', (key,)).fetchone()
+            values.append(row[0] if row and row[0] else default)
+        return values
+
+    def reverseLookup(self,value,default):
+        # Doing reverse lookup, will only find first match
+        row = self._reader().execute('SELECT key FROM entries WHERE value=? ORDER BY rowid LIMIT 1', (value,)).fetchone()
+        if row:
+            return row[0]
+        else:
+            return default
+
+    def read(self):
+        # Returning whole table to user as a dictionary
+        return dict(self._reader().execute('SELECT key, value FROM entries ORDER BY rowid'))
+
+    def __reduce__(self):
+        # Connections stay behind, worker processes open their own
+        return (indexedTable, (self.path,))
+
+#-------------------------------------------------------------------------------#
+# Compiled rewriting rules.  Set, copy, table mapping, date reformatting and    #
+# segment deletes are compiled once into split positions, like "extract".      #
+# Raw messages are only split at the segments the rules name and only changed  #
+# segments are joined again, parsed messages only load the fields named        #
+#-------------------------------------------------------------------------------#
+class mapping:
+    """Rule set compiled once and applied to any number of messages"""
+
+    checkInterval = 1.0     # Seconds before remembered table lookups are dropped
+
+    def __init__(self,rules=()):
+        self.ops = []           # Compiled rules, in order
+        self.segNames = set()   # Segments any rule reads or changes
+        self.memos = []         # Table lookups remembered per map rule
+        self.checked = time.monotonic()
+        for rule in rules:
+            if rule[0] not in ('set', 'copy', 'map', 'date', 'delete'):
+                raise ValueError('Unknown rule: %s' % (rule[0],))
+            getattr(self, rule[0])(*rule[1:])
+
+    def __repr__(self):
+        return 'mapping(%d rules)' % len(self.ops)
+
+    def __len__(self):
+        return len(self.ops)
+
+    def _plan(self,text,target=True):
+        # Split positions for a field path, as in "extract"
+        p = path(text)
+        if p.field is None:
+            raise ValueError('Path does not name a field: %s' % text)
+        n = _keyOrder(p.field)
+        if p.seg == 'MSH' and n <= 2 and target:
+            raise ValueError('Encoding characters can not be changed: %s' % text)
+        pos = n - 1 if p.seg == 'MSH' else n
+        com = _keyOrder(p.component) if p.component else 0
+        sub = _keyOrder(p.subcomponent) if p.subcomponent else 0
+        self.segNames.add(p.seg)
+        return (p.seg, p.segIndex, p.field, pos, p.repIndex, com, sub)
+
+    def set(self,target,value):
+        """Sets a field, component or sub-component to a fixed value"""
+        self.ops.append(('set', self._plan(target), str(value)))
+        return self
+
+    def copy(self,source,target):
+        """Copies the first value found at source into target"""
+        source = self._plan(source, False)
+        if path.ALL in (source[1], source[4]):
+            raise ValueError('Copy source must name one value: %s' % source[2])
+        self.ops.append(('copy', self._plan(target), source))
+        return self
+
+    def map(self,target,lookup,default=None):
+        """Replaces a value through a table, indexedTable or dictionary, None keeps unmatched values"""
+        memo = {}
+        self.memos.append(memo)
+        self.ops.append(('map', self._plan(target), (lookup, default, memo)))
+        return self
+
+    def date(self,target,inFormat,outFormat=None):
+        """Reformats a date, inFormat may be a tuple of formats tried in order"""
+        if isinstance(inFormat,str):
+            inFormat = (inFormat,)
+        self.ops.append(('date', self._plan(target), (tuple(inFormat), outFormat or inFormat[0])))
+        return self
+
+    def delete(self,target):
+        """Deletes segments, every one of the name unless an index is given, or clears a field"""
+        p = path(target)
+        if p.field is not None:
+            return self.set(target, '')
+        self.segNames.add(p.seg)
+        index = path.ALL if p.segIndex is None else p.segIndex
+        self.ops.append(('delete', (p.seg, index), None))
+        return self
+
+    def _fresh(self):
+        # Remembered lookups are dropped now and then so table changes show
+        now = time.monotonic()
+        if now - self.checked >= mapping.checkInterval:
+            for memo in self.memos:
+                memo.clear()
+            self.checked = now
+
+    def _value(self,kind,arg,old):
+        # New value for one map or date rule, None leaves the value alone
+        if kind == 'map':
+            lookup, default, memo = arg
+            if old in memo:
+                return memo[old]
+            if isinstance(lookup,dict):
+                new = lookup.get(old, default)
+            else:
+                new = lookup.lookup(old, default)
+            if len(memo) < 100000:
+                memo[old] = new
+            return new
+        if old == '':
+            return None
+        if old.lower() == 'now':
+            # Never cached, the time moves on
+            return date('now', arg[1])
+        return _reformat(old, arg[0], arg[1])
+
+    def __call__(self,msg):
+        """Rewrites raw text into a new string, parsed messages are changed in place"""
+        self._fresh()
+        if isinstance(msg,(str,bytes,bytearray,memoryview)):
+            return self._rewrite(msg)
+        return self._apply(msg)
+
+    def _rewrite(self,raw):
+        # Raw text, only the segments named by the rules are split
+        if not isinstance(raw,str):
+            raw = _decode(raw)
+        if '\n' in raw:
+            raw = raw.replace('\n','\r')
+        fld = raw[3:4]
+        chars = (raw[4:5], raw[5:6], raw[7:8])
+        lines = raw.split('\r')
+        segNames = self.segNames
+        index = {}      # Segment name to line numbers
+        for i, line in enumerate(lines):
+            if line[0:3] in segNames and line[3:4] == fld:
+                index.setdefault(line[0:3], []).append(i)
+        split = {}      # Line number to split fields, once touched
+        deleted = False
+
+        for kind, plan, arg in self.ops:
+            if kind == 'delete':
+                found = index.get(plan[0])
+                if found:
+                    for i in _pick(found, plan[1]):
+                        lines[i] = None
+                    index[plan[0]] = [i for i in found if lines[i] is not None]
+                    deleted = True
+                continue
+            seg, segIndex, key, pos, repIndex, com, sub = plan
+            found = index.get(seg)
+            if not found:
+                continue
+            value = arg
+            if kind == 'copy':
+                value = self._read(lines, split, index, fld, chars, arg)
+                if value is None:
+                    continue
+            for i in _pick(found, segIndex):
+                fields = split.get(i)
+                if fields is None:
+                    fields = split[i] = lines[i].split(fld)
+                old = fields[pos] if pos < len(fields) else ''
+                new = self._edit(old, kind, arg, value, repIndex, com, sub, chars)
+                if new != old:
+                    while len(fields) <= pos:
+                        fields.append('')
+                    fields[pos] = new
+
+        for i, fields in split.items():
+            if lines[i] is not None:
+                lines[i] = fld.join(fields)
+        if deleted:
+            lines = [line for line in lines if line is not None]
+        return '\r'.join(lines)
+
+    def _read(self,lines,split,index,fld,chars,plan):
+        # Current value of a copy source in raw text, None if it isn't there
+        seg, segIndex, key, pos, repIndex, com, sub = plan
+        found = _pick(index.get(seg) or [], segIndex)
+        if not found:
+            return None
+        i = found[0]
+        fields = split.get(i)
+        if fields is None:
+            fields = split[i] = lines[i].split(fld)
+        if seg == 'MSH' and pos <= 1:
+            # MSH.1 and MSH.2 are the delimiters and are never split
+            return fld if pos == 0 else fields[1]
+        if pos >= len(fields):
+            return None
+        return _readValue(fields[pos], repIndex, com, sub, chars)
+
+    def _edit(self,text,kind,arg,value,repIndex,com,sub,chars):
+        # Field text with the rule applied at the repetition and component named
+        if repIndex is None and not com:
+            new = value if kind in ('set', 'copy') else self._value(kind, arg, text)
+            return text if new is None else new
+        comChar, repChar, subChar = chars
+        reps = text.split(repChar)
+        if repIndex == path.ALL:
+            indexes = range(len(reps))
+        else:
+            indexes = (repIndex or 0,)
+        changed = False
+        for r in indexes:
+            item = reps[r] if r < len(reps) else ''
+            parts = item.split(comChar) if com else [item]
+            c = (com or 1) - 1
+            part = parts[c] if c < len(parts) else ''
+            subs = part.split(subChar) if sub else [part]
+            s = (sub or 1) - 1
+            old = subs[s] if s < len(subs) else ''
+            new = value if kind in ('set', 'copy') else self._value(kind, arg, old)
+            if new is None or new == old:
+                continue
+            _extend(subs, s)[s] = new
+            _extend(parts, c)[c] = subChar.join(subs)
+            _extend(reps, r)[r] = comChar.join(parts)
+            changed = True
+        return repChar.join(reps) if changed else text
+
+    def _apply(self,msg):
+        # Parsed, lazy or compact message, only the fields named are loaded
+        MSH = msg['MSH']
+        fld = _peekField(MSH, 'MSH.1')
+        enc = _peekField(MSH, 'MSH.2')
+        chars = (enc[0:1], enc[1:2], enc[3:4])
+        comChar, repChar, subChar = chars
+        grown = None    # (segment, repetition) to its last field, for new fields
+
+        for kind, plan, arg in self.ops:
+            if kind == 'delete':
+                _dropSegment(msg, plan[0], plan[1])
+                continue
+            seg, segIndex, key, pos, repIndex, com, sub = plan
+            segs = msg.get(seg)
+            if segs is None:
+                continue
+            value = arg
+            if kind == 'copy':
+                value = self._get(msg, fld, enc, chars, arg)
+                if value is None:
+                    continue
+            for n, segDict in enumerate(segs if segs.__class__ is list else (segs,)):
+                if segIndex != path.ALL and n != (segIndex or 0):
+                    continue
+                missing = False
+                try:
+                    old = _fieldString(_peekField(segDict, key), comChar, repChar, subChar)
+                except KeyError:
+                    old = ''
+                    missing = True
+                new = self._edit(old, kind, arg, value, repIndex, com, sub, chars)
+                if new != old:
+                    segDict[key] = _parseField(key, new, comChar, repChar, subChar)
+                    if missing:
+                        last = _fillFields(segDict, seg, key)
+                        if grown is None:
+                            grown = {}
+                        grown[(seg, n)] = max(last, grown.get((seg, n), 0))
+        if grown:
+            _growStructure(msg, grown)
+        return msg
+
+    def _get(self,msg,fld,enc,chars,plan):
+        # Current value of a copy source in a parsed message
+        seg, segIndex, key, pos, repIndex, com, sub = plan
+        segs = msg.get(seg)
+        found = _pick(segs, segIndex) if segs is not None else ()
+        if not found:
+            return None
+        if seg == 'MSH' and pos <= 1:
+            return fld if pos == 0 else enc
+        try:
+            text = _fieldString(_peekField(found[0], key), *chars)
+        except KeyError:
+            return None
+        return _readValue(text, repIndex, com, sub, chars)
+
+    def run(self,source,workers=1,chunksize=1000):
+        """Rewrites a stream of messages or an hl7.file, yielding results in order"""
+        if isinstance(source,file):
+            source = source.iterMessages(binary=True)
+        messages = iter(source)
+        if workers is None:
+            workers = os.cpu_count() or 1
+
+        if workers <= 1:
+            for msg in messages:
+                yield self(msg)
+            return
+
+        # Rules, and any dictionary they map through, are sent once per worker
+        for chunk in _poolChunks(_mappingChunk, messages, chunksize, workers, initializer=_mappingWorker, initargs=(self,)):
+            for msg in chunk:
+                yield msg
+
+_worker = None      # Rules for the worker processes of "mapping.run"
+
+def _mappingWorker(rules):
+    """Worker process start-up, keeps the rule set for every chunk"""
+    global _worker
+    _worker = rules
+
+def _mappingChunk(chunk):
+    """Worker side of "mapping.run", rewrites one chunk of messages"""
+    return [_worker(msg) for msg in chunk]
+
+def _readValue(text,repIndex,com,sub,chars):
+    """Reads the first value a split position names from field text"""
+    comChar, repChar, subChar = chars
+    item = text.split(repChar)
+    r = repIndex or 0
+    if r >= len(item):
+        return None
+    item = item[r]
+    if com:
+        parts = item.split(comChar)
+        if com > len(parts):
+            return None
+        item = parts[com-1]
+        if sub:
+            parts = item.split(subChar)
+            if sub > len(parts):
+                return None
+            item = parts[sub-1]
+    return item
+
+def _extend(parts,index):
+    """Pads a split list with empty strings so index can be set"""
+    while len(parts) <= index:
+        parts.append('')
+    return parts
+
+@lru_cache(maxsize=4096)
+def _reformat(value,inFormats,outFormat):
+    """Reformats a date string, None if it matches none of the formats"""
+    for inFormat in inFormats:
+        try:
+            return datetime.datetime.strptime(value, inFormat).strftime(outFormat)
+        except ValueError:
+            continue
+    return None
+
+def _fillFields(segDict,seg,key):
+    """Leaves the fields between a segment's end and a new field empty, returns its number"""
+    last = _keyOrder(key)
+    for k in range(2 if seg == 'MSH' else 1, last):
+        if seg + '.' + str(k) not in segDict:
+            segDict[seg + '.' + str(k)] = ''
+    return last
+
+def _growStructure(msg,grown):
+    """Extends the structure lines of segments given fields past their end"""
+    lines = msg['structure'].split('\r')
+    seen = {}
+    for i, line in enumerate(lines):
+        seg = line[0:3]
+        n = seen[seg] = seen.get(seg, -1) + 1
+        last = grown.get((seg, n))
+        if last is not None and last > _keyOrder(line.rsplit('|', 1)[-1]):
+            first = 2 if seg == 'MSH' else 1
+            lines[i] = _structureLine(seg, first, last - first + 1)[:-1]
+    msg['structure'] = '\r'.join(lines)
+
+def _dropSegment(msg,seg,index):
+    """Removes one or every segment of a name from a parsed message"""
+    segs = msg.get(seg)
+    if segs is None:
+        return
+    if segs.__class__ is not list:
+        segs = [segs]
+    if index == path.ALL or (index == 0 and len(segs) == 1):
+        del msg[seg]
+        if isinstance(msg,dict) and seg in msg['segments']:
+            msg['segments'].remove(seg)
+        return
+    if index >= len(segs):
+        return
+    # The structure line of the segment goes too, so the rest stay in step
+    lines = msg['structure'].split('\r')
+    n = -1
+    for i, line in enumerate(lines):
+        if line[0:4] == seg + '|':
+            n += 1
+            if n == index:
+                del lines[i]
+                break
+    segs = segs[:index] + segs[index+1:]
+    msg[seg] = segs[0] if len(segs) == 1 else segs
+    msg['structure'] = '\r'.join(lines)
+
+#-------------------------------------------------------------------------------#
+# ACK builder and MLLP helpers shared by the listeners.  Only the MSH segment   #
+# of the received message is located and split, so building an ACK costs the   #
+# same whatever the size of the message                                         #
+#-------------------------------------------------------------------------------#
+# Acknowledgment codes for MSA-1
+ackCodes = ('AA', 'AE', 'AR', 'CA', 'CE', 'CR')
+
+# HL7 table 0357 error codes for ERR-3
+errorCodes = {
+    '0': 'Message accepted',
+    '100': 'Segment sequence error',
+    '101': 'Required field missing',
+    '102': 'Data type error',
+    '103': 'Table value not found',
+    '200': 'Unsupported message type',
+    '201': 'Unsupported event code',
+    '202': 'Unsupported processing id',
+    '203': 'Unsupported version id',
+    '204': 'Unknown key identifier',
+    '205': 'Duplicate key identifier',
+    '206': 'Application record locked',
+    '207': 'Application internal error',
+}
+
+def makeAck(raw,status='AA',error='',errCode=None):
+    """Creates AA, AE, AR, CA, CE or CR ACK message string for a received message"""
+    return _makeAck(raw,status,error,errCode)[0]
+
+def _header(raw):
+    """MSH segment of a received message, the return character after it and its codec"""
+    if isinstance(raw,str):
+        start = raw.find('MSH')
+        end = _segmentEnd(raw, start, '\r', '\n')
+        msh = raw[start:end]
+        return msh, raw[end:end+1] or '\r', _charset(msh.encode('utf-8'))
+
+    start = raw.find(b'MSH')
+    if start == -1:
+        # UTF-16 and UTF-32 have no MSH in their bytes, decoded whole
+        raw = _unframe(raw)
+        msh, ret, encoding = _header(_decode(raw))
+        return msh, ret, _charset(raw)
+    end = _segmentEnd(raw, start, b'\r', b'\n')
+    msh = bytes(raw[start:end])
+    encoding = _charset(msh)
+    ret = '\n' if raw[end:end+1] == b'\n' else '\r'
+    return msh.decode(encoding, 'replace'), ret, encoding
+
+def _makeAck(raw,status,error,errCode):
+    """Builds the ACK string and the codec of the message it answers"""
+    if isinstance(raw,dict):
+        raw = raw['raw']
+    elif isinstance(raw,message):
+        raw = raw.raw
+
+    # Locating the MSH segment, nothing after it is looked at
+    msh, ret, encoding = _header(raw)
+
+    # Get the field separator from MSH-1
+    fld = msh[3:4]
+    com = msh[4:5]
+
+    # Only MSH-1 to MSH-12 are carried over
+    fields = msh.split(fld, 12)[:12]
+    if len(fields) < 12:
+        fields += [''] * (12 - len(fields))
+
+    # Sender and receiver swap, MSH-3/4 with MSH-5/6
+    fields[2], fields[4] = fields[4], fields[2]
+    fields[3], fields[5] = fields[5], fields[3]
+
+    # MSH-9 becomes ACK^<event>^ACK
+    msgType = fields[8].split(com)
+    msgType[0] = 'ACK'
+    if len(msgType) > 2:
+        msgType[2] = 'ACK'
+    fields[8] = com.join(msgType)
+
+    # MSA|AA or AE or AR|MSH-10 value|text
+    ACK = fld.join(fields) + ret + "MSA" + fld + status + fld + fields[9] + fld + str(error) + ret
+
+    if errCode is not None:
+        # ERR-3 error code, ERR-4 severity and ERR-8 user message
+        errCode = str(errCode)
+        severity = 'I' if errCode == '0' else 'E'
+        code = com.join((errCode, errorCodes.get(errCode, ''), 'HL70357'))
+        ACK += fld.join(('ERR', '', '', code, severity, '', '', '', str(error))) + ret
+
+    return ACK, encoding
+
+def ackBytes(raw,status='AA',error='',errCode=None):
+    """Creates the ACK message as MLLP framed bytes, ready for a single send"""
+    return _frame(*_makeAck(raw,status,error,errCode))
+
+def _frame(message,encoding='utf-8'):
+    """Wraps a message string in the MLLP container as bytes"""
+    return b'\x0b' + message.encode(encoding, 'replace') + b'\x1c\r'
+
+#-------------------------------------------------------------------------------#
+# Incremental MLLP decoder.  Bytes are fed in as they arrive from a socket and  #
+# complete frames come out, however the sender's writes were split or merged.   #
+# A partial frame waits in one bytearray and only new bytes are searched, so a  #
+# large message is never rejoined or copied more than once                      #
+#-------------------------------------------------------------------------------#
+class mllp:
+    """Buffered MLLP stream decoder, feed bytes in and get complete frames out"""
+    def __init__(self,maxSize=16777216):
+        self.buffer = bytearray()
+        self.start = -1         # Offset of the current frame's content, -1 between frames
+        self.scanned = 0        # Offset already searched for the end block
+        self.maxSize = maxSize  # Frames larger than this are dropped
+        self.dropped = 0        # Number of frames dropped for size
+
+    def feed(self,data):
+        """Adds received bytes, returns list of complete frames as bytes"""
+        buf = self.buffer
+        buf += data
+        frames = []
+        pos = 0
+        with memoryview(buf) as view:
+            while True:
+                if self.start < 0:
+                    # Bytes between frames (the trailing <CR>) are skipped
+                    sb = buf.find(b'\x0b', pos)
+                    if sb == -1:
+                        pos = len(buf)
+                        break
+                    self.start = self.scanned = sb + 1
+
+                eb = buf.find(b'\x1c', self.scanned)
+                if eb == -1:
+                    self.scanned = len(buf)
+                    if self.scanned - self.start > self.maxSize:
+                        # Giving up on a frame that will never fit
+                        self.dropped += 1
+                        self.start = -1
+                        pos = len(buf)
+                    else:
+                        pos = self.start
+                    break
+
+                if eb - self.start <= self.maxSize:
+                    frames.append(view[self.start:eb].tobytes())
+                else:
+                    self.dropped += 1
+                self.start = -1
+                pos = eb + 1
+
+        # Dropping everything already handed out
+        if pos:
+            del buf[:pos]
+            if self.start >= 0:
+                self.start -= pos
+                self.scanned -= pos
+        return frames
+
+    def reset(self):
+        """Discards any partial frame, used when a connection is replaced"""
+        self.buffer = bytearray()
+        self.start = -1
+        self.scanned = 0
+
+class _destination:
+    """Connections to one destination of a tcp.pool"""
+    def __init__(self,host,port,size):
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = LifoQueue()     # (client, idle since), most recent first
+        self.created = 0            # Connections open or being opened
+        self.failures = 0           # Failures in a row, drives the backoff
+        self.retryAt = 0            # No new connection before this time
+        self.lock = threading.Lock()
+
+# Control ids kept after their message completes, so late ACKs are recognised
+_finishedIds = 1000
+
+class _inflight:
+    """A message sent in windowed mode that is waiting on its ACK"""
+    __slots__ = ('msgId', 'data', 'future', 'sent', 'deadline', 'attempts', 'done', 'ack', 'error')
+
+    def __init__(self,msgId,data):
+        self.msgId = msgId      # MSH-10, matched against MSA-2
+        self.data = data        # MLLP framed bytes, kept for resending
+        self.future = Future()
+        self.sent = 0
+        self.deadline = 0
+        self.attempts = 0
+        self.done = False
+        self.ack = None
+        self.error = None
+
+#-------------------------------------------------------------------------------#
+# Metrics for the listeners and senders.  Nothing is counted until a metrics    #
+# object is handed to "instrument", until then the only cost on the hot path    #
+# is a check for None                                                           #
+#-------------------------------------------------------------------------------#
+class metrics:
+    """Counters, gauges, latency histograms and hooks kept in this process"""
+
+    # Histogram bucket upper bounds, in seconds
+    buckets = (.0001, .00025, .0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+    # Events hooks can be added for
+    events = ('receive', 'frame', 'parse', 'handler', 'ackSent', 'send', 'ackReceived', 'reconnect')
+
+    def __init__(self,prefix='hl7'):
+        # Initializing
+        self.prefix = prefix        # Prepended to names in "text"
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}        # Name -> [bucket counts, sum, count]
+        self.hooks = {}             # Event -> callbacks
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.httpd = None
+
+    def count(self,name,n=1):
+        """Adds n to a counter"""
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self,name,value):
+        """Sets a gauge to the current value"""
+        self.gauges[name] = value
+
+    def adjust(self,name,n):
+        """Moves a gauge up or down by n"""
+        with self.lock:
+            self.gauges[name] = self.gauges.get(name, 0) + n
+
+    def observe(self,name,seconds):
+        """Records a latency in a histogram"""
+        i = bisect_left(metrics.buckets, seconds)
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [[0] * (len(metrics.buckets) + 1), 0.0, 0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def hook(self,event,callback):
+        """Calls callback on every event, see "metrics.events" """
+        if event not in metrics.events:
+            raise ValueError('Unknown event: %s' % event)
+        self.hooks.setdefault(event, []).append(callback)
+
+    def emit(self,event,*args):
+        """Runs the hooks for an event, a failing hook never stops the caller"""
+        callbacks = self.hooks.get(event)
+        if not callbacks:
+            return
+        for callback in callbacks:
+            try:
+                callback(*args)
+            except Exception:
+                self.count('hook_errors')
+
+    def timed(self,name):
+        """Context manager timing a block into name_seconds, e.g. timed('parse')"""
+        return _timer(self, name)
+
+    def wrap(self,fn,name):
+        """Returns fn timed into name_seconds on every call"""
+        def timed(*args,**kwargs):
+            with _timer(self, name):
+                return fn(*args,**kwargs)
+        return timed
+
+    def snapshot(self):
+        """Returns a copy of every counter, gauge and histogram"""
+        with self.lock:
+            snapshot = {'uptime': time.time() - self.started,
+                        'counters': dict(self.counters),
+                        'gauges': dict(self.gauges),
+                        'histograms': {}}
+            histograms = [(name, list(h[0]), h[1], h[2]) for name, h in self.histograms.items()]
+        for name, counts, total, n in histograms:
+            snapshot['histograms'][name] = {
+                'count': n,
+                'sum': total,
+                'mean': total / n if n else 0,
+                # Bucket upper bounds, so percentiles are at most this long
+                'p50': _bucketPercentile(counts, n, .50),
+                'p90': _bucketPercentile(counts, n, .90),
+                'p99': _bucketPercentile(counts, n, .99),
+                'buckets': dict(zip(metrics.buckets + (float('inf'),), counts)),
+            }
+        return snapshot
+
+    def text(self):
+        """Returns the metrics in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        prefix = self.prefix + '_' if self.prefix else ''
+        lines = []
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s%s_total counter' % (prefix, name))
+            lines.append('%s%s_total %s' % (prefix, name, value))
+        for name, value in sorted(snapshot['gauges'].items()):
+            lines.append('# TYPE %s%s gauge' % (prefix, name))
+            lines.append('%s%s %s' % (prefix, name, value))
+        for name, histogram in sorted(snapshot['histograms'].items()):
+            lines.append('# TYPE %s%s histogram' % (prefix, name))
+            cumulative = 0
+            for bound, n in histogram['buckets'].items():
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                lines.append('%s%s_bucket{le="%s"} %d' % (prefix, name, le, cumulative))
+            lines.append('%s%s_sum %s' % (prefix, name, histogram['sum']))
+            lines.append('%s%s_count %d' % (prefix, name, histogram['count']))
+        return '\n'.join(lines) + '\n'
+
+    def serve(self,port,host=''):
+        """Serves "text" over HTTP on a background thread, for scrapers"""
+        collector = self
+
+        class handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = collector.text().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self,*args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return True
+
+    def stop(self):
+        """Stops the HTTP endpoint"""
+        if self.httpd is None:
+            return False
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.httpd = None
+        return True
+
+    def reset(self):
+        """Clears every counter, gauge and histogram, hooks are kept"""
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.histograms = {}
+            self.started = time.time()
+
+class _timer:
+    """Times a block into a metrics histogram and emits the matching event"""
+    __slots__ = ('metrics', 'name', 'start')
+
+    def __init__(self,collector,name):
+        self.metrics = collector
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        elapsed = time.perf_counter() - self.start
+        self.metrics.observe(self.name + '_seconds', elapsed)
+        self.metrics.emit(self.name, elapsed)
+        return False
+
+def _bucketPercentile(counts,n,p):
+    """Upper bound of the histogram bucket holding the p-th percentile"""
+    if not n:
+        return 0
+    target = n * p
+    seen = 0
+    for bound, count in zip(metrics.buckets + (float('inf'),), counts):
+        seen += count
+        if seen >= target:
+            return bound
+    return float('inf')
 
 #-------------------------------------------------------------------------------#
 # Class for inbound TCP functions                                               #
@@ -480,8 +2398,13 @@ class tcp:
         """Class receives data on a listener port on the local machine"""
         def __init__(self,port):
             # Initializes connection object
-            self.largeMsg = []   # A variable to hold large messages
+            self.decoder = mllp()   # Holds partial messages between reads
             self.ackFlag = True
+            self.ackAfter = False   # ACK once the dispatch handler has finished
+            self.bytesFlag = False
+            self.pool = None        # Worker pool used by "dispatch"
+            self.metrics = None     # Set by "instrument"
+            self.sendLock = threading.Lock()
             self.port = port
             # Connection variables populated when connection is established
             self.conn = None
@@ -502,41 +2425,73 @@ class tcp:
             self.ib = ib
 
             def startListener():
+                conn = None
                 while True:
                     # Connecting to client
                     if self.halt:
                         # They are stopping the connection
                         break
-                    addr = False
+
+                    # Waiting on a new connection or data on the open one,
+                    # waking up now and then to see if we've been stopped
+                    waiting = [ib] if conn is None else [ib, conn]
                     try:
-                        conn, addr = ib.accept()
-                    except socket.timeout:
-                        pass
-                    if addr:
+                        ready = select.select(waiting, [], [], .1)[0]
+                    except (OSError, ValueError):
+                        # Socket closed under us
+                        conn = None
+                        continue
+
+                    # Whatever is waiting on the open connection, or its
+                    # close, is read before a new connection takes its place
+                    if ib in ready and conn not in ready:
+                        try:
+                            conn, addr = ib.accept()
+                        except OSError:
+                            continue
                         # This is the remote IP and port
                         self.address = addr
                         self.conn = conn
+                        self.decoder.reset()
+                        if self.metrics is not None:
+                            self.metrics.count('connections')
+                        continue
+
+                    if conn not in ready:
+                        continue
                     try:
                         data = conn.recv(65536)
                     except:
                         continue
-                    if data:    
-                        if b'\x1c' not in data:
-                            # Waiting on the end of the message in case its a long message
-                            self.largeMsg.append(data)        # Converting from byte to string
-                            continue                            # Keep listening for rest of message
-                        if self.largeMsg:
-                            self.largeMsg.append(data)      # Add the last section
-                            data = b''.join(self.largeMsg)
-                            self.largeMsg = []
-
-                        # Stripping Vertical Tab and File Separators
-                        data = data.replace(b'\x0b', b'') # Vertical Tab
-                        data = data.replace(b'\x1c', b'') # File Separator
-                        data = data.decode('utf-8')       # Converting from byte to string
-
-                        # ACK or NACK back
-                        if self.ackFlag:
+                    if not data:
+                        # Remote side closed the connection
+                        try:
+                            conn.close()
+                        except OSError:
+                            pass
+                        if self.conn is conn:
+                            self.conn = None
+                        conn = None
+                        continue
+
+                    m = self.metrics
+                    if m is not None:
+                        m.count('bytes_received', len(data))
+                        m.emit('receive', data)
+
+                    # Every complete message in what was received, partial
+                    # messages wait in the decoder for the next read
+                    for data in self.decoder.feed(data):
+                        if m is not None:
+                            m.count('messages_received')
+                            m.emit('frame', data)
+
+                        if not self.bytesFlag:
+                            # Converting from byte to string using MSH-18
+                            data = data.decode(_charset(data), 'replace')
+
+                        # ACK or NACK back, unless workers ACK when done
+                        if self.ackFlag and not self.ackAfter:
                             ACK = self.ack(data,'AA')
 
                         # This should be the received HL7 message
@@ -544,56 +2499,83 @@ class tcp:
 
             self.generator = startListener()
 
-        def ack(self,raw,status,error=''):
+        def ack(self,raw,status,error='',conn=None,errCode=None):
             """Creates AA,AE or AR ACK message and returns it to sender"""
-            # First we parse the message
-            ACK = ""
-                
-            # Get the field separator from MSH-1
-            fld = raw[3:4]
-            com = raw[4:5]
-
-            # Finding the newline or return character
-            if "\n" in raw:
-                ret = "\n"
-            else:
-                ret = "\r"
-
-            # Splitting segments
-            segments = raw.split(ret)
-            # Splitting MSH fields
-            fields = segments[0].split(fld)
-            i = 0
-            MSH = ""
-            while i < 12:
-                if i == 8:
-                    # Changing MSH-9-1
-                    coms = fields[i].split(com)
-                    coms[0] = 'ACK'
-                    fields[i] = com.join(coms) 
-                MSH += fields[i] + fld
-                i += 1
-            MSH = MSH[0:len(MSH) - 1]# Trimming last field character
-            # Combining MSH segment with MSA segment
-            # MSA|AA or AE or AR|MSH-10 value
-            ACK = MSH + ret + "MSA" + fld + status + fld + fields[9] + fld + str(error) + ret
-                
-            # Wraps message and sends outbound
-            SB = '\x0b'  # <SB>, vertical tab
-            EB = '\x1c'  # <EB>, file separator
-            CR = '\x0d'  # <CR>, \r
-            FF = '\x0c'  # <FF>, new page form feed
-                
-            # wrap in MLLP message container
-            data = SB + ACK + EB + CR
-            data = bytes(data, "utf-8")
+            ACK, encoding = _makeAck(raw,status,error,errCode)
+
+            # Sending ACK back on same connection, wrapped in MLLP.  Workers
+            # pass the connection the message arrived on
+            if conn is None:
+                conn = self.conn
+            if conn is None:
+                raise ConnectionError('No open connection to send the ACK on')
+            with self.sendLock:
+                conn.sendall(_frame(ACK, encoding))
 
-            # Sending ACK back on same connection
-            self.conn.send(data)
+            if self.metrics is not None:
+                self.metrics.count('acks_sent_' + status)
+                self.metrics.emit('ackSent', ACK)
 
             # Returning ACK to use if they do it directly
             return ACK
 
+        def dispatch(self,handler,workers=4,queueSize=100,processes=False,ackAfter=False):
+            """Hands received messages to a pool of workers through a bounded queue"""
+            # Processes need a handler that can be pickled (a module function)
+            if processes:
+                self.pool = ProcessPoolExecutor(workers)
+            else:
+                self.pool = ThreadPoolExecutor(workers)
+            self.ackAfter = ackAfter
+            slots = threading.BoundedSemaphore(queueSize)
+
+            m = self.metrics
+            if m is not None and not processes:
+                # Handler time on its own, dispatch_seconds adds the queue wait
+                handler = m.wrap(handler, 'handler')
+
+            def finished(future,data,conn,start):
+                # Worker is done with a message, making room for the next one
+                slots.release()
+                if m is not None:
+                    m.adjust('queue_depth', -1)
+                    m.observe('dispatch_seconds', time.perf_counter() - start)
+                    if future.exception() is not None:
+                        m.count('handler_errors')
+                if not self.ackAfter or not self.ackFlag:
+                    return
+                try:
+                    # Handlers may return the ACK code to send
+                    result = future.result()
+                    status = result if result in ackCodes else 'AA'
+                    error = ''
+                except Exception as e:
+                    status = 'AE'
+                    error = e
+                try:
+                    self.ack(data,status,error,conn)
+                except:
+                    pass
+
+            def reader():
+                for data in self.generator:
+                    # With the queue full the socket isn't read, so TCP flow
+                    # control holds the sender back instead of memory growing
+                    while not slots.acquire(timeout=.1):
+                        if self.halt:
+                            return
+                    conn = self.conn
+                    start = 0
+                    if m is not None:
+                        m.adjust('queue_depth', 1)
+                        start = time.perf_counter()
+                    future = self.pool.submit(handler, data)
+                    future.add_done_callback(lambda f, data=data, conn=conn, start=start: finished(f, data, conn, start))
+
+            self.reader = threading.Thread(target=reader, daemon=True)
+            self.reader.start()
+            return True
+
         def stop(self):
             # Stops the listener
             self.halt = True
@@ -603,6 +2585,17 @@ class tcp:
             except:
                 status = False
 
+            # Waking up a read blocked on the open connection
+            if self.conn is not None:
+                try:
+                    self.conn.shutdown(socket.SHUT_RDWR)
+                    self.conn.close()
+                except:
+                    pass
+
+            if self.pool is not None:
+                self.pool.shutdown(wait=False)
+
             return status
 
         def getMsg(self):
@@ -620,6 +2613,20 @@ class tcp:
             else:
                 self.ackFlag = True
 
+        def rawBytes(self,boolian):
+            """Setting true returns messages as undecoded bytes for "parse".  Default is False"""
+            if not boolian:
+                self.bytesFlag = False
+            else:
+                self.bytesFlag = True
+
+        def instrument(self,collector=None):
+            """Turns on counters, histograms and hooks, returns the metrics object"""
+            if collector is None:
+                collector = metrics()
+            self.metrics = collector
+            return collector
+
     class client():
         """Class connects to remote client and sends data"""
         def __init__(self,host,port):
@@ -630,6 +2637,10 @@ class tcp:
             self.timeout = 5
             self.host = host
             self.port = port
+            self.decoder = mllp()   # Reassembles ACKs split over several reads
+            self.acks = deque()     # ACKs received but not yet returned
+            self.pipelined = False  # Windowed sending, see "pipeline"
+            self.metrics = None     # Set by "instrument"
             
             # Initializes and creates socket
             cnxn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -658,6 +2669,11 @@ class tcp:
                 self.cnxn.close()
             except:
                 pass
+            if self.metrics is not None:
+                self.metrics.count('reconnects')
+                self.metrics.emit('reconnect', self.host, self.port)
+            self.decoder.reset()
+            self.acks.clear()
             try:
                 self.cnxn = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
                 self.cnxn.settimeout(self.timeout)
@@ -669,6 +2685,7 @@ class tcp:
 
         def stop(self):
             """Stops the connection"""
+            self.pipelined = False
             try:
                 self.cnxn.close()
                 status = True
@@ -685,36 +2702,271 @@ class tcp:
             CR = '\x0d'  # <CR>, \r
             FF = '\x0c'  # <FF>, new page form feed
             
+            if self.pipelined:
+                # Windowed mode, the reader thread owns the socket's input
+                try:
+                    return self.sendAsync(message).result()
+                except Exception as e:
+                    return False
+
             # Wrap in MLLP message container and converts to bytes
             MLLP = SB + message + EB + CR
             msg = bytes(MLLP, "utf-8")
             
             # Sending message
+            m = self.metrics
             try:
-                self.cnxn.send(msg)
+                self.cnxn.sendall(msg)
             except Exception as e:
                 self.status = False
+                if m is not None:
+                    m.count('send_errors')
                 return False
 
+            if m is not None:
+                sent = time.perf_counter()
+                m.count('messages_sent')
+                m.count('bytes_sent', len(msg))
+                m.emit('send', message)
+
             if self.ackFlag:
-                # Storing the ACK
+                # Reading until a whole ACK has arrived
                 RECV_BUFFER = 4096
+                while not self.acks:
+                    try:
+                        data = self.cnxn.recv(RECV_BUFFER)
+                    except Exception as e:
+                        self.status = False
+                        if m is not None:
+                            m.count('ack_errors')
+                        return False
+                    if not data:
+                        # Remote side closed the connection
+                        self.status = False
+                        if m is not None:
+                            m.count('ack_errors')
+                        return False
+                    self.acks.extend(self.decoder.feed(data))
+                ACK = self.acks.popleft().decode()
+
+                if m is not None:
+                    elapsed = time.perf_counter() - sent
+                    m.count('acks_received')
+                    m.observe('ack_seconds', elapsed)
+                    m.emit('ackReceived', ACK, elapsed)
+
+                # Returning ACK string
+                return ACK
+
+        def pipeline(self,window=10,retries=0,ordered=False):
+            """Turns on windowed sending with up to window messages waiting on ACKs"""
+            # ACKs are matched to messages on MSA-2 / MSH-10 by a reader
+            # thread.  AE and CE ACKs are resent up to retries times.  Ordered
+            # returns results in send order, resends still go out after
+            # later messages, so receivers that must see strict order need
+            # window=1
+            self.window = threading.BoundedSemaphore(window)
+            self.retries = retries
+            self.ordered = ordered
+            self.inflight = {}          # MSH-10 -> entries waiting on an ACK
+            self.sendOrder = deque()    # Entries in the order they were sent
+            self.finished = {}          # MSH-10s recently completed or timed out, oldest first
+            self.pipeLock = threading.Lock()
+            self.sendLock = threading.Lock()
+            self.pipelined = True
+            self.reader = threading.Thread(target=self._readAcks, daemon=True)
+            self.reader.start()
+            return True
+
+        def sendAsync(self,message,callback=None):
+            """Sends without waiting, returns a Future that resolves to the ACK"""
+            if not self.pipelined:
+                # Without "pipeline" the send is synchronous, the Future is
+                # already complete when it's returned
+                future = Future()
+                if callback is not None:
+                    future.add_done_callback(callback)
+                ACK = self.send(message)
+                if ACK is False:
+                    future.set_exception(ConnectionError('Unable to send'))
+                else:
+                    future.set_result(ACK)
+                return future
+
+            entry = _inflight(peek(message)['msg_id'], _frame(message))
+            if callback is not None:
+                entry.future.add_done_callback(callback)
+
+            if not self.ackFlag:
+                # Nothing to wait for
+                if self._write(entry.data):
+                    entry.future.set_result(None)
+                else:
+                    entry.future.set_exception(ConnectionError('Unable to send'))
+                return entry.future
+
+            # Waits while the window is full
+            self.window.acquire()
+            self._track(entry)
+            if not self._write(entry.data):
+                self._complete(entry, error=ConnectionError('Unable to send'))
+            elif self.metrics is not None:
+                self.metrics.count('messages_sent')
+                self.metrics.count('bytes_sent', len(entry.data))
+                self.metrics.emit('send', message)
+            return entry.future
+
+        def _track(self,entry):
+            # Registering before sending, the ACK can beat send() returning
+            entry.sent = time.monotonic()
+            entry.deadline = entry.sent + self.timeout
+            with self.pipeLock:
+                self.inflight.setdefault(entry.msgId, deque()).append(entry)
+                if entry.attempts == 0:
+                    self.sendOrder.append(entry)
+                if self.metrics is not None:
+                    self.metrics.gauge('inflight', len(self.sendOrder))
+
+        def _write(self,data):
+            # Socket writes from senders and resends don't interleave
+            try:
+                with self.sendLock:
+                    self.cnxn.sendall(data)
+                return True
+            except Exception as e:
+                self.status = False
+                return False
+
+        def _readAcks(self):
+            # Reader thread matching ACKs to messages in flight
+            while self.pipelined:
                 try:
-                    ACK = self.cnxn.recv(RECV_BUFFER)   
+                    ready = select.select([self.cnxn], [], [], .25)[0]
+                    if ready:
+                        data = self.cnxn.recv(65536)
+                        if not data:
+                            raise ConnectionError('Connection closed by remote host')
+                        for frame in self.decoder.feed(data):
+                            self._ackReceived(frame.decode('utf-8', 'replace'))
                 except Exception as e:
+                    # Everything in flight is lost with the connection
                     self.status = False
-                    return False
-                ACK = ACK.replace(b"\x0b", b"") # Vertical Tab
-                ACK = ACK.replace(b"\x1c", b"") # File Separator
-                ACK = ACK.decode()
+                    if self.metrics is not None:
+                        self.metrics.count('disconnects')
+                    self._failAll(e if isinstance(e, ConnectionError) else ConnectionError(str(e)))
+                    time.sleep(.25)
+                self._expire()
 
-                # Returning ACK string
-                return ACK
+        def _ackReceived(self,ack):
+            # Finding the message this ACK is for using MSA-2
+            fld = ack[3:4]
+            start = ack.find('MSA' + fld)
+            msa = ack[start:_segmentEnd(ack, max(start, 0), '\r', '\n')].split(fld) if start != -1 else []
+            code = msa[1] if len(msa) > 1 else ''
+            msgId = msa[2] if len(msa) > 2 else None
+
+            with self.pipeLock:
+                waiting = self.inflight.get(msgId)
+                if waiting:
+                    entry = waiting.popleft()
+                elif msgId:
+                    # Late ACK for a message that timed out, or one that was
+                    # never sent, it's never given to another message
+                    if self.metrics is not None:
+                        self.metrics.count('late_acks' if msgId in self.finished else 'unknown_acks')
+                    return
+                else:
+                    # No control id, taking the oldest message in flight
+                    entry = next((e for e in self.sendOrder if not e.done and e in self.inflight.get(e.msgId, ())), None)
+                    if entry is None:
+                        return
+                    self.inflight[entry.msgId].remove(entry)
+                if not self.inflight.get(entry.msgId):
+                    self.inflight.pop(entry.msgId, None)
 
-        def status(self):
+            if code in ('AE', 'CE') and entry.attempts < self.retries:
+                # Error ACKs are resent, rejects (AR, CR) are not
+                entry.attempts += 1
+                if self.metrics is not None:
+                    self.metrics.count('resends')
+                self._track(entry)
+                if not self._write(entry.data):
+                    self._complete(entry, error=ConnectionError('Unable to resend'))
+                return
+
+            self._complete(entry, ack)
+
+        def _complete(self,entry,ack=None,error=None):
+            # Resolving a message's Future, in send order when ordered
+            with self.pipeLock:
+                if entry.done:
+                    return
+                entry.done = True
+                entry.ack = ack
+                entry.error = error
+                self.finished.pop(entry.msgId, None)
+                self.finished[entry.msgId] = True
+                if len(self.finished) > _finishedIds:
+                    del self.finished[next(iter(self.finished))]
+                waiting = self.inflight.get(entry.msgId)
+                if waiting is not None:
+                    if entry in waiting:
+                        waiting.remove(entry)
+                    if not waiting:
+                        del self.inflight[entry.msgId]
+                finished = []
+                if self.ordered:
+                    while self.sendOrder and self.sendOrder[0].done:
+                        finished.append(self.sendOrder.popleft())
+                else:
+                    self.sendOrder.remove(entry)
+                    finished.append(entry)
+                inflight = len(self.sendOrder)
+            self.window.release()
+
+            m = self.metrics
+            if m is not None:
+                m.gauge('inflight', inflight)
+                if error is None:
+                    elapsed = time.monotonic() - entry.sent
+                    m.count('acks_received')
+                    m.observe('ack_seconds', elapsed)
+                    m.emit('ackReceived', ack, elapsed)
+                elif isinstance(error, socket.timeout):
+                    m.count('ack_timeouts')
+                else:
+                    m.count('send_errors')
+
+            for entry in finished:
+                if entry.error is not None:
+                    entry.future.set_exception(entry.error)
+                else:
+                    entry.future.set_result(entry.ack)
+
+        def _expire(self):
+            # Failing messages that have waited longer than the timeout
+            now = time.monotonic()
+            with self.pipeLock:
+                expired = [e for e in self.sendOrder if not e.done and e.deadline < now]
+            for entry in expired:
+                self._complete(entry, error=socket.timeout('No ACK for ' + entry.msgId))
+
+        def _failAll(self,error):
+            with self.pipeLock:
+                waiting = [e for e in self.sendOrder if not e.done]
+            for entry in waiting:
+                self._complete(entry, error=error)
+
+        def checkStatus(self):
             """Checking if oubound connection is still open"""
+            if self.pipelined:
+                # The reader thread notices a closed connection itself
+                return self.status
             try:
-                self.cnxn.send(b'')
+                # A closed connection reads as ready with nothing to read
+                if select.select([self.cnxn], [], [], 0)[0]:
+                    if not self.cnxn.recv(1, socket.MSG_PEEK):
+                        raise ConnectionError('Connection closed by remote host')
                 self.status = True
                 return True
             except:
@@ -740,17 +2992,646 @@ class tcp:
             self.timeout = timeout
             self.cnxn.settimeout(self.timeout)
 
+        def instrument(self,collector=None):
+            """Turns on counters, histograms and hooks, returns the metrics object"""
+            if collector is None:
+                collector = metrics()
+            self.metrics = collector
+            return collector
+
+    class asyncServer():
+        """asyncio listener serving many sending systems on one port"""
+        def __init__(self,port,handler=None,host=''):
+            # Initializes listener object
+            self.port = port
+            self.host = host
+            self.handler = handler      # Called with each message, plain functions run in threads
+            self.ackFlag = True
+            self.bytesFlag = False
+            self.maxSize = 16777216     # Largest message accepted, in bytes
+            self.queueSize = 1000       # Messages waiting when there is no handler
+            self.server = None
+            self.queue = None
+            self.overflow = deque()     # Messages that arrived after "stop" with the queue full
+            self.closing = False
+            self.connections = {}       # Remote address -> per connection state
+            self.metrics = None         # Set by "instrument"
+
+        async def start(self):
+            """Starts listening, returns once the port is bound"""
+            self.queue = asyncio.Queue(self.queueSize)
+            self.overflow = deque()
+            self.closing = False
+            self.server = await asyncio.start_server(self._connection, self.host or None, self.port)
+            return True
+
+        async def serve(self):
+            """Starts listening and serves until stopped"""
+            if self.server is None:
+                await self.start()
+            try:
+                await self.server.serve_forever()
+            except asyncio.CancelledError:
+                pass
+
+        async def _connection(self,reader,writer):
+            # One of these runs per connected sending system
+            addr = writer.get_extra_info('peername')
+            state = {'writer': writer, 'task': asyncio.current_task(), 'connected': datetime.datetime.now(),
+                     'decoder': mllp(self.maxSize), 'received': 0, 'errors': 0, 'waiting': False}
+            self.connections[addr] = state
+            m = self.metrics
+            if m is not None:
+                m.count('connections')
+                m.adjust('connections_open', 1)
+            try:
+                while True:
+                    try:
+                        data = await reader.read(65536)
+                    except ConnectionError:
+                        break
+                    if not data:
+                        break
+                    if m is not None:
+                        m.count('bytes_received', len(data))
+                        m.emit('receive', data)
+                    for frame in state['decoder'].feed(data):
+                        await self._received(frame, writer, state)
+            finally:
+                del self.connections[addr]
+                writer.close()
+                if m is not None:
+                    m.adjust('connections_open', -1)
+
+        async def _received(self,data,writer,state):
+            # Acknowledges and hands on one complete message
+            state['received'] += 1
+            m = self.metrics
+            if m is not None:
+                m.count('messages_received')
+                m.emit('frame', data)
+
+            if self.ackFlag:
+                ACK, encoding = _makeAck(data,'AA','',None)
+                writer.write(_frame(ACK, encoding))
+                await writer.drain()
+                if m is not None:
+                    m.count('acks_sent_AA')
+                    m.emit('ackSent', ACK)
+
+            if not self.bytesFlag:
+                data = data.decode(_charset(data), 'replace')
+
+            if self.handler is None:
+                if self.closing and self.queue.full():
+                    # Already ACKed, kept for "getMsg" after the queue
+                    self.overflow.append(data)
+                    return
+                # Waits when the queue is full, which stops reading this socket
+                state['waiting'] = True
+                try:
+                    await self.queue.put(data)
+                except asyncio.CancelledError:
+                    if not self.closing:
+                        raise
+                    # Let go by "stop", the connection then ends normally
+                    self.overflow.append(data)
+                    return
+                finally:
+                    state['waiting'] = False
+                if m is not None:
+                    m.gauge('queue_depth', self.queue.qsize())
+                return
+
+            start = time.perf_counter()
+            try:
+                if iscoroutinefunction(self.handler):
+                    result = self.handler(data)
+                else:
+                    # Plain functions run in threads, so a slow one doesn't hold up every connection
+                    result = await asyncio.get_running_loop().run_in_executor(None, self.handler, data)
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception:
+                state['errors'] += 1
+                if m is not None:
+                    m.count('handler_errors')
+            if m is not None:
+                elapsed = time.perf_counter() - start
+                m.observe('handler_seconds', elapsed)
+                m.emit('handler', elapsed)
+
+        async def getMsg(self):
+            """Getting next message from any connection"""
+            if self.overflow and self.queue.empty():
+                data = self.overflow[0]
+                if data is not None:
+                    self.overflow.popleft()
+                return data
+            data = await self.queue.get()
+            if data is None:
+                # Listener was stopped
+                self.queue.put_nowait(None)
+            return data
+
+        def __aiter__(self):
+            return self
+
+        async def __anext__(self):
+            data = await self.getMsg()
+            if data is None:
+                raise StopAsyncIteration
+            return data
+
+        async def stop(self):
+            """Stops the listener and closes every connection"""
+            # Messages already received are still returned by "getMsg"
+            try:
+                self.closing = True
+                self.server.close()
+                states = list(self.connections.values())
+                for state in states:
+                    state['writer'].close()
+                    if state['waiting']:
+                        # Waiting on a full queue, the message moves to the overflow
+                        state['task'].cancel()
+                # Connections finish what they were doing, handlers included
+                await asyncio.gather(*[state['task'] for state in states], return_exceptions=True)
+                await self.server.wait_closed()
+                if self.queue is not None:
+                    if self.overflow or self.queue.full():
+                        self.overflow.append(None)
+                    else:
+                        self.queue.put_nowait(None)
+                status = True
+            except:
+                status = False
+
+            return status
+
+        def remoteAddresses(self):
+            """Lists the addresses currently connected"""
+            return list(self.connections)
+
+        def autoAck(self,boolian):
+            if not boolian:
+                self.ackFlag = False
+            else:
+                self.ackFlag = True
+
+        def rawBytes(self,boolian):
+            """Setting true returns messages as undecoded bytes for "parse".  Default is False"""
+            if not boolian:
+                self.bytesFlag = False
+            else:
+                self.bytesFlag = True
+
+        def instrument(self,collector=None):
+            """Turns on counters, histograms and hooks, returns the metrics object"""
+            if collector is None:
+                collector = metrics()
+            self.metrics = collector
+            return collector
+
+    class pool():
+        """Pooled senders with several lazy connections per destination"""
+        def __init__(self,size=2,workers=32):
+            # Initializes pool object
+            self.size = size            # Connections per destination
+            self.timeout = 5            # ACK timeout for each connection
+            self.backoff = .5           # First reconnect delay, doubled per failure
+            self.maxBackoff = 60        # Longest reconnect delay
+            self.idleCheck = 30         # Seconds idle before a connection is checked
+            self.destinations = {}
+            self.executor = ThreadPoolExecutor(workers)
+            self.metrics = None         # Shared by every connection, see "instrument"
+
+        def add(self,name,host,port,size=None):
+            """Adds a destination, connections are opened on first use"""
+            self.destinations[name] = _destination(host, port, size or self.size)
+            return True
+
+        def _acquire(self,dest):
+            # Idle connection, a new one if under the limit, or wait for one
+            while True:
+                try:
+                    ob, idleSince = dest.idle.get_nowait()
+                except Empty:
+                    with dest.lock:
+                        opening = dest.created < dest.size
+                        if opening:
+                            dest.created += 1
+                    if opening:
+                        return self._connect(dest)
+                    try:
+                        ob, idleSince = dest.idle.get(timeout=self.timeout)
+                    except Empty:
+                        return None
+
+                # Connections idle for a while are checked before reuse
+                if time.monotonic() - idleSince < self.idleCheck or ob.checkStatus():
+                    return ob
+                self._discard(dest, ob)
+
+        def _connect(self,dest):
+            # Opening a connection unless the destination is backing off
+            if time.monotonic() < dest.retryAt:
+                with dest.lock:
+                    dest.created -= 1
+                return None
+            ob = tcp.client(dest.host, dest.port)
+            ob.setTimeout(self.timeout)
+            ob.metrics = self.metrics
+            if ob.start():
+                dest.failures = 0
+                return ob
+            self._discard(dest, ob)
+            return None
+
+        def _discard(self,dest,ob):
+            # Dropping a broken connection and backing off with jitter
+            ob.stop()
+            if self.metrics is not None:
+                self.metrics.count('connection_failures')
+            with dest.lock:
+                dest.created -= 1
+                dest.failures += 1
+                delay = min(self.maxBackoff, self.backoff * 2 ** (dest.failures - 1))
+                dest.retryAt = time.monotonic() + delay * random.uniform(.5, 1)
+
+        def send(self,name,message):
+            """Sends to one destination and returns the ACK, or False"""
+            dest = self.destinations[name]
+            ob = self._acquire(dest)
+            if ob is None:
+                return False
+            ack = ob.send(message)
+            if ack is False:
+                self._discard(dest, ob)
+                return False
+            dest.idle.put((ob, time.monotonic()))
+            return ack
+
+        def sendTo(self,names,message):
+            """Sends to one or many destinations at once, returns ACK or dict of ACKs"""
+            if isinstance(names,str):
+                return self.send(names, message)
+            futures = {name: self.executor.submit(self.send, name, message) for name in names}
+            return {name: future.result() for name, future in futures.items()}
+
+        def health(self):
+            """Returns each destination's open connections, failures and backoff"""
+            now = time.monotonic()
+            status = {}
+            for name, dest in self.destinations.items():
+                status[name] = {'connections': dest.created,
+                                'idle': dest.idle.qsize(),
+                                'failures': dest.failures,
+                                'retryIn': max(0, dest.retryAt - now)}
+            return status
+
+        def close(self):
+            """Closes every connection in the pool"""
+            for dest in self.destinations.values():
+                while True:
+                    try:
+                        ob, idleSince = dest.idle.get_nowait()
+                    except Empty:
+                        break
+                    ob.stop()
+                    with dest.lock:
+                        dest.created -= 1
+            self.executor.shutdown(wait=False)
+            return True
+
+        def instrument(self,collector=None):
+            """Turns on metrics for every connection, returns the metrics object"""
+            if collector is None:
+                collector = metrics()
+            self.metrics = collector
+            for dest in self.destinations.values():
+                for ob, idleSince in list(dest.idle.queue):
+                    ob.metrics = collector
+            return collector
+
+#-------------------------------------------------------------------------------#
+# Durable store-and-forward queue for outbound messages.  Messages are appended #
+# to segment files on disk, with an index of record offsets per segment, and a  #
+# cursor records how far the receiver has ACKed.  Segments the cursor has       #
+# passed are deleted, and after a restart sending picks up at the cursor        #
+#-------------------------------------------------------------------------------#
+class outbox:
+    """Persistent queue of outbound messages, sent in order by "drain" """
+
+    header = struct.Struct('<II')       # Record length and CRC-32 of the message
+    offset = struct.Struct('<Q')        # Index entry, record offset in the segment
+
+    def __init__(self,path,segmentSize=67108864,syncEvery=1000,syncInterval=.1):
+        # Initializing, one process owns an outbox directory at a time
+        self.path = path
+        self.segmentSize = segmentSize      # Bytes before a new segment is started
+        self.syncEvery = syncEvery          # Messages between fsyncs
+        self.syncInterval = syncInterval    # Seconds between fsyncs
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+        self.halt = False
+        self.thread = None
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+        os.makedirs(path, exist_ok=True)
+
+        # Cursor, the sequence number of the first message not yet ACKed
+        cursorPath = os.path.join(path, 'cursor')
+        if not os.path.exists(cursorPath):
+            with open(cursorPath, 'wb') as f:
+                f.write(outbox.offset.pack(0))
+        self.cursorFile = open(cursorPath, 'r+b')
+        self.cursorMap = mmap.mmap(self.cursorFile.fileno(), outbox.offset.size)
+        self.cursor = outbox.offset.unpack(self.cursorMap)[0]
+
+        # Segments are named by the sequence number of their first message
+        self.segments = sorted(int(name[:-4]) for name in os.listdir(path) if name.endswith('.log'))
+        if not self.segments:
+            self.segments = [self.cursor]
+        self._recover()
+        self.cursor = max(self.segments[0], min(self.cursor, self.tail))
+
+        # Reader position, the next message "read" returns
+        self.readSeq = None
+        self.readFile = None
+        self.readBase = None
+
+    def _file(self,base,ext):
+        return os.path.join(self.path, '%020d.%s' % (base, ext))
+
+    def _recover(self):
+        # Checking the last segment after a crash, a torn record at the end
+        # is cut off and index entries are rebuilt from the log
+        base = self.segments[-1]
+        logPath = self._file(base, 'log')
+        idxPath = self._file(base, 'idx')
+        offsets = array('Q')
+        if os.path.exists(idxPath):
+            with open(idxPath, 'rb') as f:
+                data = f.read()
+            offsets.frombytes(data[:len(data) - len(data) % 8])
+        size = os.path.getsize(logPath) if os.path.exists(logPath) else 0
+        while offsets and offsets[-1] >= size:
+            offsets.pop()
+
+        # Scanning forward from the last indexed record
+        pos = offsets.pop() if offsets else 0
+        with open(logPath, 'ab+') as f:
+            f.seek(pos)
+            while True:
+                head = f.read(outbox.header.size)
+                if len(head) < outbox.header.size:
+                    break
+                length, crc = outbox.header.unpack(head)
+                data = f.read(length)
+                if len(data) < length or crc32(data) != crc:
+                    break
+                offsets.append(pos)
+                pos += outbox.header.size + length
+            f.truncate(pos)
+        with open(idxPath, 'wb') as f:
+            f.write(offsets.tobytes())
+
+        self.tail = base + len(offsets)     # Sequence number of the next message
+        self.writeOffset = pos
+        self.logFd = os.open(logPath, os.O_WRONLY | os.O_APPEND)
+        self.idxFd = os.open(idxPath, os.O_WRONLY | os.O_APPEND)
+
+    def put(self,message):
+        """Adds a message to the end of the queue, returns its sequence number"""
+        return self.putMany([message])
+
+    def putMany(self,messages):
+        """Adds messages in one write, returns the last sequence number"""
+        records = []
+        for message in messages:
+            if not isinstance(message,str):
+                message = message.decode(_charset(message), 'replace')
+            data = message.encode('utf-8')
+            records.append(outbox.header.pack(len(data), crc32(data)) + data)
+
+        with self.lock:
+            first = 0
+            while first < len(records):
+                if self.writeOffset >= self.segmentSize:
+                    self._rotate()
+                # Records that fit in the current segment
+                index = array('Q')
+                last = first
+                while last < len(records) and (last == first or self.writeOffset < self.segmentSize):
+                    index.append(self.writeOffset)
+                    self.writeOffset += len(records[last])
+                    last += 1
+                # Written straight to the file, a crash of this process loses nothing
+                _writeAll(self.logFd, b''.join(records[first:last]))
+                _writeAll(self.idxFd, index.tobytes())
+                self.tail += last - first
+                first = last
+            self.unsynced += len(records)
+            if self.unsynced >= self.syncEvery or time.monotonic() - self.lastSync >= self.syncInterval:
+                self._sync()
+            self.ready.notify_all()
+            return self.tail - 1
+
+    def _rotate(self):
+        # Starting a new segment once the current one is full
+        self._sync()
+        os.close(self.logFd)
+        os.close(self.idxFd)
+        self.segments.append(self.tail)
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        self.logFd = os.open(self._file(self.tail, 'log'), flags)
+        self.idxFd = os.open(self._file(self.tail, 'idx'), flags)
+        self.writeOffset = 0
+
+    def _sync(self):
+        # Batched fsync of the log, index and cursor
+        os.fsync(self.logFd)
+        os.fsync(self.idxFd)
+        self.cursorMap.flush()
+        self.unsynced = 0
+        self.lastSync = time.monotonic()
+
+    def sync(self):
+        """Forces everything queued so far onto disk"""
+        with self.lock:
+            self._sync()
+
+    def _seek(self,seq):
+        # Positioning the reader, the segment index gives the record offset
+        base = max(b for b in self.segments if b <= seq)
+        if self.readFile is not None:
+            self.readFile.close()
+        self.readFile = open(self._file(base, 'log'), 'rb')
+        self.readBase = base
+        if seq > base:
+            with open(self._file(base, 'idx'), 'rb') as f:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                    self.readFile.seek(outbox.offset.unpack_from(index, (seq - base) * 8)[0])
+        self.readSeq = seq
+
+    def read(self,limit=100,start=None):
+        """Returns up to limit (sequence number, message) pairs, oldest first"""
+        with self.lock:
+            tail = self.tail
+            segments = list(self.segments)
+            if start is None:
+                start = self.cursor if self.readSeq is None else self.readSeq
+            start = max(start, self.cursor)
+            if start >= tail:
+                return []
+            if start != self.readSeq:
+                self._seek(start)
+
+        messages = []
+        while self.readSeq < tail and len(messages) < limit:
+            nextBase = next((b for b in segments if b > self.readBase), None)
+            if nextBase is not None and self.readSeq >= nextBase:
+                # Moving on to the next segment
+                self._seek(self.readSeq)
+            length, crc = outbox.header.unpack(self.readFile.read(outbox.header.size))
+            data = self.readFile.read(length)
+            messages.append((self.readSeq, data.decode('utf-8')))
+            self.readSeq += 1
+        return messages
+
+    def ack(self,seq):
+        """Marks every message up to and including seq as delivered"""
+        with self.lock:
+            if seq < self.cursor:
+                return
+            self.cursor = seq + 1
+            self.cursorMap[:] = outbox.offset.pack(self.cursor)
+
+            # Deleting segments every message of which has been delivered
+            while len(self.segments) > 1 and self.segments[1] <= self.cursor:
+                base = self.segments.pop(0)
+                if self.readBase == base:
+                    self.readFile.close()
+                    self.readFile = None
+                    self.readSeq = None
+                for ext in ('log', 'idx'):
+                    try:
+                        remove(self._file(base, ext))
+                    except OSError:
+                        pass
+
+    def __len__(self):
+        return self.tail - self.cursor
+
+    def drain(self,client,batch=100,backoff=.5,maxBackoff=30,rejected=None):
+        """Sends the queue through a tcp.client in order until "stop" is called"""
+        # Messages are only dropped from the queue once ACKed, anything sent
+        # without an ACK is sent again, so delivery is at least once.  AR and
+        # AE ACKs still count as delivered, rejected(message, ack) sees them
+        delay = backoff
+        start = self.cursor
+        while not self.halt:
+            messages = self.read(batch, start)
+            start = None
+            if not messages:
+                with self.lock:
+                    if self.unsynced:
+                        self._sync()
+                    if self.readSeq is None or self.readSeq >= self.tail:
+                        self.ready.wait(.25)
+                continue
+
+            sent = _deliver(client, messages, rejected)
+            if sent:
+                self.ack(messages[sent - 1][0])
+            if sent == len(messages):
+                delay = backoff
+                continue
+
+            # Receiver is down, reconnecting and resending from the cursor
+            start = self.cursor
+            deadline = time.monotonic() + delay
+            while not self.halt and time.monotonic() < deadline:
+                time.sleep(min(.25, delay))
+            if self.halt:
+                break
+            client.restart()
+            delay = backoff if client.status else min(maxBackoff, delay * 2)
+
+    def start(self,client,**options):
+        """Runs "drain" on a background thread"""
+        self.halt = False
+        self.thread = threading.Thread(target=self.drain, args=(client,), kwargs=options, daemon=True)
+        self.thread.start()
+        return True
+
+    def stop(self):
+        """Stops the drain thread"""
+        self.halt = True
+        with self.lock:
+            self.ready.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        return True
+
+    def close(self):
+        """Stops draining and closes the queue files, everything is synced"""
+        self.stop()
+        with self.lock:
+            self._sync()
+            os.close(self.logFd)
+            os.close(self.idxFd)
+            self.cursorMap.close()
+            self.cursorFile.close()
+            if self.readFile is not None:
+                self.readFile.close()
+        return True
+
+def _writeAll(fd,data):
+    """Writes all of data to a file descriptor"""
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _deliver(client,messages,rejected):
+    """Sends (sequence number, message) pairs, returns how many were ACKed in order"""
+    if client.pipelined:
+        futures = [client.sendAsync(message) for seq, message in messages]
+    sent = 0
+    for i, (seq, message) in enumerate(messages):
+        if client.pipelined:
+            try:
+                ack = futures[i].result()
+            except Exception:
+                return sent
+        else:
+            ack = client.send(message)
+            if ack is False:
+                return sent
+        if rejected is not None and ack and not client.evaluate(ack):
+            rejected(message, ack)
+        sent += 1
+    return sent
+
 #---------------------------------------#
 #  Class for file Reading and Writing   #
 #---------------------------------------#
 class file:
     """File reader designed for reading HL7 files"""
-    msgList = []
+
+    # Segments that start a message or wrap a batch of them
+    envelope = (b'MSH', b'FHS', b'BHS', b'BTS', b'FTS')
 
     def __init__(self,path,filename=None):
         path = path.replace('\\','/')
         self.path = path
         self.filename = filename
+        self.msgList = []       # Messages from the last "read"
+        self.count = 0          # Messages from the last "read", "batch" or "debatch"
+        self.f = None
+        self.db = None          # Index sidecar, see "index"
         if self.filename:
             # If they supply a filename we get the full path
             self.fullpath = self.path + '/' + self.filename
@@ -760,131 +3641,413 @@ class file:
 
     def read(self,splitChar = 'MSH'):
         # Reads file and splits HL7 messages
+        if splitChar == 'MSH':
+            self.msgList = list(self.iterMessages())
+            self.count = len(self.msgList)
+            return self.msgList
+
         f = open(self.fullpath,'r')
         data = f.read()
         f.close()
 
+        self.msgList = []
         messages = data.split(splitChar)
         for msg in messages:
             if msg == '':
                 continue
-            file.msgList.append(splitChar + msg)
+            self.msgList.append(splitChar + msg)
+
+        self.count = len(self.msgList)
+        return self.msgList
+
+    def iterMessages(self,binary=False):
+        """Yields one message at a time from the memory-mapped file"""
+        with open(self.fullpath,'rb') as f:
+            try:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped
+                return
+            with data:
+                for start, end in self._boundaries(data):
+                    if binary:
+                        yield data[start:end]
+                    else:
+                        yield _decode(data[start:end])
 
-        return file.msgList
+    def _boundaries(self,data,pos=0):
+        # Start and end offset of every message from pos on.  A message
+        # starts at MSH followed by the field separator, at the start of the
+        # file or of a line, and ends where the next message or batch
+        # segment starts
+        if data[pos:pos+3] in file.envelope:
+            first = pos
+        else:
+            first = data.find(b'MSH', pos)
+            if first == -1:
+                return
+        fld = data[first+3:first+4]
+        segStart = compile(b'[\r\n](' + b'|'.join(file.envelope) + b')' + escape(fld))
+
+        start = None
+        if data[first:first+3] == b'MSH' and (first == 0 or data[first-1:first] in (b'\r', b'\n')):
+            start = first
+        for found in segStart.finditer(data, max(first - 1, 0)):
+            if start is not None and found.start() >= start:
+                yield start, found.start() + 1
+                start = None
+            if found.group(1) == b'MSH':
+                start = found.start() + 1
+        if start is not None:
+            yield start, len(data)
 
     def open(self,flag='a'):
+        # Binary, so index offsets are byte offsets.  Strings are written
+        # as UTF-8 by "write"
         try:
             if flag.lower() == 'w':
-                self.f = open(self.fullpath,'w')
+                self.f = open(self.fullpath,'wb')
             else:
-                self.f = open(self.fullpath,'a')
+                self.f = open(self.fullpath,'ab')
+            if self.db is None and os.path.exists(self.fullpath + '.idx'):
+                # Keeping an existing index up to date while appending
+                self._indexDb()
             return self
         except:
             return "Unable to write to file %s" % (self.fullpath)
 
     def write(self,data):
-        """Writing or appending to file"""
+        """Writing or appending to file, the file stays open until "close" """
         try:
+            if isinstance(data,str):
+                data = data.encode('utf-8')
             self.f.write(data)
-            if not file.appendFlag:
-                self.f.close()
+            if self.db is not None:
+                self.f.flush()
+                self._updateIndex()
             return self
         except:
             return False
 
     def close(self):
         """Closing file"""
-        self.f.close()
+        if self.f is not None:
+            self.f.close()
+        if self.db is not None:
+            self.db.close()
+            self.db = None
 
     def delete(self):
         """Deleting file after finished"""
+        self.close()
         remove(self.fullpath)
+        if os.path.exists(self.fullpath + '.idx'):
+            remove(self.fullpath + '.idx')
 
     def rename(self,newname):
         """Deleting file after finished"""
         rename(self.fullpath, self.path + '/' + newname)
+        if os.path.exists(self.fullpath + '.idx'):
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+            rename(self.fullpath + '.idx', self.path + '/' + newname + '.idx')
         self.fullpath = self.path + '/' + newname
 
-    def batch(self,comments = ''):
-        """HL7 batching file"""
-        # Reading file
-        temp = open(self.fullpath,'r')
-        # If FHS or BHS segments already exist, remove them
-        data = temp.read()
-        temp.close()
-        temp = open(self.fullpath,'w')
-        data = data.replace('\n','\r')
-        data = sub(r'FHS(.*?)\r|BHS(.*?)\r','',data)
-        temp.write(data)
-        temp.close()
-        messages = self.read()
-        # Getting MSH segment from first message
-        MSH = messages[0]
-        MSH = MSH.replace('\n','\r')
-        MSH = MSH.split('\r')
-        MSH = MSH[0]
+    #---------------------------------------------------------------------------#
+    # Index sidecar.  A SQLite file next to the HL7 file holds the byte offset, #
+    # length, MSH-10 and MSH-9 of every message, plus the values of any key    #
+    # fields.  Lookups read only the matching messages through mmap, and new   #
+    # messages are indexed from where the last update stopped                  #
+    #---------------------------------------------------------------------------#
+    def index(self,keys=None):
+        """Builds or updates the index sidecar, keys are field paths like PID.3.1"""
+        db = self._indexDb()
+        if keys is not None:
+            keys = '\r'.join(keys)
+            if keys != self._meta('keys', ''):
+                # Different key fields, every message has to be read again
+                _extractPlan(tuple(keys.split('\r')) if keys else ())
+                with db:
+                    db.execute('DELETE FROM messages')
+                    db.execute('DELETE FROM keys')
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('keys', ?)", (keys,))
+                    db.execute("INSERT OR REPLACE INTO meta VALUES ('size', 0)")
+        return self._updateIndex()
+
+    def _indexDb(self):
+        # Opening the sidecar, created on first use
+        if self.db is None:
+            db = sqlite3.connect(self.fullpath + '.idx', check_same_thread=False)
+            # Only a cache of the HL7 file, it can always be rebuilt
+            db.execute('PRAGMA synchronous=OFF')
+            db.execute('CREATE TABLE IF NOT EXISTS meta (name PRIMARY KEY, value)')
+            db.execute('CREATE TABLE IF NOT EXISTS messages (offset INTEGER PRIMARY KEY, length, msg_id, msg_type, msg_event)')
+            db.execute('CREATE TABLE IF NOT EXISTS keys (path, value, offset)')
+            db.execute('CREATE INDEX IF NOT EXISTS messages_id ON messages (msg_id)')
+            db.execute('CREATE INDEX IF NOT EXISTS messages_type ON messages (msg_type, msg_event)')
+            db.execute('CREATE INDEX IF NOT EXISTS keys_value ON keys (path, value)')
+            db.commit()
+            self.db = db
+        return self.db
+
+    def _meta(self,name,default=None):
+        row = self.db.execute('SELECT value FROM meta WHERE name=?', (name,)).fetchone()
+        return row[0] if row else default
+
+    def _updateIndex(self):
+        # Indexing messages added since the last update.  The last message
+        # indexed is read again, more segments may have been appended to it
+        db = self.db
+        if not os.path.exists(self.fullpath):
+            # Nothing written yet
+            return 0
+        stat = os.stat(self.fullpath)
+        if stat.st_size == self._meta('size') and stat.st_ino == self._meta('inode'):
+            return db.execute('SELECT count(*) FROM messages').fetchone()[0]
+
+        keys = self._meta('keys', '')
+        keys = tuple(keys.split('\r')) if keys else ()
+        with db:
+            if stat.st_ino != self._meta('inode') or stat.st_size < (self._meta('size') or 0):
+                # File was replaced or cut short, starting over
+                db.execute('DELETE FROM messages')
+                db.execute('DELETE FROM keys')
+                pos = 0
+            else:
+                last = db.execute('SELECT offset, msg_id FROM messages ORDER BY offset DESC LIMIT 1').fetchone()
+                pos = last[0] if last else 0
+                db.execute('DELETE FROM messages WHERE offset >= ?', (pos,))
+                db.execute('DELETE FROM keys WHERE offset >= ?', (pos,))
+
+            if stat.st_size:
+                with open(self.fullpath,'rb') as f:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        size = len(data)
+                        header = peek(data[pos:_segmentEnd(data, pos, b'\r', b'\n')]) if pos else None
+                        if pos and (not header or header['msg_id'] != last[1]):
+                            # Rewritten in place, the last message indexed isn't there
+                            db.execute('DELETE FROM messages')
+                            db.execute('DELETE FROM keys')
+                            pos = 0
+                        rows = []
+                        keyRows = []
+                        for start, end in self._boundaries(data, pos):
+                            _indexMessage(data[start:end], start, end, keys, rows, keyRows)
+                            if len(rows) >= 10000:
+                                _indexRows(db, rows, keyRows)
+                        _indexRows(db, rows, keyRows)
+            else:
+                size = 0
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('size', ?)", (size,))
+            db.execute("INSERT OR REPLACE INTO meta VALUES ('inode', ?)", (stat.st_ino,))
+        return db.execute('SELECT count(*) FROM messages').fetchone()[0]
+
+    def lookup(self,msgId=None,msgType=None,event=None,keys=None,binary=False):
+        """Returns the messages matching every condition given, in file order"""
+        self._indexDb()
+        self._updateIndex()
+        where = []
+        args = []
+        if msgId is not None:
+            where.append('msg_id=?')
+            args.append(msgId)
+        if msgType is not None:
+            where.append('msg_type=?')
+            args.append(msgType)
+        if event is not None:
+            where.append('msg_event=?')
+            args.append(event)
+        indexed = self._meta('keys', '').split('\r')
+        for key, value in (keys or {}).items():
+            if key not in indexed:
+                raise ValueError('Field is not indexed: %s' % key)
+            where.append('offset IN (SELECT offset FROM keys WHERE path=? AND value=?)')
+            args += [key, value]
+
+        sql = 'SELECT offset, length FROM messages'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        rows = self.db.execute(sql + ' ORDER BY offset', args).fetchall()
+        if not rows:
+            return []
+
+        messages = []
+        with open(self.fullpath,'rb') as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                for offset, length in rows:
+                    raw = data[offset:offset+length]
+                    messages.append(raw if binary else _decode(raw))
+        return messages
+
+    def batch(self,comments = '',size = None):
+        """HL7 batching file, in one pass.  Size splits it into batches of that many messages"""
+        # Existing FHS, BHS, BTS and FTS segments are left out by iterMessages
+        messages = self.iterMessages(binary=True)
+        first = next(messages, None)
+        if first is None:
+            self.count = 0
+            return 0
+
+        # Getting MSH segment from first message, latin-1 keeps every byte
+        MSH = first.replace(b'\n',b'\r').split(b'\r')[0].decode('latin-1')
         fld = MSH[3:4]
-        total = self.total()
+        now = date('now','%Y%m%d%H%M%S')
 
-        # Editing FHS segment
-        FHSList = MSH.split(fld)
+        # Editing FHS and BHS segments, we only want first 11 fields
+        FHSList = (MSH.split(fld) + [''] * 11)[:11]
         FHSList[0] = 'FHS'
-        FHSList[6] = date('now','%Y%m%d%H%M%S')
-        FHSList[8] = self.filename
+        FHSList[6] = now
+        FHSList[8] = self.filename or os.path.basename(self.fullpath)
         FHSList[9] = comments
-        FHSList[10] = date('now','%Y%m%d%H%M%S')
-        i = 0
-        FHS = ''
-        while i < 11:
-            # We only want first 11 fields
-            if i == 10:
-                FHS += FHSList[i]
-            else:
-                FHS += FHSList[i] + fld
-            i += 1
+        FHSList[10] = now
+        FHS = fld.join(FHSList).encode('latin-1')
 
-        # Editing BHS segment
-        BHSList = MSH.split(fld)
+        BHSList = list(FHSList)
         BHSList[0] = 'BHS'
-        BHSList[6] = date('now','%Y%m%d%H%M%S')
         BHSList[8] = ''
-        BHSList[9] = comments
-        BHSList[10] = date('now','%Y%m%d%H%M%S')
-        i = 0
-        BHS = ''
-        while i < 11:
-            # We only want first 11 fields
-            if i == 10:
-                BHS += BHSList[i]
-            else:
-                BHS += BHSList[i] + fld
-            i += 1
-        
-        # Writing FHS and BHS segments to file with original data
-        batch = open(self.fullpath,'r')
-        data = batch.read()
-        batch.close()
-        batch = open(self.fullpath,'w')
-        batch = batch.replace('\n','\r')
-        batch.write(FHS+'\r'+BHS+'\r'+data+'BHS'+fld+str(total)+'\r'+'FHS'+fld+'1'+'\r')
-        batch.close()
+        BHS = fld.join(BHSList).encode('latin-1')
+        fld = fld.encode('latin-1')
+
+        def write(out):
+            # Trailers carry the counts, so nothing has to be read twice
+            out.write(FHS + b'\r')
+            total = batches = inBatch = 0
+            for msg in _chain(first, messages):
+                if inBatch == 0:
+                    out.write(BHS + b'\r')
+                    batches += 1
+                out.write(_segments(msg))
+                total += 1
+                inBatch += 1
+                if inBatch == size:
+                    out.write(b'BTS' + fld + str(inBatch).encode() + b'\r')
+                    inBatch = 0
+            if inBatch:
+                out.write(b'BTS' + fld + str(inBatch).encode() + b'\r')
+            out.write(b'FTS' + fld + str(batches).encode() + b'\r')
+            return total
+
+        self.count = self._rewrite(write)
+        return self.count
 
     def debatch(self):
-        """HL7 batching file"""
-        # Reading file
-        temp = open(self.fullpath,'r')
-        # If FHS or BHS segments already exist, remove them
-        data = temp.read()
-        temp.close()
-        temp = open(self.fullpath,'w')
-        data = data.replace('\n','\r')
-        data = sub(r'FHS(.*?)\r|BHS(.*?)\r','',data)
-        temp.write(data)
-        temp.close()
+        """Removes the FHS, BHS, BTS and FTS segments, in one pass"""
+        def write(out):
+            total = 0
+            for msg in self.iterMessages(binary=True):
+                out.write(_segments(msg))
+                total += 1
+            return total
+
+        self.count = self._rewrite(write)
+        return self.count
+
+    def _rewrite(self,write):
+        # Writing a temporary file next to this one and swapping it in, named
+        # so concurrent rewrites and files left by a crash don't collide
+        temp = '%s.%d.%d.tmp' % (self.fullpath, os.getpid(), threading.get_ident())
+        try:
+            with open(temp,'wb') as out:
+                result = write(out)
+            os.replace(temp, self.fullpath)
+        except:
+            if os.path.exists(temp):
+                remove(temp)
+            raise
+        return result
 
     def total(self):
-        """Return total of inbound messages"""
-        return len(file.msgList)
+        """Return total of messages from the last read, batch or debatch"""
+        return self.count
+
+def _indexMessage(raw,start,end,keys,rows,keyRows):
+    """Adds one message's index row and key rows"""
+    header = peek(raw)
+    rows.append((start, end - start, header['msg_id'], header['msg_type'], header['msg_event']))
+    if keys:
+        text = _decode(raw)
+        if '\n' in text:
+            text = text.replace('\n','\r')
+        plans, segNames = _extractPlan(keys)
+        segs = _extractSegments(text, segNames)
+        for key, plan in zip(keys, plans):
+            values = _extractValue(text, segs, plan, None)
+            if not isinstance(values,list):
+                values = [values]
+            for value in values:
+                if value:
+                    keyRows.append((key, value, start))
+
+def _indexRows(db,rows,keyRows):
+    """Writes and empties the pending index rows"""
+    db.executemany('INSERT INTO messages VALUES (?,?,?,?,?)', rows)
+    db.executemany('INSERT INTO keys VALUES (?,?,?)', keyRows)
+    del rows[:]
+    del keyRows[:]
+
+def _chain(first,rest):
+    """Yields first and then everything in rest"""
+    yield first
+    for item in rest:
+        yield item
+
+def _segments(msg):
+    """A message's bytes with every segment ending in a return"""
+    msg = msg.replace(b'\n',b'\r')
+    if not msg.endswith(b'\r'):
+        msg += b'\r'
+    return msg
+
+class _splitter:
+    """Splits a stream of file bytes into messages as blocks arrive"""
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = None       # Where the message being read starts
+        self.scanned = 0        # Everything before here has been searched
+        self.pattern = None     # Built from the field separator of the first segment
+
+    def feed(self,data):
+        """Adds a block, returns the messages it completed as bytes"""
+        buf = self.buffer
+        buf += data
+        messages = []
+        if self.pattern is None:
+            # Same boundaries as "file.iterMessages"
+            first = 0 if buf[0:3] in file.envelope else buf.find(b'MSH')
+            if first == -1 or len(buf) < first + 4:
+                return messages
+            fld = bytes(buf[first+3:first+4])
+            self.pattern = compile(b'[\r\n](' + b'|'.join(file.envelope) + b')' + escape(fld))
+            if buf[first:first+3] == b'MSH' and (first == 0 or buf[first-1:first] in (b'\r', b'\n')):
+                self.start = first
+            self.scanned = first
+
+        for found in self.pattern.finditer(buf, self.scanned):
+            if self.start is not None and found.start() >= self.start:
+                messages.append(bytes(buf[self.start:found.start()+1]))
+                self.start = None
+            if found.group(1) == b'MSH':
+                self.start = found.start() + 1
+
+        # A boundary can be cut by the end of the block, the last few bytes
+        # are searched again with the next one
+        self.scanned = max(len(buf) - 4, 0)
+        if self.start is not None:
+            self.scanned = max(self.scanned, self.start)
+        cut = self.scanned if self.start is None else min(self.start, self.scanned)
+        if cut:
+            del buf[:cut]
+            self.scanned -= cut
+            if self.start is not None:
+                self.start -= cut
+        return messages
+
+    def end(self):
+        """Returns the last message once the stream has finished"""
+        if self.start is None:
+            return []
+        return [bytes(self.buffer[self.start:])]
 
 #---------------------------------------#
 #  Class for ftp Reading and Writing    #
@@ -897,11 +4060,15 @@ class ftp:
         self.address = address
         self.port = port
         self.ftp = FTP()
+        self.sessions = LifoQueue()     # Idle (session, directory) for getMany and sendMany
+        self.credentials = None
 
     def connect(self,usr,pwd):
         """Creates connection to ftp site"""
         self.ftp.connect(self.address,self.port)
         self.ftp.login(usr,pwd)
+        # Kept to open the extra sessions used for parallel transfers
+        self.credentials = (usr,pwd)
         usr = ''
         port = ''
         return self.ftp.getwelcome()
@@ -918,18 +4085,19 @@ class ftp:
     def send(self,destname,data):
         """Sending data in either binary or ascii"""
         try:
-            if ftp.mode == 'ASCII':
-                f = BytesIO(data.encode())
-                self.ftp.storlines("STOR " + destname, f)
-            else:
-                f = BytesIO(data)
-                self.ftp.storbinary("STOR " + destname, f)
+            _store(self.ftp, destname, data)
             return True
         except:
             return False
 
     def get(self,destname,splitChar='MSH'):
         """Gets data in binary or ascii mode"""
+        if splitChar == 'MSH':
+            try:
+                return list(self.iterMessages(destname))
+            except:
+                return False
+
         try:
             f = BytesIO()
             self.ftp.retrbinary("RETR " + destname, f.write)
@@ -967,6 +4135,104 @@ class ftp:
             ftp.mode = 'ASCII'
         return ftp.mode
 
+    def iterMessages(self,destname,binary=False):
+        """Yields one message at a time as the file downloads"""
+        self.ftp.voidcmd('TYPE I')
+        conn = self.ftp.transfercmd('RETR ' + destname)
+        splitter = _splitter()
+        finished = False
+        try:
+            while True:
+                data = conn.recv(65536)
+                if not data:
+                    break
+                for msg in splitter.feed(data):
+                    yield msg if binary else _decode(msg)
+            for msg in splitter.end():
+                yield msg if binary else _decode(msg)
+            finished = True
+        finally:
+            conn.close()
+            if finished:
+                self.ftp.voidresp()
+            else:
+                # Stopped early, the server reports the aborted transfer
+                try:
+                    self.ftp.voidresp()
+                except:
+                    pass
+
+    def _session(self,directory):
+        # Idle session from the pool, or a new one, in the given directory
+        try:
+            session, current = self.sessions.get_nowait()
+        except Empty:
+            session, current = FTP(), None
+            session.connect(self.address,self.port)
+            session.login(*self.credentials)
+        if current != directory:
+            session.cwd(directory)
+        return session
+
+    def _transfer(self,work,name,directory):
+        # Runs one transfer on a pooled session, dropping sessions that fail
+        try:
+            session = self._session(directory)
+        except:
+            return False
+        try:
+            result = work(session, name)
+        except:
+            try:
+                session.close()
+            except:
+                pass
+            return False
+        self.sessions.put((session, directory))
+        return result
+
+    def getMany(self,names,workers=4,binary=False):
+        """Gets many files at once over pooled sessions, returns {name: messages or False}"""
+        def work(session,name):
+            # Same streaming as "iterMessages", on this session
+            other = ftp(self.address,self.port)
+            other.ftp = session
+            return list(other.iterMessages(name,binary))
+
+        directory = self.ftp.pwd()
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {name: executor.submit(self._transfer, work, name, directory) for name in names}
+        return {name: future.result() for name, future in futures.items()}
+
+    def sendMany(self,files,workers=4):
+        """Sends {destname: data} at once over pooled sessions, returns {destname: True or False}"""
+        def work(session,destname):
+            _store(session, destname, files[destname])
+            return True
+
+        directory = self.ftp.pwd()
+        with ThreadPoolExecutor(workers) as executor:
+            futures = {destname: executor.submit(self._transfer, work, destname, directory) for destname in files}
+        return {destname: future.result() for destname, future in futures.items()}
+
     def close(self):
         """Closes FTP connection"""
+        while True:
+            try:
+                session, directory = self.sessions.get_nowait()
+            except Empty:
+                break
+            try:
+                session.quit()
+            except:
+                session.close()
         self.ftp.quit()
+
+def _store(session,destname,data):
+    """Uploads data on an FTP session in the current mode"""
+    if ftp.mode == 'ASCII':
+        f = BytesIO(data.encode())
+        session.storlines("STOR " + destname, f)
+    else:
+        f = BytesIO(data)
+        session.storbinary("STOR " + destname, f)
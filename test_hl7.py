@@ -0,0 +1,919 @@
+import asyncio
+import json
+import os
+import pickle
+import select
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import hl7
+
+ADT = ('MSH|^~\\&|SENDAPP|SENDFAC|RECVAPP|RECVFAC|20150128120000||ADT^A08^ADT_A01|MSG00001|P|2.3\r'
+       'EVN|A08|20150128120000\r'
+       'PID|1||123456^^^MRN~987654^^^SSN||DOE^JOHN^Q&R^JR||19700101|M\r'
+       'NK1|1|DOE^JANE|SPO\r'
+       'NK1|2|DOE^JIM|SON\r')
+
+MODES = ({}, {'lazy': True}, {'compact': True})
+
+BATCH = ('FHS|^~\\&|SENDAPP|SENDFAC\r'
+         'BHS|^~\\&|SENDAPP|SENDFAC\r'
+         + ADT + ADT.replace('MSG00001', 'MSG00002') + ADT.replace('MSG00001', 'MSG00003') +
+         'BTS|3\r'
+         'FTS|1\r')
+
+LATIN = ('MSH|^~\\&|M\u00dcNCHEN|FAC|RECV|RFAC|20150128120000||ADT^A08|MSG00003|P|2.5|||||DE|8859/1\r'
+         'PID|1||42||M\u00dcLLER^J\u00dcRGEN\r')
+
+class peekTest(unittest.TestCase):
+
+    def test_header_follows_charset(self):
+        self.assertEqual(hl7.peek(LATIN.encode('latin-1'))['MSH.3'], 'M\u00dcNCHEN')
+        self.assertEqual(hl7.peek(memoryview(LATIN.encode('latin-1')))['MSH.3'], 'M\u00dcNCHEN')
+
+    def test_wide_encodings(self):
+        wide = LATIN.replace('8859/1', 'UNICODE UTF-16')
+        for encoding in ('utf-16', 'utf-32'):
+            header = hl7.peek(wide.encode(encoding))
+            self.assertEqual(header['MSH.3'], 'M\u00dcNCHEN', encoding)
+            self.assertEqual(header['msg_id'], 'MSG00003', encoding)
+
+class ackTest(unittest.TestCase):
+
+    def test_charset_of_received_message(self):
+        ack = hl7.makeAck(LATIN.encode('latin-1'), 'AA')
+        self.assertTrue(ack.startswith('MSH|^~\\&|RECV|RFAC|M\u00dcNCHEN|FAC|'))
+        self.assertIn('MSA|AA|MSG00003|', ack)
+        framed = hl7.ackBytes(LATIN.encode('latin-1'), 'AA')
+        self.assertEqual(framed, b'\x0b' + ack.encode('latin-1') + b'\x1c\r')
+
+    def test_wide_encodings(self):
+        wide = LATIN.replace('8859/1', 'UNICODE UTF-16')
+        framed = hl7.ackBytes(wide.encode('utf-16'), 'AE', 'Bad')
+        ack = framed[1:-2].decode('utf-16')
+        self.assertIn('|M\u00dcNCHEN|FAC|', ack)
+        self.assertIn('MSA|AE|MSG00003|Bad', ack)
+
+class tableTest(unittest.TestCase):
+
+    def setUp(self):
+        folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, folder)
+        self.path = os.path.join(folder, 'codes.tbl')
+        self.addCleanup(hl7.table.cache.pop, self.path, None)
+
+    def test_reloaded_after_file_change(self):
+        codes = hl7.table(self.path)
+        codes.create({'M': 'Male'})
+        self.assertEqual(codes.lookup('M', ''), 'Male')
+
+        # Another process writes the file, it's noticed at the next check
+        other = hl7.table(self.path)
+        with open(self.path, 'wb') as f:
+            pickle.dump({'M': 'Man', 'F': 'Woman'}, f)
+        stat = os.stat(self.path)
+        os.utime(self.path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+        self.assertEqual(other.lookup('M', ''), 'Male')
+
+        self.addCleanup(setattr, hl7.table, 'checkInterval', hl7.table.checkInterval)
+        hl7.table.checkInterval = 0
+        self.assertEqual(other.lookupMany(['M', 'F', 'U'], '?'), ['Man', 'Woman', '?'])
+        self.assertEqual(codes.read(), {'M': 'Man', 'F': 'Woman'})
+
+    def test_reverse_index(self):
+        codes = hl7.table(self.path)
+        codes.create({'M': 'Male', 'F': 'Female', 'X': ['not', 'hashable']})
+        self.assertEqual(codes.reverseLookup('Female', ''), 'F')
+        self.assertEqual(codes.reverseLookup(['not', 'hashable'], ''), 'X')
+        self.assertEqual(codes.reverseLookup('Unknown', 'U'), 'U')
+        # Rebuilt when the table is replaced
+        codes.create({'W': 'Female'})
+        self.assertEqual(codes.reverseLookup('Female', ''), 'W')
+
+class indexedTableTest(unittest.TestCase):
+
+    def test_create_replaces_what_this_object_reads(self):
+        with tempfile.TemporaryDirectory() as folder:
+            codes = hl7.indexedTable(os.path.join(folder, 'codes.db'))
+            codes.create({'a': '1'})
+            self.assertEqual(codes.lookup('a', ''), '1')
+            codes.create({'a': '8'})
+            self.assertEqual(codes.lookup('a', ''), '8')
+            self.assertEqual(os.listdir(folder), ['codes.db'])
+
+class fileIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'archive.hl7')
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def write(self,ids,mode='w'):
+        with open(self.path, mode, newline='') as f:
+            f.write(''.join(ADT.replace('MSG00001', msgId) for msgId in ids))
+
+    def test_appended_messages(self):
+        self.write(['A1', 'A2'])
+        archive = hl7.file(self.path)
+        self.assertEqual(archive.index(keys=['PID.3.1']), 2)
+        archive.open('a').write(ADT.replace('MSG00001', 'A3'))
+        archive.close()
+        self.assertEqual(len(archive.lookup(msgId='A3')), 1)
+        self.assertEqual(len(archive.lookup(keys={'PID.3.1': '123456'})), 3)
+
+    def test_rebuilt_after_truncate(self):
+        self.write(['A1', 'A2', 'A3'])
+        archive = hl7.file(self.path)
+        archive.index()
+        self.write(['B1'])
+        self.assertEqual(archive.index(), 1)
+        self.assertEqual(archive.lookup(msgId='A1'), [])
+        self.assertEqual(archive.lookup(msgId='B1'), [ADT.replace('MSG00001', 'B1')])
+
+    def test_rebuilt_after_rewrite_in_place(self):
+        # Same file, cut short and written again longer than before
+        self.write(['A1', 'A2'])
+        archive = hl7.file(self.path)
+        archive.index()
+        self.write(['B1', 'B2', 'B3', 'B4'])
+        self.assertEqual(archive.index(), 4)
+        self.assertEqual(archive.lookup(msgId='A1'), [])
+        self.assertEqual(len(archive.lookup(msgId='B1')), 1)
+        self.assertEqual(len(archive.lookup(msgType='ADT')), 4)
+
+    def test_rebuilt_after_replace(self):
+        self.write(['A1', 'A2'])
+        archive = hl7.file(self.path)
+        archive.index()
+        temp = self.path + '.new'
+        with open(temp, 'w', newline='') as f:
+            f.write(ADT.replace('MSG00001', 'C1') + ADT.replace('MSG00001', 'C2') + ADT.replace('MSG00001', 'C3'))
+        os.replace(temp, self.path)
+        self.assertEqual(archive.lookup(msgId='A1'), [])
+        self.assertEqual(len(archive.lookup(msgId='C3')), 1)
+        self.assertEqual(archive.index(), 3)
+
+class fileStreamTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'stream.hl7')
+        self.addCleanup(shutil.rmtree, self.folder)
+
+    def stream(self,text,binary=False):
+        with open(self.path, 'w', newline='') as f:
+            f.write(text)
+        return list(hl7.file(self.path).iterMessages(binary))
+
+    def test_msh_inside_a_field(self):
+        inner = ADT.replace('DOE^JIM', 'MSH|SMITH')
+        self.assertEqual(self.stream(inner + ADT), [inner, ADT])
+
+    def test_batch_segments_skipped(self):
+        self.assertEqual(self.stream(BATCH), [ADT, ADT.replace('MSG00001', 'MSG00002'), ADT.replace('MSG00001', 'MSG00003')])
+
+    def test_newline_endings(self):
+        text = (ADT + ORU).replace('\r', '\n')
+        self.assertEqual(self.stream(text), [ADT.replace('\r', '\n'), ORU.replace('\r', '\n')])
+        self.assertEqual(self.stream(text, binary=True)[1], ORU.replace('\r', '\n').encode())
+
+    def test_empty_file(self):
+        self.assertEqual(self.stream(''), [])
+
+class fileBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, 'batch.hl7')
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.messages = [ADT.replace('MSG00001', 'MSG%05d' % n) for n in range(5)]
+        with open(self.path, 'w', newline='') as f:
+            f.write(''.join(self.messages))
+
+    def lines(self):
+        with open(self.path, newline='') as f:
+            return f.read().split('\r')
+
+    def test_batch_counts(self):
+        archive = hl7.file(self.path)
+        self.assertEqual(archive.batch('Nightly'), 5)
+        lines = self.lines()
+        self.assertTrue(lines[0].startswith('FHS|^~\\&|SENDAPP|SENDFAC|'))
+        self.assertEqual(lines[0].split('|')[9], 'Nightly')
+        self.assertTrue(lines[1].startswith('BHS|'))
+        self.assertEqual(lines[-3:], ['BTS|5', 'FTS|1', ''])
+        self.assertEqual(list(archive.iterMessages()), self.messages)
+        self.assertEqual(os.listdir(self.folder), ['batch.hl7'])
+
+    def test_batch_size_splits(self):
+        archive = hl7.file(self.path)
+        self.assertEqual(archive.batch(size=2), 5)
+        trailers = [line for line in self.lines() if line[0:3] in ('BHS', 'BTS', 'FTS')]
+        self.assertEqual([line[0:3] for line in trailers], ['BHS', 'BTS', 'BHS', 'BTS', 'BHS', 'BTS', 'FTS'])
+        self.assertEqual([line for line in trailers if line[0:3] != 'BHS'], ['BTS|2', 'BTS|2', 'BTS|1', 'FTS|3'])
+
+    def test_debatch_removes_envelope(self):
+        archive = hl7.file(self.path)
+        archive.batch(size=2)
+        self.assertEqual(archive.debatch(), 5)
+        with open(self.path, newline='') as f:
+            self.assertEqual(f.read(), ''.join(self.messages))
+        self.assertEqual(os.listdir(self.folder), ['batch.hl7'])
+
+ORU = ('MSH|^~\\&|LAB|HOSP|EMR|HOSP|20150128120000||ORU^R01|MSG3|P|2.5\r'
+       'PID|1||42^^^MRN||DOE^JANE\r'
+       'OBR|1|||CBC^Blood\r'
+       'OBX|1|NM|WBC^White cells^LN||0.5|10*3/uL|4.0-11.0|N|||F\r'
+       'OBX|2|NM|WBC^White cells^LN||1.5|10*3/uL|4.0-11.0|N|||F\r'
+       'OBX|3|NM|WBC^White cells^LN||2.5|10*3/uL|4.0-11.0|N|||F\r')
+
+class roundTripTest(unittest.TestCase):
+    """Expected strings are what toString returned before unchanged segments were copied"""
+
+    def test_unchanged(self):
+        for raw in (ADT, ORU, LATIN):
+            for mode in MODES:
+                self.assertEqual(hl7.toString(hl7.parse(raw, **mode)), raw, mode)
+                self.assertEqual(hl7.toString(hl7.parse(raw.replace('\r', '\n'), **mode)), raw, mode)
+
+    def test_to_dict(self):
+        expected = json.dumps(hl7.parse(ADT))
+        for mode in MODES:
+            msg = hl7.parse(ADT, **mode)
+            self.assertEqual(json.dumps(hl7.toDict(msg['PID'])), json.dumps(hl7.parse(ADT)['PID']), mode)
+            self.assertEqual(json.dumps(hl7.toDict(msg)), expected, mode)
+            # Reading every field doesn't count as a change
+            self.assertFalse(msg['PID'].dirty, mode)
+            self.assertFalse(msg['NK1'][1].dirty, mode)
+
+    def test_bytes(self):
+        for mode in MODES:
+            msg = hl7.parse(LATIN.encode('latin-1'), **mode)
+            self.assertEqual(hl7.toString(msg), LATIN, mode)
+            self.assertEqual(hl7.toBytes(msg), LATIN.encode('latin-1'), mode)
+
+    def test_edited_fields(self):
+        expected = ('MSH|^~\\&|TEST|SENDFAC|RECVAPP|RECVFAC|20150128120000||ADT^A08^ADT_A01|MSG00001|P|2.3\r'
+                    'EVN|A08|20150128120000\r'
+                    'PID|1||123456^^^MRN~555^^^SSN||ROE^JOHN^Q&R^JR||19700101|M\r'
+                    'NK1|1|DOE^JANE|SPO\r'
+                    'NK1|2|DOE^JIM|SON\r')
+        for mode in MODES:
+            msg = hl7.parse(ADT, **mode)
+            msg['MSH']['MSH.3'] = 'TEST'
+            msg['PID']['PID.5']['PID.5.1'] = 'ROE'
+            msg['PID']['PID.3'][1]['PID.3.1'] = '555'
+            self.assertEqual(hl7.toString(msg), expected, mode)
+
+    def test_edited_repeating_segments(self):
+        expected = ORU.replace('||1.5|', '||9.9|').replace('WBC^White cells^LN||2.5', 'WBC^WBC count^LN||2.5')
+        for mode in MODES:
+            msg = hl7.parse(ORU, **mode)
+            msg['OBX'][1]['OBX.5'] = '9.9'
+            msg['OBX'][2]['OBX.3']['OBX.3.2'] = 'WBC count'
+            self.assertEqual(hl7.toString(msg), expected, mode)
+
+class parseManyTest(unittest.TestCase):
+
+    messages = [ADT.replace('MSG00001', 'MSG%05d' % n) for n in range(250)]
+    ids = ['MSG%05d' % n for n in range(250)]
+
+    def test_order_kept_with_workers(self):
+        parsed = list(hl7.parseMany(iter(self.messages), workers=2, chunksize=7))
+        self.assertEqual([msg['MSH']['MSH.10'] for msg in parsed], self.ids)
+        self.assertEqual(parsed[3], hl7.parse(self.messages[3]))
+
+    def test_unordered(self):
+        parsed = hl7.parseMany(self.messages, workers=2, chunksize=7, ordered=False)
+        self.assertEqual(sorted(msg['MSH']['MSH.10'] for msg in parsed), self.ids)
+
+    def test_in_process(self):
+        parsed = hl7.parseMany(self.messages[:3], workers=1, compact=True)
+        self.assertEqual([hl7.toString(msg) for msg in parsed], self.messages[:3])
+
+class pathTest(unittest.TestCase):
+
+    def test_edit_after_get(self):
+        # Values handed out by get can be edited in place, as with the parse dictionaries
+        for mode in MODES:
+            msg = hl7.parse(ADT, **mode)
+            hl7.path('MSH.9').get(msg)['MSH.9.1'] = 'ORU'
+            hl7.path('PID.3[*]').get(msg)[1]['PID.3.1'] = '555'
+            out = hl7.toString(msg)
+            self.assertIn('|ORU^A08^ADT_A01|', out, mode)
+            self.assertIn('|123456^^^MRN~555^^^SSN|', out, mode)
+
+    def test_set_past_end_of_segment(self):
+        for mode in MODES:
+            msg = hl7.parse(ADT, **mode)
+            hl7.path('PID.20').set(msg, 'X')
+            hl7.path('NK1[*].5.2').set(msg, 'Y')
+            out = hl7.toString(msg).split('\r')
+            self.assertEqual(out[2], 'PID|1||123456^^^MRN~987654^^^SSN||DOE^JOHN^Q&R^JR||19700101|M' + '|' * 12 + 'X', mode)
+            self.assertEqual(out[3], 'NK1|1|DOE^JANE|SPO||^Y', mode)
+            self.assertEqual(out[4], 'NK1|2|DOE^JIM|SON||^Y', mode)
+            self.assertEqual(hl7.path('PID.20').get(hl7.parse('\r'.join(out), **mode)), 'X', mode)
+
+    def test_all_on_plain_field(self):
+        msg = hl7.parse(ADT, compact=True)
+        self.assertEqual(hl7.path('PID.7[*]').get(msg), ['19700101'])
+
+class mappingTest(unittest.TestCase):
+
+    def test_now_is_not_cached(self):
+        rules = hl7.mapping([('date', 'MSH.7', '%Y', '%H%M%S%f')])
+        raw = ADT.replace('20150128120000', 'now', 1)
+        first = rules(raw).split('|')[6]
+        time.sleep(.01)
+        self.assertNotEqual(rules(raw).split('|')[6], first)
+
+    def test_same_output_for_every_mode(self):
+        rules = hl7.mapping([
+            ('set', 'MSH.3', 'TEST'),
+            ('copy', 'PID.3[1].1', 'PID.2'),
+            ('map', 'NK1[*].3', {'SPO': 'SPOUSE'}),
+            ('date', 'PID.7', '%Y%m%d', '%m/%d/%Y'),
+            ('delete', 'EVN'),
+        ])
+        out = rules(ADT)
+        self.assertEqual(out.split('\r')[1], 'PID|1|987654|123456^^^MRN~987654^^^SSN||DOE^JOHN^Q&R^JR||01/01/1970|M')
+        for mode in MODES:
+            self.assertEqual(hl7.toString(rules(hl7.parse(ADT, **mode))), out, mode)
+
+def _frame(raw):
+    return b'\x0b' + raw.encode() + b'\x1c\r'
+
+def _readAck(sock):
+    data = b''
+    while not data.endswith(b'\x1c\r'):
+        data += sock.recv(4096)
+    return data
+
+class serverTest(unittest.TestCase):
+
+    def test_closed_connection_is_closed_here(self):
+        ib = hl7.tcp.server(0)
+        ib.start()
+        port = ib.ib.getsockname()[1]
+        try:
+            first = socket.create_connection(('127.0.0.1', port))
+            first.sendall(_frame(ADT))
+            self.assertEqual(ib.getMsg(), ADT)
+            self.assertIn(b'MSA|AA|MSG00001', _readAck(first))
+            held = ib.conn
+            first.close()
+
+            second = socket.create_connection(('127.0.0.1', port))
+            second.sendall(_frame(ADT.replace('MSG00001', 'MSG00002')))
+            self.assertIn('MSG00002', ib.getMsg())
+            self.assertEqual(held.fileno(), -1)
+            self.assertIsNot(ib.conn, held)
+            second.close()
+        finally:
+            ib.stop()
+
+    def test_ack_in_received_charset(self):
+        ib = hl7.tcp.server(0)
+        ib.start()
+        ib.rawBytes(True)
+        try:
+            sender = socket.create_connection(('127.0.0.1', ib.ib.getsockname()[1]))
+            sender.sendall(b'\x0b' + LATIN.encode('latin-1') + b'\x1c\r')
+            self.assertEqual(ib.getMsg(), LATIN.encode('latin-1'))
+            ack = _readAck(sender)
+            self.assertIn('|M\u00dcNCHEN|FAC|'.encode('latin-1'), ack)
+            sender.close()
+        finally:
+            ib.stop()
+
+    def test_dispatch_backpressure_and_ack_after(self):
+        gate = threading.Event()
+        lock = threading.Lock()
+        counts = {'active': 0, 'peak': 0}
+
+        def handler(raw):
+            with lock:
+                counts['active'] += 1
+                counts['peak'] = max(counts['peak'], counts['active'])
+            gate.wait(5)
+            with lock:
+                counts['active'] -= 1
+            if 'MSG00003' in raw:
+                return 'AR'
+            if 'MSG00004' in raw:
+                raise ValueError('Bad message')
+
+        ib = hl7.tcp.server(0)
+        ib.start()
+        self.addCleanup(ib.stop)
+        ib.dispatch(handler, workers=4, queueSize=2, ackAfter=True)
+        sender = socket.create_connection(('127.0.0.1', ib.ib.getsockname()[1]))
+        self.addCleanup(sender.close)
+        for n in range(8):
+            sender.sendall(_frame(ADT.replace('MSG00001', 'MSG%05d' % n)))
+
+        # Four threads, but only as many messages as the queue holds are taken
+        time.sleep(.3)
+        self.assertEqual(counts['peak'], 2)
+        self.assertEqual(select.select([sender], [], [], 0)[0], [])
+
+        gate.set()
+        decoder = hl7.mllp()
+        acks = {}
+        sender.settimeout(5)
+        while len(acks) < 8:
+            for ack in decoder.feed(sender.recv(65536)):
+                msa = ack.decode().split('\r')[1].split('|')
+                acks[msa[2]] = msa[1]
+        self.assertEqual(acks.pop('MSG00003'), 'AR')
+        self.assertEqual(acks.pop('MSG00004'), 'AE')
+        self.assertEqual(set(acks.values()), {'AA'})
+        self.assertLessEqual(counts['peak'], 2)
+
+class asyncServerTest(unittest.IsolatedAsyncioTestCase):
+
+    async def listen(self,handler=None,queueSize=1000):
+        ib = hl7.tcp.asyncServer(0, handler, host='127.0.0.1')
+        ib.queueSize = queueSize
+        await ib.start()
+        errors = []
+        asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+        return ib, ib.server.sockets[0].getsockname()[1], errors
+
+    async def send(self,port,raw):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        writer.write(_frame(raw))
+        ack = await reader.readuntil(b'\x1c\r')
+        return reader, writer, ack
+
+    async def test_stop_keeps_queued_messages(self):
+        ib, port, errors = await self.listen(queueSize=5)
+        messages = [ADT.replace('MSG00001', 'MSG%05d' % n) for n in range(40)]
+        connections = []
+        for raw in messages:
+            reader, writer, ack = await self.send(port, raw)
+            self.assertIn(b'MSA|AA|' + raw.split('|')[9].encode(), ack)
+            connections.append(writer)
+        self.assertTrue(await ib.stop())
+        # The queue first, then what was waiting on it, all of it already ACKed
+        self.assertEqual([raw async for raw in ib], messages)
+        self.assertIsNone(await ib.getMsg())
+        self.assertEqual(errors, [])
+        self.assertEqual(ib.remoteAddresses(), [])
+        for writer in connections:
+            writer.close()
+
+    async def test_plain_handler_does_not_block_other_connections(self):
+        handled = []
+
+        def handler(raw):
+            if 'SLOW' in raw:
+                time.sleep(.5)
+            handled.append(raw.split('|')[9])
+
+        ib, port, errors = await self.listen(handler)
+        start = time.monotonic()
+        await self.send(port, ADT.replace('MSG00001', 'SLOW'))
+        for n in range(5):
+            await self.send(port, ADT.replace('MSG00001', 'FAST%d' % n))
+        while len(handled) < 5:
+            await asyncio.sleep(.01)
+        self.assertLess(time.monotonic() - start, .4)
+        self.assertNotIn('SLOW', handled)
+
+        # "stop" waits for the slow handler
+        self.assertTrue(await ib.stop())
+        self.assertEqual(handled[-1], 'SLOW')
+        self.assertEqual(errors, [])
+
+    async def test_coroutine_handler(self):
+        handled = []
+
+        async def handler(raw):
+            await asyncio.sleep(0)
+            handled.append(raw)
+
+        ib, port, errors = await self.listen(handler)
+        await self.send(port, ADT)
+        self.assertTrue(await ib.stop())
+        self.assertEqual(handled, [ADT])
+        self.assertEqual(errors, [])
+
+class metricsTest(unittest.TestCase):
+
+    def test_hooks_snapshot_and_text(self):
+        collector = hl7.metrics(prefix='lab')
+        seen = []
+        collector.hook('parse', seen.append)
+        collector.hook('parse', lambda elapsed: 1 / 0)
+        with self.assertRaises(ValueError):
+            collector.hook('unknown', print)
+
+        collector.count('messages', 2)
+        collector.gauge('depth', 5)
+        collector.adjust('depth', -1)
+        collector.observe('ack_seconds', .003)
+        collector.observe('ack_seconds', 20)
+        parse = collector.wrap(hl7.parse, 'parse')
+        self.assertEqual(parse(ADT)['MSH']['MSH.10'], 'MSG00001')
+
+        snapshot = collector.snapshot()
+        self.assertEqual(len(seen), 1)
+        self.assertEqual(snapshot['counters'], {'messages': 2, 'hook_errors': 1})
+        self.assertEqual(snapshot['gauges'], {'depth': 4})
+        acks = snapshot['histograms']['ack_seconds']
+        self.assertEqual((acks['count'], acks['p50'], acks['p99']), (2, .005, float('inf')))
+        self.assertEqual(snapshot['histograms']['parse_seconds']['count'], 1)
+
+        text = collector.text()
+        self.assertIn('# TYPE lab_messages_total counter\nlab_messages_total 2\n', text)
+        self.assertIn('lab_depth 4\n', text)
+        self.assertIn('lab_ack_seconds_bucket{le="0.005"} 1\n', text)
+        self.assertIn('lab_ack_seconds_bucket{le="+Inf"} 2\n', text)
+        self.assertIn('lab_ack_seconds_count 2\n', text)
+
+        collector.reset()
+        self.assertEqual(collector.snapshot()['counters'], {})
+
+    def test_listener_and_sender(self):
+        # Only the listener is instrumented, the sender records nothing
+        collector = hl7.metrics()
+        acks = []
+        collector.hook('ackSent', acks.append)
+        ib = hl7.tcp.server(0)
+        ib.start()
+        self.assertIs(ib.instrument(collector), collector)
+        self.addCleanup(ib.stop)
+        ob = hl7.tcp.client('127.0.0.1', ib.ib.getsockname()[1])
+        ob.start()
+        self.addCleanup(ob.stop)
+
+        for n in range(3):
+            raw = ADT.replace('MSG00001', 'MSG%05d' % n)
+            sent = threading.Thread(target=ob.send, args=(raw,))
+            sent.start()
+            self.assertEqual(ib.getMsg(), raw)
+            sent.join(5)
+
+        counters = collector.snapshot()['counters']
+        self.assertEqual(counters['messages_received'], 3)
+        self.assertEqual(counters['acks_sent_AA'], 3)
+        self.assertEqual(counters['bytes_received'], 3 * len(_frame(ADT)))
+        self.assertNotIn('messages_sent', counters)
+        self.assertEqual(len(acks), 3)
+        self.assertIsNone(ob.metrics)
+
+class receiver(threading.Thread):
+    """Test MLLP receiver, answers each message with reply(raw, count) or not at all"""
+
+    def __init__(self,reply):
+        threading.Thread.__init__(self, daemon=True)
+        self.reply = reply
+        self.received = []
+        self.ib = socket.socket()
+        self.ib.bind(('127.0.0.1', 0))
+        self.ib.listen(1)
+        self.port = self.ib.getsockname()[1]
+        self.start()
+
+    def run(self):
+        conn = self.ib.accept()[0]
+        decoder = hl7.mllp()
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            for raw in decoder.feed(data):
+                raw = raw.decode()
+                self.received.append(raw)
+                status = self.reply(raw, len(self.received))
+                if status:
+                    conn.sendall(hl7.ackBytes(raw, status))
+        conn.close()
+
+class clientTest(unittest.TestCase):
+
+    def test_send_async_without_pipeline(self):
+        remote = receiver(lambda raw, n: 'AA')
+        ob = hl7.tcp.client('127.0.0.1', remote.port)
+        ob.start()
+        try:
+            future = ob.sendAsync(ADT)
+            self.assertTrue(future.done())
+            self.assertIn('MSA|AA|MSG00001', future.result())
+        finally:
+            ob.stop()
+
+    def pipelined(self,reply,**options):
+        remote = receiver(reply)
+        ob = hl7.tcp.client('127.0.0.1', remote.port)
+        ob.start()
+        ob.pipeline(**options)
+        self.addCleanup(ob.stop)
+        return remote, ob
+
+    def test_error_ack_is_resent(self):
+        remote, ob = self.pipelined(lambda raw, n: 'AE' if n == 1 else 'AA', window=4, retries=2)
+        ack = ob.sendAsync(ADT).result(5)
+        self.assertIn('MSA|AA|MSG00001', ack)
+        self.assertEqual(remote.received, [ADT, ADT])
+
+    def test_resends_stop_after_retries(self):
+        remote, ob = self.pipelined(lambda raw, n: 'AE', retries=1)
+        ack = ob.sendAsync(ADT).result(5)
+        self.assertIn('MSA|AE|MSG00001', ack)
+        self.assertEqual(len(remote.received), 2)
+
+    def test_acks_matched_on_control_id(self):
+        remote, ob = self.pipelined(lambda raw, n: 'AA', window=8)
+        messages = [ADT.replace('MSG00001', 'MSG%05d' % n) for n in range(30)]
+        futures = [ob.sendAsync(raw) for raw in messages]
+        for n, future in enumerate(futures):
+            self.assertIn('MSA|AA|MSG%05d' % n, future.result(5))
+
+    def test_missing_ack_times_out(self):
+        remote = receiver(lambda raw, n: None)
+        ob = hl7.tcp.client('127.0.0.1', remote.port)
+        ob.setTimeout(.3)
+        ob.start()
+        ob.pipeline(window=1)
+        self.addCleanup(ob.stop)
+        future = ob.sendAsync(ADT)
+        with self.assertRaises(socket.timeout):
+            future.result(5)
+        # The window slot is given back
+        self.assertEqual(ob.sendAsync(ADT.replace('MSG00001', 'MSG00002')).exception(5).__class__, socket.timeout)
+
+    def test_late_ack_is_not_given_to_another_message(self):
+        def reply(raw, n):
+            if n == 1:
+                # Answering the first message after it has timed out
+                time.sleep(1)
+            return 'AA'
+        remote = receiver(reply)
+        ob = hl7.tcp.client('127.0.0.1', remote.port)
+        ob.setTimeout(.3)
+        ob.start()
+        ob.pipeline(window=4)
+        collector = ob.instrument()
+        self.addCleanup(ob.stop)
+        with self.assertRaises(socket.timeout):
+            ob.sendAsync(ADT).result(5)
+        ob.setTimeout(5)
+        second = ob.sendAsync(ADT.replace('MSG00001', 'MSG00002'))
+        self.assertIn('MSA|AA|MSG00002', second.result(5))
+        third = ob.sendAsync(ADT.replace('MSG00001', 'MSG00003'))
+        self.assertIn('MSA|AA|MSG00003', third.result(5))
+        self.assertEqual(collector.snapshot()['counters']['late_acks'], 1)
+
+class poolTest(unittest.TestCase):
+
+    def test_fan_out_and_backoff(self):
+        lab = receiver(lambda raw, n: 'AA')
+        billing = receiver(lambda raw, n: 'AE')
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        down = closed.getsockname()[1]
+        closed.close()
+
+        ob = hl7.tcp.pool(size=1)
+        self.addCleanup(ob.close)
+        ob.add('lab', '127.0.0.1', lab.port)
+        ob.add('billing', '127.0.0.1', billing.port)
+        ob.add('down', '127.0.0.1', down)
+
+        for n in range(3):
+            acks = ob.sendTo(['lab', 'billing', 'down'], ADT.replace('MSG00001', 'MSG%05d' % n))
+            self.assertIn('MSA|AA|MSG%05d' % n, acks['lab'])
+            self.assertIn('MSA|AE|MSG%05d' % n, acks['billing'])
+            self.assertIs(acks['down'], False)
+
+        # One connection each, reused for every message
+        health = ob.health()
+        self.assertEqual(health['lab']['connections'], 1)
+        self.assertEqual(len(lab.received), 3)
+        self.assertEqual(health['down']['connections'], 0)
+        self.assertGreater(health['down']['failures'], 0)
+        self.assertGreater(health['down']['retryIn'], 0)
+
+class ftpServer(threading.Thread):
+    """Stand-in FTP server keeping files in memory, enough for ftplib in passive mode"""
+
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.files = {}         # Full path -> bytes
+        self.logins = 0
+        self.ib = socket.socket()
+        self.ib.bind(('127.0.0.1', 0))
+        self.ib.listen(16)
+        self.port = self.ib.getsockname()[1]
+        self.start()
+
+    def run(self):
+        while True:
+            try:
+                conn = self.ib.accept()[0]
+            except OSError:
+                break
+            threading.Thread(target=self.session, args=(conn,), daemon=True).start()
+
+    def session(self,conn):
+        def say(text):
+            conn.sendall((text + '\r\n').encode())
+        cwd = '/'
+        data = None
+        say('220 Ready')
+        for line in conn.makefile('rb'):
+            command, _, arg = line.decode().strip().partition(' ')
+            command = command.upper()
+            if command == 'USER':
+                say('331 Password required')
+            elif command == 'PASS':
+                self.logins += 1
+                say('230 Logged in')
+            elif command == 'TYPE':
+                say('200 Type set')
+            elif command == 'PWD':
+                say('257 "%s"' % cwd)
+            elif command == 'CWD':
+                cwd = arg
+                say('250 Directory changed')
+            elif command == 'PASV':
+                data = socket.socket()
+                data.bind(('127.0.0.1', 0))
+                data.listen(1)
+                port = data.getsockname()[1]
+                say('227 Entering Passive Mode (127,0,0,1,%d,%d)' % (port >> 8, port & 255))
+            elif command == 'RETR':
+                channel = data.accept()[0]
+                content = self.files.get(cwd.rstrip('/') + '/' + arg)
+                if content is None:
+                    channel.close()
+                    say('550 No such file')
+                    continue
+                say('150 Sending')
+                try:
+                    # Small blocks, so messages arrive split across reads
+                    for i in range(0, len(content), 100):
+                        channel.sendall(content[i:i+100])
+                    channel.close()
+                    say('226 Transfer complete')
+                except OSError:
+                    say('426 Transfer aborted')
+            elif command == 'STOR':
+                channel = data.accept()[0]
+                say('150 Ready to receive')
+                content = b''
+                while True:
+                    block = channel.recv(65536)
+                    if not block:
+                        break
+                    content += block
+                channel.close()
+                self.files[cwd.rstrip('/') + '/' + arg] = content
+                say('226 Stored')
+            elif command == 'QUIT':
+                say('221 Bye')
+                break
+            else:
+                say('502 Not implemented')
+        conn.close()
+
+class ftpTest(unittest.TestCase):
+
+    def test_splitter_one_byte_blocks(self):
+        expected = [ADT, ADT.replace('MSG00001', 'MSG00002'), ADT.replace('MSG00001', 'MSG00003')]
+        for raw in (BATCH, ''.join(expected), BATCH.replace('\r', '\n')):
+            splitter = hl7._splitter()
+            found = []
+            for byte in raw.encode():
+                found.extend(splitter.feed(bytes([byte])))
+            found.extend(splitter.end())
+            if '\n' in raw:
+                found = [msg.replace(b'\n', b'\r') for msg in found]
+            self.assertEqual([msg.decode() for msg in found], expected)
+
+    def connect(self,server):
+        session = hl7.ftp('127.0.0.1', server.port)
+        session.connect('user', 'secret')
+        self.addCleanup(session.close)
+        return session
+
+    def test_iter_messages(self):
+        server = ftpServer()
+        server.files['/in/batch.hl7'] = BATCH.encode()
+        session = self.connect(server)
+        session.cd('/in')
+        messages = list(session.iterMessages('batch.hl7'))
+        self.assertEqual([msg.split('|')[9] for msg in messages], ['MSG00001', 'MSG00002', 'MSG00003'])
+        self.assertEqual(session.get('batch.hl7'), messages)
+
+        # Stopping part way leaves the session usable
+        for msg in session.iterMessages('batch.hl7', binary=True):
+            self.assertEqual(msg, ADT.encode())
+            break
+        self.assertEqual(len(session.get('batch.hl7')), 3)
+
+    def test_send_and_get_many(self):
+        server = ftpServer()
+        session = self.connect(server)
+        session.cd('/out')
+        # ASCII mode ends the upload with CRLF, binary leaves it as it is
+        session.setMode('BINARY')
+        self.addCleanup(session.setMode, 'ASCII')
+        files = dict(('%d.hl7' % n, ADT.replace('MSG00001', 'MSG%05d' % n).encode()) for n in range(12))
+        self.assertEqual(session.sendMany(files, workers=3), dict((name, True) for name in files))
+        self.assertEqual(server.files['/out/5.hl7'], files['5.hl7'])
+
+        found = session.getMany(list(files) + ['missing.hl7'], workers=3, binary=True)
+        self.assertIs(found.pop('missing.hl7'), False)
+        self.assertEqual(found, dict((name, [raw]) for name, raw in files.items()))
+        # The main session and at most one per worker
+        self.assertLessEqual(server.logins, 1 + 3 + 1)
+
+class outboxTest(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for name in os.listdir(self.folder):
+            os.remove(os.path.join(self.folder, name))
+        os.rmdir(self.folder)
+
+    def messages(self,count):
+        return [ADT.replace('MSG00001', 'MSG%05d' % n) for n in range(count)]
+
+    def test_torn_record_is_cut_off(self):
+        messages = self.messages(5)
+        out = hl7.outbox(self.folder)
+        out.putMany(messages)
+        out.ack(1)
+        out.close()
+
+        # A crash part way through writing a record
+        log = os.path.join(self.folder, '%020d.log' % 0)
+        with open(log, 'ab') as f:
+            f.write(struct.pack('<II', 500, 0) + b'MSH|^~\\&|partial')
+        size = os.path.getsize(log)
+
+        out = hl7.outbox(self.folder)
+        self.assertLess(os.path.getsize(log), size)
+        self.assertEqual(len(out), 3)
+        self.assertEqual(out.read(), list(zip(range(2, 5), messages[2:])))
+        self.assertEqual(out.put('MSH|^~\\&|after'), 5)
+        self.assertEqual(out.read(), [(5, 'MSH|^~\\&|after')])
+        out.close()
+
+    def test_corrupt_record_is_cut_off(self):
+        out = hl7.outbox(self.folder)
+        out.putMany(self.messages(3))
+        out.close()
+        log = os.path.join(self.folder, '%020d.log' % 0)
+        with open(log, 'r+b') as f:
+            f.seek(-5, os.SEEK_END)
+            f.write(b'XXXXX')
+
+        out = hl7.outbox(self.folder)
+        self.assertEqual([seq for seq, raw in out.read()], [0, 1])
+        out.close()
+
+    def test_cursor_resumes_across_segments(self):
+        messages = self.messages(10)
+        out = hl7.outbox(self.folder, segmentSize=600)
+        for raw in messages:
+            out.put(raw)
+        segments = len([name for name in os.listdir(self.folder) if name.endswith('.log')])
+        self.assertGreater(segments, 2)
+        self.assertEqual([seq for seq, raw in out.read(3)], [0, 1, 2])
+        out.ack(6)
+        out.close()
+
+        out = hl7.outbox(self.folder, segmentSize=600)
+        self.assertEqual(len(out), 3)
+        self.assertEqual(out.read(), list(zip(range(7, 10), messages[7:])))
+        remaining = len([name for name in os.listdir(self.folder) if name.endswith('.log')])
+        self.assertLess(remaining, segments)
+        out.close()
+
+    def test_drain_sends_in_order(self):
+        remote = receiver(lambda raw, n: 'AA')
+        ob = hl7.tcp.client('127.0.0.1', remote.port)
+        ob.start()
+        out = hl7.outbox(self.folder)
+        out.putMany(self.messages(20))
+        out.start(ob)
+        deadline = time.monotonic() + 5
+        while len(out) and time.monotonic() < deadline:
+            time.sleep(.01)
+        out.close()
+        ob.stop()
+        self.assertEqual(remote.received, self.messages(20))
+
+if __name__ == '__main__':
+    unittest.main()